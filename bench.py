@@ -0,0 +1,414 @@
+#####################################################################
+# Benchmarks - bench.py                                             #
+#                                                                   #
+#####################################################################
+"""
+This script compares the servers of this repository. For each server
+(and, for the WSGI servers, for each application) it:
+* starts the server, on port 8888
+* drives it with client3.py (see there) for a few seconds, once for
+  each concurrency level (number of clients sending requests at the
+  same time)
+* measures, on the server side, the CPU time used and the memory (RSS:
+  resident set size, the memory actually in RAM) of the server process
+  and all its children
+* stops the server
+At the end it prints a table with the results, and writes them to a
+JSON file. Give the JSON file of a previous run (e.g. made before your
+last change) with --compare, and the differences are printed, with the
+regressions highlighted.
+Run it by typing:
+python bench.py
+or, for a subset of the combinations:
+python bench.py --servers webserver2 webserver4 --apps wsgiapp --concurrency 1 50
+The measures on the server side read the /proc filesystem, so they work
+on Linux only.
+Be sure that nothing else is using port 8888.
+"""
+import argparse
+import json
+import os
+import signal
+import socket
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+
+import client3
+
+
+SERVER_ADDRESS = (HOST, PORT) = 'localhost', 8888
+# directory of this script, where the servers and the apps are
+ROOT = os.path.dirname(os.path.abspath(__file__))
+
+"""
+the servers. Each one is (name, command line, takes an app, run by
+default). The command line is run with python, in this directory; for
+the WSGI servers the app (module:app) is appended to it.
+Some servers are not run by default, since they are examples of what
+goes wrong, and they would just make the benchmark wait:
+* webserver3b sleeps 60 seconds after each request
+* webserver3c and webserver3e keep the connection open while their
+  children sleep, so the client never sees the end of the response
+* webserver3d never closes its copy of the connections
+"""
+SERVERS = [
+    ('webserver1', ['webserver1.py'], False, True),
+    ('webserver2', ['webserver2.py'], True, True),
+    ('webserver2-threads', ['webserver2.py', '--threads', '8'], True, True),
+    ('webserver2-workers', ['webserver2.py', '--workers',
+                            str(os.cpu_count() or 1)], True, True),
+    ('webserver3b', ['webserver3b.py'], False, False),
+    ('webserver3c', ['webserver3c.py'], False, False),
+    ('webserver3d', ['webserver3d.py'], False, False),
+    ('webserver3e', ['webserver3e.py'], False, False),
+    ('webserver3f', ['webserver3f.py'], False, True),
+    ('webserver3g', ['webserver3g.py'], False, True),
+    ('webserver3h', ['webserver3h.py'], False, True),
+    ('webserver3i', ['webserver3i.py'], False, True),
+    ('webserver4', ['webserver4.py'], True, True),
+]
+
+# the sample applications (module:app). The frameworks (flask, pyramid,
+# django) must be installed, otherwise their combinations are skipped
+APPS = ['wsgiapp:app', 'flaskapp:app', 'pyramidapp:app', 'djangoapp:app']
+
+
+"""
+a process and all its descendants, read from /proc (Linux only)
+"""
+class ProcessTree(object):
+    # clock ticks per second, the unit of the CPU times in /proc
+    ticks = os.sysconf('SC_CLK_TCK')
+    page_size = os.sysconf('SC_PAGE_SIZE')
+
+    def __init__(self, pid):
+        self.pid = pid
+    # pids of the process and of all its descendants
+    def pids(self):
+        children = {}
+        for name in os.listdir('/proc'):
+            if name.isdigit():
+                stat = self.read_stat(int(name))
+                if stat is not None:
+                    children.setdefault(int(stat[1]), []).append(int(name))
+        pids, todo = [], [self.pid]
+        while todo:
+            pid = todo.pop()
+            pids.append(pid)
+            todo.extend(children.get(pid, []))
+        return pids
+    """
+    fields of /proc/<pid>/stat after the command name, which is between
+    parentheses and may contain spaces: field 0 is the state, 1 the
+    parent pid, 11-14 utime, stime, cutime, cstime, 21 the RSS in pages
+    """
+    def read_stat(self, pid):
+        try:
+            with open('/proc/{0}/stat'.format(pid)) as stat_file:
+                data = stat_file.read()
+        except OSError:
+            return None
+        return data[data.rindex(')') + 2:].split()
+    """
+    CPU time (seconds) used by the processes, including their children
+    that have terminated (cutime, cstime): e.g. the children forked by
+    webserver3g for each connection
+    """
+    def cpu_seconds(self):
+        ticks = 0
+        for pid in self.pids():
+            stat = self.read_stat(pid)
+            if stat is not None:
+                ticks += sum(int(value) for value in stat[11:15])
+        return ticks / float(self.ticks)
+    # memory in RAM (bytes) of all the processes
+    def rss_bytes(self):
+        pages = 0
+        for pid in self.pids():
+            stat = self.read_stat(pid)
+            if stat is not None:
+                pages += int(stat[21])
+        return pages * self.page_size
+
+
+"""
+samples the RSS of a process tree every interval seconds, in a thread,
+and keeps the highest value
+"""
+class RSSSampler(object):
+    def __init__(self, tree, interval=0.2):
+        self.tree = tree
+        self.interval = interval
+        self.peak = 0
+        self.done = threading.Event()
+        self.thread = threading.Thread(target=self.run, daemon=True)
+
+    def run(self):
+        while not self.done.is_set():
+            self.peak = max(self.peak, self.tree.rss_bytes())
+            self.done.wait(self.interval)
+
+    def __enter__(self):
+        self.thread.start()
+        return self
+
+    def __exit__(self, *exc_info):
+        self.done.set()
+        self.thread.join()
+
+
+"""
+starts a server, and waits until it accepts connections. Returns the
+subprocess.Popen object, or raises RuntimeError with the error output
+of the server if it exits before that (e.g. the app can't be imported).
+The server runs in its own session (process group), so that it can be
+stopped together with its children (see stop_server).
+"""
+def start_server(command, timeout=15.0):
+    errors = tempfile.TemporaryFile()
+    process = subprocess.Popen(
+        [sys.executable] + command,
+        cwd=ROOT,
+        stdout=subprocess.DEVNULL,
+        stderr=errors,
+        start_new_session=True,
+    )
+    deadline = time.time() + timeout
+    while time.time() < deadline:
+        if process.poll() is not None:
+            errors.seek(0)
+            message = errors.read().decode('utf-8', 'replace').strip()
+            raise RuntimeError(message.splitlines()[-1] if message else
+                               'exited with status {0}'.format(process.returncode))
+        try:
+            socket.create_connection(SERVER_ADDRESS, timeout=1).close()
+            return process
+        except OSError:
+            time.sleep(0.1)
+    stop_server(process)
+    raise RuntimeError('not accepting connections after {0}s'.format(timeout))
+
+
+def stop_server(process):
+    try:
+        os.killpg(process.pid, signal.SIGTERM)
+        process.wait(timeout=5)
+    except subprocess.TimeoutExpired:
+        os.killpg(process.pid, signal.SIGKILL)
+        process.wait()
+    except ProcessLookupError:
+        pass
+
+
+"""
+benchmarks one server/app combination at all the concurrency levels.
+Returns a list of result dictionaries, one per level.
+"""
+def bench_combination(name, command, app, args):
+    label = '{0} {1}'.format(name, app or '-')
+    try:
+        process = start_server(command + ([app] if app else []))
+    except RuntimeError as e:
+        print('{0}: skipped ({1})'.format(label, e))
+        return [{
+            'server': name, 'app': app, 'concurrency': concurrency,
+            'skipped': str(e),
+        } for concurrency in args.concurrency]
+    results = []
+    try:
+        tree = ProcessTree(process.pid)
+        # a short warm-up, so that imports and caches don't count
+        client3.run(HOST, PORT, path=args.path, clients=1, duration=0.5,
+                    keepalive=args.keepalive, expect_status=0)
+        for concurrency in args.concurrency:
+            cpu_before = tree.cpu_seconds()
+            with RSSSampler(tree) as sampler:
+                # as many requests as the clients can send in the
+                # duration; any other status (e.g. a 503 of an overloaded
+                # server) is counted as an error
+                result = client3.run(
+                    HOST, PORT, path=args.path, clients=concurrency,
+                    requests=None, duration=args.duration,
+                    keepalive=args.keepalive, timeout=args.timeout,
+                    expect_status=args.expect_status,
+                )
+            result.update({
+                'server': name,
+                'app': app,
+                'concurrency': concurrency,
+                'cpu_seconds': round(tree.cpu_seconds() - cpu_before, 3),
+                'rss_mb': round(sampler.peak / 1048576.0, 1),
+            })
+            results.append(result)
+            print('{0} c={1}: {2} req/s, p99 {3}ms, {4} errors'.format(
+                label, concurrency, result['requests_per_second'],
+                result['latency_ms']['p99'], sum(result['errors'].values()),
+            ))
+    finally:
+        stop_server(process)
+    return results
+
+
+def key(result):
+    return result['server'], result['app'], result['concurrency']
+
+
+def format_table(results):
+    header = '{0:<20} {1:<16} {2:>5} {3:>9} {4:>8} {5:>8} {6:>9} {7:>7} {8:>7} {9:>7}'
+    lines = [header.format('server', 'app', 'conc', 'req/s', 'p50 ms',
+                           'p99 ms', 'p99.9 ms', 'errors', 'cpu s', 'rss MB')]
+    for result in results:
+        if 'skipped' in result:
+            continue
+        latency = result['latency_ms']
+        lines.append(header.format(
+            result['server'], result['app'] or '-', result['concurrency'],
+            result['requests_per_second'], latency['p50'], latency['p99'],
+            latency['p99.9'], sum(result['errors'].values()),
+            result['cpu_seconds'], result['rss_mb'],
+        ))
+    return '\n'.join(lines)
+
+
+"""
+compares the results with the ones of a previous run. A combination
+regresses if its throughput dropped, or its p99 latency grew, by more
+than threshold percent.
+"""
+def format_comparison(results, previous, threshold):
+    old = dict((key(result), result) for result in previous
+               if 'skipped' not in result)
+    lines = ['{0:<20} {1:<16} {2:>5} {3:>10} {4:>10}'.format(
+        'server', 'app', 'conc', 'req/s', 'p99')]
+    for result in results:
+        if 'skipped' in result or key(result) not in old:
+            continue
+        before = old[key(result)]
+
+        def change(new, old):
+            return (new - old) * 100.0 / old if old else 0.0
+        rps = change(result['requests_per_second'],
+                     before['requests_per_second'])
+        p99 = change(result['latency_ms']['p99'], before['latency_ms']['p99'])
+        regression = rps < -threshold or p99 > threshold
+        lines.append('{0:<20} {1:<16} {2:>5} {3:>+9.1f}% {4:>+9.1f}%{5}'.format(
+            result['server'], result['app'] or '-', result['concurrency'],
+            rps, p99, '  REGRESSION' if regression else '',
+        ))
+    return '\n'.join(lines)
+
+
+def git_revision():
+    try:
+        return subprocess.check_output(
+            ['git', 'rev-parse', '--short', 'HEAD'], cwd=ROOT,
+            stderr=subprocess.DEVNULL,
+        ).decode().strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(
+        description='Benchmark of the LSBAWS servers.',
+        formatter_class=argparse.ArgumentDefaultsHelpFormatter,
+    )
+    parser.add_argument(
+        '--servers',
+        nargs='+',
+        default=[name for name, command, wsgi, default in SERVERS if default],
+        choices=[name for name, command, wsgi, default in SERVERS],
+        help='Servers to benchmark.'
+    )
+    parser.add_argument(
+        '--apps',
+        nargs='+',
+        default=[app.split(':')[0] for app in APPS],
+        help='Applications to run on the WSGI servers.'
+    )
+    parser.add_argument(
+        '--concurrency',
+        nargs='+',
+        type=int,
+        default=[1, 10, 50],
+        help='Numbers of concurrent clients.'
+    )
+    parser.add_argument(
+        '--duration',
+        type=float,
+        default=5.0,
+        help='Seconds of load for each concurrency level.'
+    )
+    parser.add_argument(
+        '--keepalive',
+        action='store_true',
+        help='Reuse the connections (HTTP/1.1 keep-alive).'
+    )
+    parser.add_argument(
+        '--path',
+        default=client3.PATH,
+        help='Path requested.'
+    )
+    parser.add_argument(
+        '--timeout',
+        type=float,
+        default=10.0,
+        help='Seconds to wait for a response.'
+    )
+    parser.add_argument(
+        '--expect-status',
+        type=int,
+        default=200,
+        help='Expected status of the responses, others are errors (0: any).'
+    )
+    parser.add_argument(
+        '--json',
+        metavar='FILE',
+        default='bench_results.json',
+        help='Write the results as JSON to FILE.'
+    )
+    parser.add_argument(
+        '--compare',
+        metavar='FILE',
+        default=None,
+        help='JSON file of a previous run, to compare with.'
+    )
+    parser.add_argument(
+        '--threshold',
+        type=float,
+        default=10.0,
+        help='Percent change reported as a regression.'
+    )
+    args = parser.parse_args()
+
+    results = []
+    for name, command, wsgi, default in SERVERS:
+        if name not in args.servers:
+            continue
+        if wsgi:
+            for app in APPS:
+                if app.split(':')[0] in args.apps:
+                    results += bench_combination(name, command, app, args)
+        else:
+            results += bench_combination(name, command, None, args)
+
+    print()
+    print(format_table(results))
+    with open(args.json, 'w') as json_file:
+        json.dump({
+            'revision': git_revision(),
+            'time': time.strftime('%Y-%m-%d %H:%M:%S'),
+            'duration': args.duration,
+            'keepalive': args.keepalive,
+            'results': results,
+        }, json_file, indent=2)
+    print('\nresults written to {0}'.format(args.json))
+    if args.compare:
+        with open(args.compare) as json_file:
+            previous = json.load(json_file)
+        print('\nchanges since {0} ({1}):'.format(
+            args.compare, previous.get('revision')))
+        print(format_comparison(results, previous['results'], args.threshold))
@@ -3,48 +3,438 @@
 #                                                                   #
 #####################################################################
 """
-This simple script simulates a variable number of clients making
-requests to the server running at localhost (your computer), port 8888.
+This script is a load generator: it simulates a number of clients
+making requests to the server running at localhost (your computer),
+port 8888, and measures how the server copes with them.
 Run it by typing:
 python client3.py --max-clients=300 --max-conns=1
-(You can specify the number of clients/connections-per-client
+(You can specify the number of clients/requests-per-client
 from the command line.)
 Be sure that the server is running before running this script.
+
+There are two ways of generating the load:
+* closed loop (the default): --max-clients clients, each sending a
+  request, waiting for the response, and sending the next one, until
+  it has sent --max-conns requests (or, with --duration, until the time
+  is up). The load adapts to the server: a slow server receives fewer
+  requests.
+* open loop (--rate): requests arrive at a fixed rate, e.g. 1000 per
+  second, whatever the server does, as with real users. The latency
+  of a request is measured from the moment it *should* have been sent,
+  so the time spent waiting for a free connection is counted too.
+By default each request uses a new connection. With --keepalive the
+connections are reused (HTTP/1.1 persistent connections), and with
+--pipeline N each client sends N requests at once, before reading the
+N responses.
+At the end it prints the number of requests per second, the errors,
+and the latency percentiles (p50 is the median: half of the requests
+took less than that; p99: 99% of them took less than that, ...).
+Use --json to get the same results as JSON, e.g. to compare runs.
 """
 # the module argparse is used to make a program accept named command
 # line arguments, like --max-clients
 import argparse
-import errno
-import os
-import socket
+# the clients run as coroutines in a single process, on an event loop
+# (see webserver4.py): thousands of them cost just some memory
+import asyncio
+import json
+import sys
+import time
 
 
 SERVER_ADDRESS = 'localhost', 8888
-REQUEST = b"""\
-GET /hello HTTP/1.1
-Host: localhost:8888
-
-"""
-
-# when this is called, it creates max_clients sockets, simulating
-# an equal amount of clients connecting to the server, and sends
-# a simple get request (see text above). Each client sends max_conns
-# equal requests. The total load that the server will receive will be
-# therefore max_clients*max_conns.
-def main(max_clients, max_conns):
-    socks = []
-    for client_num in range(max_clients):
-        pid = os.fork()
-        if pid == 0:
-            for connection_num in range(max_conns):
-                sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
-                sock.connect(SERVER_ADDRESS)
-                sock.sendall(REQUEST)
-                socks.append(sock)
-                print(connection_num)
-                os._exit(0)
-
-# read parameters from command line, and call main()
+PATH = '/hello'
+
+
+"""
+latency histogram, in the style of HdrHistogram: instead of keeping all
+the measurements, it counts how many fall in each bucket. The buckets
+are exact up to 128 microseconds, and then grow with the value, so that
+every bucket is less than 1/64 (~1.5%) wide relative to its values.
+So the memory used is small and fixed, whatever the number of requests,
+and the percentiles are precise to ~1.5%.
+"""
+class Histogram(object):
+    # number of significant bits kept for each value
+    precision_bits = 7
+
+    def __init__(self):
+        self.counts = {}
+        self.count = 0
+        self.total = 0
+        self.min = None
+        self.max = 0
+    # the bucket of a value is (shift, value >> shift)
+    def bucket(self, value):
+        shift = max(value.bit_length() - self.precision_bits, 0)
+        return shift, value >> shift
+    # records a latency, given in seconds
+    def record(self, seconds):
+        value = max(int(seconds * 1000000), 0)  # microseconds
+        key = self.bucket(value)
+        self.counts[key] = self.counts.get(key, 0) + 1
+        self.count += 1
+        self.total += value
+        if self.min is None or value < self.min:
+            self.min = value
+        if value > self.max:
+            self.max = value
+    # value (microseconds) below which percent % of the values are
+    def percentile(self, percent):
+        if not self.count:
+            return 0
+        wanted = self.count * percent / 100.0
+        seen = 0
+        for shift, mantissa in sorted(self.counts):
+            seen += self.counts[shift, mantissa]
+            if seen >= wanted:
+                # the highest value of the bucket
+                return min(((mantissa + 1) << shift) - 1, self.max)
+        return self.max
+    # summary in milliseconds
+    def to_dict(self):
+        def ms(value):
+            return round(value / 1000.0, 3)
+        return {
+            'min': ms(self.min or 0),
+            'mean': ms(self.total / self.count if self.count else 0),
+            'p50': ms(self.percentile(50)),
+            'p90': ms(self.percentile(90)),
+            'p99': ms(self.percentile(99)),
+            'p99.9': ms(self.percentile(99.9)),
+            'max': ms(self.max),
+        }
+
+
+"""
+results of a run, shared by all the clients
+"""
+class Stats(object):
+    def __init__(self):
+        self.histogram = Histogram()
+        self.requests = 0
+        self.bytes = 0
+        self.statuses = {}
+        self.errors = {}
+
+    def error(self, kind):
+        self.errors[kind] = self.errors.get(kind, 0) + 1
+
+
+"""
+raised when a response is not what we expected
+"""
+class ResponseError(Exception):
+    pass
+
+
+"""
+raised when the server closes the connection (or resets it) before
+sending the first response of an exchange (see reuse)
+"""
+class NotAnswered(ResponseError):
+    pass
+
+
+def build_request(path, host, keepalive):
+    lines = [
+        'GET {path} HTTP/1.1'.format(path=path),
+        'Host: {host}'.format(host=host),
+    ]
+    if not keepalive:
+        lines.append('Connection: close')
+    return ('\r\n'.join(lines) + '\r\n\r\n').encode('latin-1')
+
+
+"""
+reads a response from the server. Returns (status, body size, keep),
+where keep tells if the connection can be used for another request.
+It accepts both \r\n and \n as newlines, since the simple servers
+(webserver1, webserver3*) answer with \n only, and without any header:
+then the body ends when the server closes the connection.
+"""
+async def read_response(reader):
+    try:
+        status_line = await reader.readline()
+    except ConnectionResetError:
+        status_line = b''
+    if not status_line:
+        raise NotAnswered('closed')
+    parts = status_line.split(None, 2)
+    if len(parts) < 2 or not parts[0].startswith(b'HTTP/'):
+        raise ResponseError('bad status line')
+    version, status = parts[0], int(parts[1])
+    headers = {}
+    while True:
+        line = await reader.readline()
+        if not line:
+            raise ResponseError('closed')
+        if not line.strip():
+            break
+        name, _, value = line.decode('latin-1').partition(':')
+        headers[name.strip().lower()] = value.strip()
+    keep = (
+        version == b'HTTP/1.1'
+        and headers.get('connection', '').lower() != 'close'
+    )
+    if headers.get('transfer-encoding', '').lower() == 'chunked':
+        size = 0
+        while True:
+            chunk_size = int((await reader.readline()).split(b';')[0], 16)
+            if chunk_size == 0:
+                # trailers, up to an empty line
+                while (await reader.readline()).strip():
+                    pass
+                break
+            size += chunk_size
+            await reader.readexactly(chunk_size + 2)
+    elif 'content-length' in headers:
+        size = int(headers['content-length'])
+        await reader.readexactly(size)
+    elif status in (204, 304) or 100 <= status < 200:
+        size = 0
+    else:
+        # no length: the body ends when the connection is closed
+        size = len(await reader.read())
+        keep = False
+    return status, size, keep
+
+
+"""
+settings of a run (see run() and the command line arguments)
+"""
+class Config(object):
+    def __init__(self, **kwargs):
+        self.__dict__.update(kwargs)
+        self.request = build_request(
+            self.path, '{0}:{1}'.format(self.host, self.port), self.keepalive
+        )
+
+
+"""
+sends count requests on the connection (reader, writer), all at once
+if count > 1 (pipelining), and reads the responses. start is the time
+to measure the latency from. Returns True if the connection can be
+reused.
+"""
+async def exchange(config, stats, reader, writer, count, start):
+    try:
+        writer.write(config.request * count)
+        await writer.drain()
+    except ConnectionError:
+        raise NotAnswered('closed')
+    keep = True
+    for i in range(count):
+        try:
+            status, size, keep = await asyncio.wait_for(
+                read_response(reader), config.timeout
+            )
+        except NotAnswered:
+            if i > 0:
+                # some of the pipelined requests were answered
+                raise ResponseError('closed')
+            raise
+        stats.histogram.record(time.perf_counter() - start)
+        stats.requests += 1
+        stats.bytes += size
+        stats.statuses[status] = stats.statuses.get(status, 0) + 1
+        if config.expect_status and status != config.expect_status:
+            stats.error('status')
+        if not keep and i < count - 1:
+            # the server closed: the other pipelined requests are lost
+            stats.error('closed')
+            return False
+    return keep
+
+
+async def connect(config):
+    return await asyncio.wait_for(
+        asyncio.open_connection(config.host, config.port), config.timeout
+    )
+
+
+def close(writer):
+    if writer is not None:
+        writer.close()
+
+
+"""
+sends count requests on a keep-alive connection already used (see
+exchange). Returns None, without counting an error, if the server
+closed it without answering: a server may close an idle connection
+while the request is on its way (e.g. webserver2 without threads, when
+another client is waiting, see WSGIRequestHandler.wait_for_next_request),
+and HTTP clients then send the request again on a new connection.
+Otherwise the same as exchange.
+"""
+async def reuse(config, stats, reader, writer, count, start):
+    try:
+        return await exchange(config, stats, reader, writer, count, start)
+    except NotAnswered:
+        return None
+
+
+"""
+closed loop: a client sends its requests one after the other (or
+pipeline at a time), until it has sent 'requests' requests (None: no
+limit), or until the deadline
+"""
+async def closed_loop_client(config, stats, requests, deadline):
+    reader = writer = None
+    while ((requests is None or requests > 0)
+            and (deadline is None or time.perf_counter() < deadline)):
+        count = config.pipeline
+        if requests is not None:
+            count = min(count, requests)
+            requests -= count
+        start = time.perf_counter()
+        try:
+            keep = None
+            if writer is not None:
+                keep = await reuse(config, stats, reader, writer, count, start)
+            if keep is None:
+                close(writer)
+                reader, writer = await connect(config)
+                keep = await exchange(
+                    config, stats, reader, writer, count, start
+                )
+        except asyncio.TimeoutError:
+            stats.error('timeout')
+            keep = False
+        except (OSError, ResponseError, asyncio.IncompleteReadError, ValueError):
+            stats.error('connection')
+            keep = False
+        if not (keep and config.keepalive):
+            close(writer)
+            reader = writer = None
+    close(writer)
+
+
+"""
+open loop: the i-th request is due at start + i / rate, whatever
+happened to the previous ones. Idle keep-alive connections are kept in
+a pool, and reused by the next requests.
+"""
+async def open_loop(config, stats):
+    idle = []
+    inflight = asyncio.Semaphore(config.max_inflight)
+    tasks = set()
+
+    async def one_request(due):
+        async with inflight:
+            reader = writer = None
+            try:
+                keep = None
+                if idle:
+                    reader, writer = idle.pop()
+                    keep = await reuse(config, stats, reader, writer, 1, due)
+                if keep is None:
+                    close(writer)
+                    reader, writer = await connect(config)
+                    keep = await exchange(config, stats, reader, writer, 1, due)
+            except asyncio.TimeoutError:
+                stats.error('timeout')
+                keep = False
+            except (OSError, ResponseError, asyncio.IncompleteReadError, ValueError):
+                stats.error('connection')
+                keep = False
+            if keep and config.keepalive:
+                idle.append((reader, writer))
+            else:
+                close(writer)
+
+    start = time.perf_counter()
+    total = int(config.rate * config.duration)
+    for i in range(total):
+        due = start + i / config.rate
+        delay = due - time.perf_counter()
+        if delay > 0:
+            await asyncio.sleep(delay)
+        task = asyncio.ensure_future(one_request(due))
+        tasks.add(task)
+        task.add_done_callback(tasks.discard)
+    if tasks:
+        await asyncio.wait(tasks)
+    for reader, writer in idle:
+        close(writer)
+
+
+async def run_async(config):
+    stats = Stats()
+    start = time.perf_counter()
+    if config.rate:
+        await open_loop(config, stats)
+    else:
+        deadline = start + config.duration if config.duration else None
+        await asyncio.gather(*[
+            closed_loop_client(config, stats, config.requests, deadline)
+            for client_num in range(config.clients)
+        ])
+    elapsed = time.perf_counter() - start
+    return {
+        'mode': 'open' if config.rate else 'closed',
+        'url': 'http://{0}:{1}{2}'.format(config.host, config.port, config.path),
+        'clients': config.clients,
+        'rate': config.rate,
+        'keepalive': config.keepalive,
+        'pipeline': config.pipeline,
+        'duration': round(elapsed, 3),
+        'requests': stats.requests,
+        'errors': stats.errors,
+        'requests_per_second': round(stats.requests / elapsed, 1) if elapsed else 0,
+        'bytes': stats.bytes,
+        'statuses': dict((str(k), v) for k, v in stats.statuses.items()),
+        'latency_ms': stats.histogram.to_dict(),
+    }
+
+
+"""
+runs a load test and returns the results as a dictionary (the same
+that is printed with --json). Used by bench.py too.
+requests is the number of requests of each client in a closed loop:
+by default 1024, or no limit when a duration is given (the clients
+stop at the end of it).
+"""
+def run(host=SERVER_ADDRESS[0], port=SERVER_ADDRESS[1], path=PATH,
+        clients=1, requests=None, duration=None, rate=None,
+        keepalive=False, pipeline=1, timeout=10.0, expect_status=200,
+        max_inflight=1000):
+    if requests is None and not duration:
+        requests = 1024
+    config = Config(
+        host=host, port=port, path=path, clients=clients,
+        requests=requests, duration=duration, rate=rate,
+        keepalive=keepalive, pipeline=pipeline if keepalive else 1,
+        timeout=timeout, expect_status=expect_status,
+        max_inflight=max_inflight,
+    )
+    if rate and not duration:
+        config.duration = 10.0
+    return asyncio.run(run_async(config))
+
+
+def format_summary(result):
+    latency = result['latency_ms']
+    lines = [
+        '{mode} loop, {url}'.format(**result),
+        '  requests:  {requests} in {duration}s'.format(**result),
+        '  req/sec:   {requests_per_second}'.format(**result),
+        '  errors:    {0}'.format(
+            ', '.join('{0}={1}'.format(k, v)
+                      for k, v in sorted(result['errors'].items())) or 0
+        ),
+        '  statuses:  {0}'.format(
+            ', '.join('{0}={1}'.format(k, v)
+                      for k, v in sorted(result['statuses'].items()))
+        ),
+        '  latency (ms): min {min}  mean {mean}  max {max}'.format(**latency),
+        '    p50 {0}  p90 {1}  p99 {2}  p99.9 {3}'.format(
+            latency['p50'], latency['p90'], latency['p99'], latency['p99.9']
+        ),
+    ]
+    return '\n'.join(lines)
+
+# read parameters from command line, and call run()
 if __name__ == '__main__':
     parser = argparse.ArgumentParser(
         description='Test client for LSBAWS.',
@@ -53,14 +443,93 @@ if __name__ == '__main__':
     parser.add_argument(
         '--max-conns',
         type=int,
-        default=1024,
-        help='Maximum number of connections per client.'
+        default=None,
+        help='Number of requests per client (closed loop). Default: 1024, '
+             'or no limit with --duration.'
     )
     parser.add_argument(
         '--max-clients',
         type=int,
         default=1,
-        help='Maximum number of clients.'
+        help='Number of concurrent clients (closed loop).'
+    )
+    parser.add_argument(
+        '--duration',
+        type=float,
+        default=None,
+        help='Run for this many seconds, instead of --max-conns requests.'
+    )
+    parser.add_argument(
+        '--rate',
+        type=float,
+        default=None,
+        help='Open loop: send this many requests per second.'
+    )
+    parser.add_argument(
+        '--max-inflight',
+        type=int,
+        default=1000,
+        help='Open loop: maximum number of requests in flight.'
+    )
+    parser.add_argument(
+        '--keepalive',
+        action='store_true',
+        help='Reuse the connections (HTTP/1.1 keep-alive).'
+    )
+    parser.add_argument(
+        '--pipeline',
+        type=int,
+        default=1,
+        help='With --keepalive, requests sent at once on a connection.'
+    )
+    parser.add_argument(
+        '--host',
+        default=SERVER_ADDRESS[0],
+        help='Server host.'
+    )
+    parser.add_argument(
+        '--port',
+        type=int,
+        default=SERVER_ADDRESS[1],
+        help='Server port.'
+    )
+    parser.add_argument(
+        '--path',
+        default=PATH,
+        help='Path requested.'
+    )
+    parser.add_argument(
+        '--timeout',
+        type=float,
+        default=10.0,
+        help='Seconds to wait for a response.'
+    )
+    parser.add_argument(
+        '--expect-status',
+        type=int,
+        default=200,
+        help='Expected status of the responses (0: any).'
+    )
+    parser.add_argument(
+        '--json',
+        metavar='FILE',
+        default=None,
+        help='Write the results as JSON to FILE ("-": standard output).'
     )
     args = parser.parse_args()
-    main(args.max_clients, args.max_conns)
+    result = run(
+        host=args.host, port=args.port, path=args.path,
+        clients=args.max_clients, requests=args.max_conns,
+        duration=args.duration, rate=args.rate,
+        keepalive=args.keepalive, pipeline=args.pipeline,
+        timeout=args.timeout, expect_status=args.expect_status,
+        max_inflight=args.max_inflight,
+    )
+    if args.json == '-':
+        json.dump(result, sys.stdout, indent=2)
+        print()
+    else:
+        print(format_summary(result))
+        if args.json:
+            with open(args.json, 'w') as json_file:
+                json.dump(result, json_file, indent=2)
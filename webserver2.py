@@ -69,156 +69,1791 @@ sys.argv contains the list of command line arguments passed to a
 Python script. argv[0] = script name. argv[n] = n-th argument
 """
 import sys
+"""
+os module provides a portable way of using operating system dependent
+functionality. Here it is used for:
+* fork() clones the current process. It returns 0 in the child (the
+         clone) and the pid of the child in the parent
+* waitpid(pid, options) waits for a child process to terminate, and
+         returns its (pid, status). See webserver3g.py for more details
+* kill(pid, sig) sends the signal sig to the process pid
+* _exit(n) exits the process without calling cleanup handlers. This is
+         the standard way of terminating a forked child
+"""
+import os
+"""
+signal module allows to set handlers for asynchronous events (signals)
+sent by the kernel or by other processes, e.g. SIGCHLD (a child process
+terminated), SIGTERM (please terminate), SIGINT (CTRL+C).
+"""
+import signal
+"""
+argparse is used to make the program accept named command line
+arguments, like --workers (see also client3.py)
+"""
+import argparse
+"""
+unquote(string, encoding) decodes the %xx escapes of an url,
+e.g. '/hello%20world' -> '/hello world'
+"""
+from urllib.parse import unquote
+"""
+traceback module prints the stack trace of exceptions, e.g. with
+traceback.print_exc() inside an 'except' block
+"""
+import traceback
+"""
+stat module interprets the results of os.stat()/os.fstat(), e.g.
+stat.S_ISREG(mode) tells if a file is a regular file
+"""
+import stat
+"""
+selectors waits for several sockets at once (epoll on Linux): used to
+accept connections on several listening sockets (see WSGIServer.accept).
+fcntl.fcntl(fd, F_DUPFD, n) duplicates a file descriptor, as os.dup(),
+but to the lowest free number >= n (see WSGIServer.reexec)
+"""
+import selectors
+import fcntl
+"""
+threading module runs functions in threads. A thread is like a separate
+flow of execution inside the same process: all the threads of a process
+share its memory (and its python objects).
+concurrent.futures.ThreadPoolExecutor manages a pool of threads, which
+run the functions that are submitted to it.
+"""
+import threading
+from concurrent.futures import ThreadPoolExecutor
+"""
+time.time() returns the current time, in seconds since the epoch.
+email.utils.formatdate(timeval, usegmt=True) formats a time as required
+by HTTP for the Date header (RFC 7231), e.g. 'Tue, 31 Mar 2015 12:54:48 GMT'
+email.utils.parsedate_tz and mktime_tz do the opposite, for the dates
+sent by the clients (see ConditionalRequests)
+"""
+import time
+from email.utils import formatdate, parsedate_tz, mktime_tz
+"""
+random.random() returns a random float in [0, 1[. It is used to pick
+the requests written in the access log (see AccessLog)
+"""
+import random
+"""
+gc is the interface to the garbage collector, which finds and frees the
+groups of objects referring to each other (cycles). See
+WSGIServer.spawn_worker for why it matters when forking.
+"""
+import gc
+"""
+mmap.mmap(-1, size) allocates size bytes of memory which, unlike the
+rest, stays shared with the child processes after fork() (see
+RequestStats). json converts python objects to JSON text.
+"""
+import mmap
+import json
+"""
+collections.OrderedDict is a dictionary which remembers the order of its
+keys, and can move a key to the end: see ResponseCache
+"""
+from collections import OrderedDict, deque
+"""
+zlib compresses data with the deflate algorithm, used by both the gzip
+and the deflate content encodings of HTTP (see Compression)
+"""
+import zlib
+"""
+mimetypes.guess_type(path) guesses the content type of a file from its
+extension, e.g. 'style.css' -> 'text/css' (see StaticFiles)
+"""
+import mimetypes
 
-# WSGI program class definition
-class WSGIServer(object):
+"""
+headers added by the server to every response. They never change, so
+they are converted to bytes once, when the module is loaded, and not
+formatted again for every response.
+"""
+SERVER_SOFTWARE = 'WSGIServer 0.2'
+SERVER_HEADER = 'Server: {0}\r\n'.format(SERVER_SOFTWARE).encode('latin-1')
+CHUNKED_HEADER = b'Transfer-Encoding: chunked\r\n'
+CLOSE_HEADER = b'Connection: close\r\n'
+KEEP_ALIVE_HEADER = b'Connection: keep-alive\r\n'
+# interim response to 'Expect: 100-continue' (see RequestBody)
+CONTINUE_RESPONSE = b'HTTP/1.1 100 Continue\r\n\r\n'
+
+"""
+returns the Date header line (as bytes) for the current time.
+The date has a precision of one second, so there is no need to format
+it for every response: it is formatted at most once per second, and
+the result is shared by all the requests (and threads) in the meantime.
+date_cache holds (second, header line). It is replaced as a whole,
+never modified, so the threads always see a consistent pair.
+"""
+date_cache = (0, b'')
+
+def date_header():
+    global date_cache
+    now = int(time.time())
+    second, header = date_cache
+    if second != now:
+        header = 'Date: {0}\r\n'.format(
+            formatdate(now, usegmt=True)
+        ).encode('latin-1')
+        date_cache = (now, header)
+    return header
+
+"""
+access log: one line for each request served, e.g.
+127.0.0.1 "GET /hello HTTP/1.1" 200 44 0.512ms
+(client address, request line, status, bytes of body sent, time spent
+serving the request).
+Writing to the terminal or to a file for every request is slow, and it
+would make the request wait. So log() just appends the line to a list in
+memory, and a background thread writes all the lines collected so far
+with a single write(), every flush_interval seconds.
+With sample_rate < 1, only that fraction of the requests is logged
+(e.g. 0.01: one request in a hundred, picked at random), which is often
+enough to see what is going on in a busy server.
+"""
+class AccessLog(object):
+    def __init__(self, stream, sample_rate=1.0, flush_interval=1.0):
+        self.stream = stream
+        self.sample_rate = sample_rate
+        self.flush_interval = flush_interval
+        self.lines = []
+        # the lines are added by the threads serving the requests, and
+        # taken by the flushing thread: the lock makes sure that they
+        # don't touch self.lines at the same time
+        self.lock = threading.Lock()
     """
-    class variables, shared by all instances of WSGIServer class
-    they can still be accessed as self.address_family, self.socket_type,...
+    starts the background thread. It must be called in the process that
+    serves the requests: after a fork(), the child has no threads
     """
-    # constant representing IPv4, passed as first argument to socket()
-    address_family = socket.AF_INET
-    # constant representing socket type of type TCP
-    socket_type = socket.SOCK_STREAM
-    # parameter for socket.listen([backlog]) which specifies the number of
-    # unaccepted connections that the system will allow before reusing new connections
-    request_queue_size = 1
+    def start(self):
+        # daemon: the thread does not prevent the program from exiting
+        thread = threading.Thread(
+            target=self.run, name=ACCESS_LOG_THREAD, daemon=True
+        )
+        thread.start()
+    # tells if the current request must be logged
+    def sampled(self):
+        return self.sample_rate >= 1 or random.random() < self.sample_rate
+
+    def log(self, line):
+        with self.lock:
+            self.lines.append(line)
+
+    def run(self):
+        while True:
+            time.sleep(self.flush_interval)
+            self.flush()
+    # writes all the lines collected so far
+    def flush(self):
+        with self.lock:
+            lines, self.lines = self.lines, []
+        if lines:
+            self.stream.write('\n'.join(lines) + '\n')
+            self.stream.flush()
+
+"""
+statistics of the requests (--stats option): how many there were, and
+how long each phase of serving them took:
+* accept : from accept() to the handler starting on the connection (e.g.
+           waiting for a free thread)
+* read   : reading and parsing the head of the request (request line
+           and headers), from its first byte (the time spent waiting for
+           a new request on a keep-alive connection does not count). The
+           body is read later, by the app (see RequestBody): that time
+           is part of the app phase
+* environ: building the environ dictionary (see get_environ)
+* app    : calling the application, until it returns its iterable
+* write  : sending the response (see finish_response), which includes
+           iterating over the result of the app
+* close  : closing the connection
+* total  : the whole request, from its first byte to the response sent
+[histograms]
+The durations are not kept one by one: for each phase there is a
+histogram, i.e. a count of the durations falling in each range (bucket),
+from which the percentiles can be estimated. The buckets are 4 for each
+power of 2 microseconds (4-5us, 5-6us, 6-7us, 7-8us, 8-10us, 10-12us,
+...), so a percentile is known within 25%, and 128 buckets are enough
+for durations up to an hour. Recording a duration is just an increment.
+[several workers]
+The numbers live in a shared memory area: an anonymous mmap created by
+the master before forking is shared by all the workers (writes of a
+worker are seen by all the others, not copied as the rest of the
+memory). Each worker writes in its own slot, so they never write the
+same numbers at the same time, and any worker can read all the slots to
+answer /__stats with the numbers of the whole server. There are two
+slots for each worker: during a reload, the old and the new worker with
+the same number use different ones (see WSGIServer.spawn_worker).
+"""
+class RequestStats(object):
+    PHASES = ('accept', 'read', 'environ', 'app', 'write', 'close', 'total')
+    COUNTERS = ('connections', 'requests', 'bytes_sent',
+                '1xx', '2xx', '3xx', '4xx', '5xx',
+                'cache_hits', 'cache_misses', 'cache_stores', 'cache_evictions',
+                'compressed', 'compress_cache_hits', 'validator_hits',
+                'static_hits', 'static_misses')
+    BUCKETS = 128
+    # each phase has its buckets, then the total and the max duration (us)
+    PHASE_SIZE = BUCKETS + 2
+    SLOT_SIZE = len(PHASES) * PHASE_SIZE + len(COUNTERS)
 
+    def __init__(self, num_slots=1):
+        self.num_slots = num_slots
+        # 8 bytes (a signed 64 bits integer, 'q') for each number
+        self.memory = mmap.mmap(-1, num_slots * self.SLOT_SIZE * 8)
+        self.values = memoryview(self.memory).cast('q')
+        # the slot of this process (see WSGIServer.spawn_worker)
+        self.slot = 0
+        # the threads of a worker share its slot
+        self.lock = threading.Lock()
+    # index of the bucket of a duration, in microseconds
+    def bucket(self, us):
+        if us < 4:
+            return us
+        exponent = us.bit_length() - 3
+        return min(4 * (exponent + 1) + ((us >> exponent) & 3), self.BUCKETS - 1)
+    # upper bound (in microseconds) of the durations in bucket index
+    def bucket_limit(self, index):
+        if index < 4:
+            return index + 1
+        exponent, mantissa = divmod(index, 4)
+        return (5 + mantissa) << (exponent - 1)
     """
-    constructor, takes the server address as argument
-    [server_address]
-    the given argument is the address to which the internal socket()
-    object will be bound to.
+    records the durations (in seconds) of some phases, given as a
+    dictionary (e.g. {'read': 0.0001, 'app': 0.002}), and adds counts to
+    the counters (e.g. {'requests': 1, 'bytes_sent': 100})
     """
-    def __init__(self, server_address):
-        """
-        Create a listening socket with socket()
-        As specified above, the protocol is IPv4 (by address_family)
-        and the socket type is TCP (by socket_type).
-        The instance socket object is: self.listen_socket.
-        A local (inside the method __init__) variable is also created:
-        listen_socket, whose name can be used later on in this function
-        to access the same socket object (just to avoid to write self.
-        every time)
-        """
-        self.listen_socket = listen_socket = socket.socket(
-            self.address_family,
-            self.socket_type
+    def record(self, durations, counters):
+        values = self.values
+        base = self.slot * self.SLOT_SIZE
+        with self.lock:
+            for phase, seconds in durations.items():
+                start = base + self.PHASES.index(phase) * self.PHASE_SIZE
+                us = int(seconds * 1000000)
+                values[start + self.bucket(us)] += 1
+                values[start + self.BUCKETS] += us
+                if us > values[start + self.BUCKETS + 1]:
+                    values[start + self.BUCKETS + 1] = us
+            start = base + len(self.PHASES) * self.PHASE_SIZE
+            for counter, count in counters.items():
+                values[start + self.COUNTERS.index(counter)] += count
+    """
+    returns the statistics of all the slots together, as a dictionary
+    (times in milliseconds)
+    """
+    def summary(self):
+        values = self.values
+        totals = [0] * self.SLOT_SIZE
+        workers = 0
+        for slot in range(self.num_slots):
+            numbers = values[slot * self.SLOT_SIZE:(slot + 1) * self.SLOT_SIZE]
+            # the workers which served requests (old ones included)
+            if any(numbers):
+                workers += 1
+            for index, value in enumerate(numbers):
+                totals[index] += value
+        # the max durations are not summed
+        for phase in range(len(self.PHASES)):
+            index = phase * self.PHASE_SIZE + self.BUCKETS + 1
+            totals[index] = max(
+                values[slot * self.SLOT_SIZE + index]
+                for slot in range(self.num_slots)
+            )
+        counters = totals[len(self.PHASES) * self.PHASE_SIZE:]
+        result = {'workers': workers}
+        result.update(zip(self.COUNTERS, counters))
+        result['phases'] = phases = {}
+        for phase_num, phase in enumerate(self.PHASES):
+            start = phase_num * self.PHASE_SIZE
+            buckets = totals[start:start + self.BUCKETS]
+            count = sum(buckets)
+            phases[phase] = {
+                'count': count,
+                'mean': round(totals[start + self.BUCKETS] / 1000.0 / count, 3)
+                        if count else 0,
+                'p50': self.percentile(buckets, count, 50),
+                'p90': self.percentile(buckets, count, 90),
+                'p99': self.percentile(buckets, count, 99),
+                'max': totals[start + self.BUCKETS + 1] / 1000.0,
+            }
+        return result
+    # upper bound of the bucket holding the given percentile, in ms
+    def percentile(self, buckets, count, percent):
+        if not count:
+            return 0
+        seen = 0
+        for index, bucket_count in enumerate(buckets):
+            seen += bucket_count
+            if seen * 100 >= count * percent:
+                return self.bucket_limit(index) / 1000.0
+    # the summary as plain text, one line for each phase
+    def format(self, summary):
+        lines = [' '.join(
+            '{0}={1}'.format(name, summary[name])
+            for name in ('workers',) + self.COUNTERS
+        )]
+        lines.append('{0:<8} {1:>9} {2:>9} {3:>9} {4:>9} {5:>9} {6:>9}'.format(
+            'phase', 'count', 'mean ms', 'p50 ms', 'p90 ms', 'p99 ms', 'max ms'))
+        for phase in self.PHASES:
+            numbers = summary['phases'][phase]
+            lines.append(
+                '{0:<8} {count:>9} {mean:>9} {p50:>9} {p90:>9} {p99:>9} '
+                '{max:>9}'.format(phase, **numbers)
+            )
+        return '\n'.join(lines) + '\n'
+    """
+    WSGI application answering STATS_PATH (see
+    WSGIRequestHandler.handle_one_request): the statistics as plain text,
+    or as JSON with the query string 'format=json'
+    """
+    def app(self, environ, start_response):
+        summary = self.summary()
+        if environ['QUERY_STRING'] == 'format=json':
+            body = json.dumps(summary).encode()
+            content_type = 'application/json'
+        else:
+            body = self.format(summary).encode()
+            content_type = 'text/plain'
+        start_response('200 OK', [
+            ('Content-Type', content_type),
+            ('Cache-Control', 'no-store'),
+        ])
+        return [body]
+
+# path of the statistics (see RequestStats.app), when they are enabled
+STATS_PATH = '/__stats'
+
+"""
+sampling profiler, to see where a running server spends its time.
+When started (with SIGUSR1, see WSGIServer.handle_profile, or with a
+request to PROFILE_PATH, see self.app), a background thread looks at the
+stack of the threads serving a request rate times per second, for a
+given number of seconds: the functions that show up most often in the
+samples are the ones taking the most time. Only the threads running the
+app (or sending its response) are sampled: their idents are in
+self.in_app (see WSGIRequestHandler.call_app). The idle ones, waiting in
+accept() or for the next request, would fill the profile with samples
+of a wait. Unlike cProfile, which
+traces every call (and slows everything down a lot), sampling costs the
+same whatever the app does, and nothing at all when it is off.
+sys._current_frames() returns the current frame (the function being
+executed) of each thread; f_back is the frame of its caller, and so on.
+The result is written to a file in the 'collapsed stacks' format, used
+by flame graph tools (e.g. flamegraph.pl, speedscope): one line for each
+different stack, with the functions from the outermost to the innermost
+separated by ';', and the number of samples, e.g.
+serve_forever (webserver2.py:1430);handle_connection (webserver2.py:1480);... 12
+Note that the profiler thread needs the GIL to take a sample: it gets it
+more easily while the other threads are in a system call (e.g. recv,
+sendall), so those tend to show up a bit more than they should.
+"""
+class Profiler(object):
+    # longest profile that can be started with a request (see self.app)
+    max_seconds = 60
+
+    def __init__(self, rate=100, seconds=10, directory='.'):
+        self.rate = rate
+        self.seconds = seconds
+        self.directory = directory
+        self.thread = None
+        # idents of the threads in the app (set.add and discard are atomic)
+        self.in_app = set()
+    # tells if a profile is being taken
+    def running(self):
+        return self.thread is not None and self.thread.is_alive()
+    """
+    starts sampling for seconds (default: self.seconds) in a background
+    thread. Returns the file the profile will be written to, or None if
+    a profile is already being taken.
+    """
+    def start(self, seconds=None):
+        if self.running():
+            return None
+        path = os.path.join(self.directory, 'profile-{pid}-{time}.txt'.format(
+            pid=os.getpid(), time=time.strftime('%Y%m%d-%H%M%S')))
+        self.thread = threading.Thread(
+            target=self.run, args=(seconds or self.seconds, path),
+            name=PROFILER_THREAD, daemon=True,
+        )
+        self.thread.start()
+        return path
+
+    def run(self, seconds, path):
+        counts = {}
+        interval = 1.0 / self.rate
+        end = time.perf_counter() + seconds
+        while time.perf_counter() < end:
+            for ident, frame in sys._current_frames().items():
+                if ident in self.in_app:
+                    stack = self.collapse(frame)
+                    counts[stack] = counts.get(stack, 0) + 1
+            time.sleep(interval)
+        with open(path, 'w') as output:
+            for stack, count in sorted(counts.items()):
+                output.write('{0} {1}\n'.format(stack, count))
+        print('Profile of pid {pid} written to {path}'.format(
+            pid=os.getpid(), path=path), flush=True)
+    # the stack of frame as a line of text, outermost function first
+    def collapse(self, frame):
+        names = []
+        while frame is not None:
+            code = frame.f_code
+            names.append('{0} ({1}:{2})'.format(
+                code.co_name, os.path.basename(code.co_filename),
+                code.co_firstlineno,
+            ))
+            frame = frame.f_back
+        return ';'.join(reversed(names))
+    """
+    WSGI application answering PROFILE_PATH (see
+    WSGIRequestHandler.handle_one_request): starts a profile of the
+    process which got the request, for the number of seconds in the
+    query string (e.g. ?seconds=5, at most self.max_seconds), and answers
+    right away with the name of the file it will be written to
+    """
+    def app(self, environ, start_response):
+        seconds = None
+        for name, _, value in (part.partition('=') for part in
+                               environ['QUERY_STRING'].split('&')):
+            if name == 'seconds' and value.replace('.', '', 1).isdigit():
+                seconds = min(float(value), self.max_seconds)
+        path = self.start(seconds)
+        if path is None:
+            status, body = '409 Conflict', 'already profiling\n'
+        else:
+            status = '202 Accepted'
+            body = 'profiling pid {pid} for {seconds}s: {path}\n'.format(
+                pid=os.getpid(), seconds=seconds or self.seconds, path=path)
+        start_response(status, [('Content-Type', 'text/plain')])
+        return [body.encode()]
+
+# names of the threads of the profiler and of the access log (see AccessLog)
+PROFILER_THREAD = 'profiler'
+ACCESS_LOG_THREAD = 'access-log'
+# path starting a profile (see Profiler.app), when the stats are enabled
+PROFILE_PATH = STATS_PATH + '/profile'
+
+"""
+dictionary with a maximum size in bytes, which forgets the least
+recently used (LRU) entries when it is full. Used by the caches of the
+server (see ResponseCache, Compression).
+The entries are kept in an OrderedDict, in the order of their last use:
+get() moves the entry to the end, and when the total size of the values
+grows beyond max_size, the entries at the beginning (the least recently
+used) are removed. The size of each value is given to put().
+Several threads may use it at the same time: a lock protects it.
+"""
+class LRUCache(object):
+    def __init__(self, max_size):
+        self.max_size = max_size
+        self.entries = OrderedDict()
+        self.size = 0
+        self.lock = threading.Lock()
+    # returns the value of key, or None
+    def get(self, key):
+        with self.lock:
+            entry = self.entries.get(key)
+            if entry is None:
+                return None
+            self.entries.move_to_end(key)
+            return entry[0]
+    """
+    stores value (of size bytes) for key. Returns the number of entries
+    removed to make room for it
+    """
+    def put(self, key, value, size):
+        with self.lock:
+            self.pop(key)
+            self.entries[key] = (value, size)
+            self.size += size
+            evicted = 0
+            while self.size > self.max_size:
+                self.pop(next(iter(self.entries)))
+                evicted += 1
+            return evicted
+
+    def remove(self, key):
+        with self.lock:
+            self.pop(key)
+    # removes all the keys for which predicate(key) is true
+    def remove_if(self, predicate):
+        with self.lock:
+            for key in [key for key in self.entries if predicate(key)]:
+                self.pop(key)
+    # removes key, with self.lock held
+    def pop(self, key):
+        entry = self.entries.pop(key, None)
+        if entry is not None:
+            self.size -= entry[1]
+
+"""
+returns the directives of a Cache-Control header as a dictionary, e.g.
+'public, max-age=60' -> {'public': None, 'max-age': '60'}
+"""
+def parse_cache_control(value):
+    directives = {}
+    for directive in value.split(','):
+        name, _, argument = directive.strip().partition('=')
+        if name:
+            directives[name.lower()] = argument.strip('"') or None
+    return directives
+
+"""
+response cache (--cache-size option): the responses to GET requests are
+kept in memory, ready to be sent, and the next identical requests (GET or
+HEAD) are answered from here, without calling the application at all.
+[what is cached]
+Only the responses which can be shared by all the clients:
+* status 200, with no Set-Cookie header, to requests without an
+  Authorization header
+* not marked 'Cache-Control: no-store', 'private' or 'no-cache' by the app
+* not varying (Vary header) on request headers other than the ones in
+  self.vary, which are part of the key
+* not bigger than self.max_entry_size bytes, and not sent with sendfile
+A response is fresh for the number of seconds of its s-maxage or max-age
+directive, or self.ttl seconds if it has none. A request with
+'Cache-Control: no-cache' (e.g. a forced reload in a browser) skips the
+cache, and its response replaces the cached one.
+The key is the Host header, the path and the query string (the target
+of the request: with virtual hosts, /index.html of two hosts are two
+different pages) and the values of the request headers in self.vary.
+[invalidation]
+A request with an unsafe method (e.g. POST, PUT, DELETE) which
+succeeds may have changed the resource: the entries of its target, for
+all the values of the varied headers, are removed (RFC 7234, section
+4.4, see self.invalidate).
+[what is stored]
+The status line and the headers, already converted to bytes (except
+Date and Connection, which change with each response), and the body.
+An entry is a tuple (status, head, body, expires, created).
+When the total size of the bodies grows beyond max_size, the least
+recently used entries are removed (see LRUCache).
+Each process has its own cache: with several workers, each one fills its
+own (the hits and misses of all of them are counted in the statistics,
+see RequestStats).
+"""
+class ResponseCache(object):
+    def __init__(self, max_size, ttl=60, vary=(), max_entry_size=None):
+        self.max_size = max_size
+        self.ttl = ttl
+        # request headers in the key, as environ keys (e.g. HTTP_ACCEPT)
+        self.vary = tuple(header_key(name) for name in vary)
+        self.vary_names = set(name.lower() for name in vary)
+        self.max_entry_size = max_entry_size or max_size // 8
+        self.entries = LRUCache(max_size)
+    # the target of the request served by handler: the start of its key
+    def target(self, handler):
+        return (handler.request_headers.get('HTTP_HOST'), handler.path,
+                handler.query_string)
+    # the key of the request served by handler
+    def key(self, handler):
+        headers = handler.request_headers
+        return self.target(handler) + tuple(
+            headers.get(name) for name in self.vary
+        )
+    # removes the entries of the target of handler's request
+    def invalidate(self, handler):
+        target = self.target(handler)
+        if not self.vary:
+            self.entries.remove(target)
+        else:
+            self.entries.remove_if(lambda key: key[:3] == target)
+    """
+    returns the entry of the request served by handler, or None (miss)
+    """
+    def get(self, handler):
+        headers = handler.request_headers
+        if 'HTTP_AUTHORIZATION' in headers:
+            return None
+        cache_control = headers.get('HTTP_CACHE_CONTROL')
+        if cache_control and 'no-cache' in parse_cache_control(cache_control):
+            return None
+        key = self.key(handler)
+        entry = self.entries.get(key)
+        if entry is not None and entry[3] < time.time():
+            # expired
+            self.entries.remove(key)
+            return None
+        return entry
+    # (see shared_freshness)
+    def freshness(self, handler):
+        return shared_freshness(handler, self.ttl, self.vary_names)
+    """
+    stores the response of handler, with the given body, fresh for ttl
+    seconds (see self.freshness). Returns the number of entries evicted
+    to make room for it, or None if it was not stored (too big).
+    """
+    def store(self, handler, body, ttl):
+        if len(body) > self.max_entry_size:
+            return None
+        status, response_headers = handler.headers_set
+        header_names = set()
+        lines = ['HTTP/1.1 ', status, '\r\n']
+        for name, value in response_headers:
+            lower_name = name.lower()
+            header_names.add(lower_name)
+            # framing and connection headers are set for each response
+            if lower_name not in HOP_BY_HOP_HEADERS:
+                lines += [name, ': ', value, '\r\n']
+        lines += ['Content-Length: ', str(len(body)), '\r\n']
+        head = ''.join(lines).encode('latin-1')
+        if 'server' not in header_names:
+            head += SERVER_HEADER
+        now = time.time()
+        return self.entries.put(
+            self.key(handler), (status, head, body, now + ttl, now), len(body)
+        )
+
+"""
+tells if the response of handler (whose status and headers have been set
+with start_response) can be shared by all the clients, and for how long
+(see ResponseCache and ConditionalRequests). Returns the number of
+seconds, or None. ttl is the default, when the app gives no max-age, and
+vary_names the lowercase request headers the response may vary on.
+"""
+def shared_freshness(handler, ttl, vary_names):
+    if (handler.request_method != 'GET'
+            or 'HTTP_AUTHORIZATION' in handler.request_headers):
+        return None
+    status, response_headers = handler.headers_set
+    if status[:3] != '200':
+        return None
+    for name, value in response_headers:
+        name = name.lower()
+        if name == 'set-cookie':
+            return None
+        if name == 'vary':
+            varied = set(part.strip().lower() for part in value.split(','))
+            if not varied <= vary_names:
+                return None
+        if name == 'cache-control':
+            directives = parse_cache_control(value)
+            if ('no-store' in directives or 'private' in directives
+                    or 'no-cache' in directives):
+                return None
+            age = directives.get('s-maxage') or directives.get('max-age')
+            if age is not None:
+                try:
+                    ttl = int(age)
+                except ValueError:
+                    return None
+    return ttl if ttl > 0 else None
+
+# methods which don't change the resource: the other ones invalidate
+# its cached responses (see WSGIRequestHandler.invalidate_caches)
+SAFE_METHODS = frozenset(('GET', 'HEAD', 'OPTIONS', 'TRACE'))
+
+# headers of a response which are not stored with it (see ResponseCache)
+HOP_BY_HOP_HEADERS = frozenset((
+    'date', 'connection', 'keep-alive', 'transfer-encoding',
+    'content-length',
+))
+
+# content types compressed by default (see Compression): a type matches
+# if it starts with one of them
+COMPRESSIBLE_TYPES = (
+    'text/', 'application/json', 'application/javascript',
+    'application/xml', 'application/xhtml+xml', 'image/svg+xml',
+)
+
+"""
+compression of the responses (--gzip option). Text compresses very well
+(HTML, CSS, JavaScript, JSON: often to a fifth of its size or less), so
+compressing saves bandwidth and time on slow networks. The client tells
+which compressions it understands with the Accept-Encoding header (e.g.
+'gzip, deflate, br'), and the server says which one it used with the
+Content-Encoding header.
+Only the responses worth it are compressed:
+* with status 200 (or another 2xx, except 204 and 206), and not already
+  compressed by the app (Content-Encoding header)
+* with a content type in self.types (e.g. text/html, application/json),
+  since images and videos are already compressed
+* of at least self.min_size bytes, when their size is known: for a few
+  bytes, the compressed data would be as big as the headers it adds
+* without 'Cache-Control: no-transform'
+The compressed body has a different length: Content-Length is removed
+(or replaced, when the whole body is compressed at once), and
+'Vary: Accept-Encoding' tells the caches that the response depends on
+that request header.
+[streaming]
+A body given as a list is compressed at once (see self.compress_body).
+The pieces of a streamed body (e.g. a generator) are compressed one at a
+time, as they are sent (see WSGIRequestHandler.write): a zlib
+compressobj keeps the state between them, and each piece is flushed
+(Z_SYNC_FLUSH), so that the client can decompress it right away.
+[precompressed cache]
+Compressing takes much more time than sending, and the same responses
+are compressed again and again. The compressed bodies of the responses
+with an ETag (the app says that the same ETag means the same body), or
+whose path starts with one of self.cache_paths (e.g. static files, whose
+body is identified by its size and checksum), are kept in an LRUCache,
+and compressed only once. The key is the whole target (path and query
+string), the encoding, the ETag (or size and checksum), and the values of
+the request headers named by the Vary header of the app: the same ETag
+for two different urls, or for two different values of a varied header
+(e.g. Accept-Language), is not the same body. A response with 'Vary: *'
+is not cached.
+"""
+class Compression(object):
+    # the values of wbits for zlib.compressobj: a gzip header and trailer
+    # for gzip, a zlib header and trailer for deflate (as in HTTP)
+    WBITS = {'gzip': 16 + zlib.MAX_WBITS, 'deflate': zlib.MAX_WBITS}
+
+    def __init__(self, min_size=1024, types=COMPRESSIBLE_TYPES, level=6,
+                 cache_size=0, cache_paths=()):
+        self.min_size = min_size
+        self.types = tuple(types)
+        self.level = level
+        self.cache = LRUCache(cache_size) if cache_size > 0 else None
+        self.cache_paths = tuple(cache_paths)
+    """
+    returns the encoding ('gzip' or 'deflate') to use for the response of
+    handler, whose status and headers have been set with start_response,
+    or None if it must not be compressed. length is the size of the
+    body, if it is known.
+    """
+    def choose(self, handler, length=None):
+        accept = handler.request_headers.get('HTTP_ACCEPT_ENCODING')
+        if not accept or not handler.response_has_body():
+            return None
+        status, response_headers = handler.headers_set
+        if status[:1] != '2' or status[:3] in ('204', '206'):
+            return None
+        content_type = None
+        for name, value in response_headers:
+            name = name.lower()
+            if name == 'content-encoding':
+                return None
+            elif name == 'content-type':
+                content_type = value.split(';')[0].strip().lower()
+            elif name == 'content-length' and length is None:
+                length = int(value)
+            elif (name == 'cache-control'
+                    and 'no-transform' in parse_cache_control(value)):
+                return None
+        if content_type is None or not content_type.startswith(self.types):
+            return None
+        if length is not None and length < self.min_size:
+            return None
+        return self.negotiate(accept)
+    """
+    the encoding to use for the Accept-Encoding header accept: gzip if
+    the client accepts it, otherwise deflate, otherwise None. A 'q=0'
+    parameter means 'not accepted' (e.g. 'gzip;q=0').
+    """
+    def negotiate(self, accept):
+        accepted = set()
+        for part in accept.lower().split(','):
+            coding, _, params = part.partition(';')
+            params = params.replace(' ', '')
+            if params.startswith('q='):
+                try:
+                    q = float(params[2:])
+                except ValueError:
+                    q = 0
+                if q == 0:
+                    continue
+            accepted.add(coding.strip())
+        for encoding in ('gzip', 'deflate'):
+            if encoding in accepted or '*' in accepted:
+                return encoding
+        return None
+    # changes the headers set by the app for a compressed body
+    def set_headers(self, handler, encoding, length=None):
+        response_headers = handler.headers_set[1]
+        vary = 'Accept-Encoding'
+        for header in list(response_headers):
+            name = header[0].lower()
+            if name == 'content-length':
+                response_headers.remove(header)
+            elif name == 'vary':
+                response_headers.remove(header)
+                vary = header[1] + ', ' + vary
+            elif name == 'etag' and not header[1].startswith('W/'):
+                # not the same bytes as the uncompressed body: the ETag
+                # becomes weak (see ConditionalRequests.matches)
+                response_headers.remove(header)
+                response_headers.append(('ETag', 'W/' + header[1]))
+        response_headers.append(('Content-Encoding', encoding))
+        response_headers.append(('Vary', vary))
+        if length is not None:
+            response_headers.append(('Content-Length', str(length)))
+    # a new zlib compressor for encoding
+    def compressobj(self, encoding):
+        return zlib.compressobj(self.level, zlib.DEFLATED, self.WBITS[encoding])
+    """
+    compresses a whole body, if the response of handler must be
+    compressed (see self.choose), and changes its headers. Returns the
+    compressed body, or None if it must not be compressed. The compressed
+    bodies may be found in (or added to) the cache.
+    """
+    def compress_body(self, handler, body):
+        encoding = self.choose(handler, len(body))
+        if encoding is None:
+            return None
+        key = self.cache_key(handler, encoding, body)
+        data = None
+        if key is not None:
+            data = self.cache.get(key)
+            if data is not None:
+                handler.counters['compress_cache_hits'] = 1
+        if data is None:
+            compressor = self.compressobj(encoding)
+            data = compressor.compress(body) + compressor.flush()
+            if key is not None:
+                self.cache.put(key, data, len(data))
+        handler.counters['compressed'] = 1
+        self.set_headers(handler, encoding, len(data))
+        return data
+    # key of the compressed body in the cache, or None if not cached
+    def cache_key(self, handler, encoding, body):
+        if self.cache is None:
+            return None
+        etag = None
+        varied = []
+        for name, value in handler.headers_set[1]:
+            name = name.lower()
+            if name == 'etag':
+                etag = value
+            elif name == 'vary':
+                varied += [part.strip() for part in value.split(',')]
+        if '*' in varied:
+            # varies on something else than the request headers
+            return None
+        headers = handler.request_headers
+        key = (handler.path, handler.query_string, encoding) + tuple(
+            headers.get(header_key(name)) for name in varied if name
+        )
+        if etag is not None:
+            return key + (etag,)
+        if self.cache_paths and handler.path.startswith(self.cache_paths):
+            return key + (len(body), zlib.crc32(body))
+        return None
+
+
+"""
+conditional requests (--etag option, RFC 7232). A client which already
+has a copy of a response sends its validators with the next request:
+* If-None-Match: the ETag of its copy (an opaque tag of that version of
+  the body, e.g. '"1f40-5e2a9c1b"')
+* If-Modified-Since: the Last-Modified date of its copy
+If its copy is still the current one, the answer is '304 Not Modified',
+with no body: the client uses its copy, and the body is not sent again.
+[ETags]
+The ETag (and Last-Modified) headers of the app are used as they are.
+The responses of the app without an ETag, whose body is a list of at most
+self.max_body_size bytes, get one computed by the server: the length and
+the CRC32 checksum of the body (see self.etag). zlib.crc32 is fast (a
+few GB per second), and a change of the body changes the checksum, except
+for an unlikely collision. The body is still produced by the app, but
+not sent.
+[validator cache]
+To skip the app too, the validators of the last response to each
+target (Host, path and query string) are kept in an LRUCache, fresh for
+the s-maxage or max-age of the response, like in ResponseCache (and
+with the same rules: only the responses which can be shared by all the
+clients). A conditional request matching them is answered with 304
+straight away (see self.lookup). A request with 'Cache-Control:
+no-cache' skips them.
+The responses without a max-age are not kept, unless self.ttl is set:
+then they are kept self.ttl seconds. This is off by default, because
+the app can't tell when such a response changes: until the validators
+expire, a client would keep getting 304 for its old copy.
+A successful request with an unsafe method (e.g. POST) removes the
+validators of its target, since it may have changed the resource (see
+self.invalidate).
+"""
+class ConditionalRequests(object):
+    # headers sent with a 304 response (RFC 7232, section 4.1)
+    NOT_MODIFIED_HEADERS = frozenset((
+        'cache-control', 'content-location', 'etag', 'expires',
+        'last-modified', 'vary',
+    ))
+
+    def __init__(self, max_body_size=1024 * 1024, cache_size=10000, ttl=0):
+        self.max_body_size = max_body_size
+        self.ttl = ttl
+        # each entry counts 1: cache_size is a number of paths
+        self.validators = LRUCache(cache_size) if cache_size > 0 else None
+    # the ETag of a body (see the [ETags] section above)
+    def etag(self, body):
+        return '"%x-%08x"' % (len(body), zlib.crc32(body))
+    # the key of the validators of the request served by handler
+    def key(self, handler):
+        return (handler.request_headers.get('HTTP_HOST'), handler.path,
+                handler.query_string)
+    # removes the validators of the target of handler's request
+    def invalidate(self, handler):
+        if self.validators is not None:
+            self.validators.remove(self.key(handler))
+    """
+    returns the 304 headers of the request served by handler, if the
+    validators of the last response to its target are fresh and match the
+    request (see self.matches), or None: the app must be called.
+    """
+    def lookup(self, handler):
+        headers = handler.request_headers
+        if self.validators is None or not (
+                'HTTP_IF_NONE_MATCH' in headers
+                or 'HTTP_IF_MODIFIED_SINCE' in headers):
+            return None
+        if 'HTTP_AUTHORIZATION' in headers:
+            return None
+        cache_control = headers.get('HTTP_CACHE_CONTROL')
+        if cache_control and 'no-cache' in parse_cache_control(cache_control):
+            return None
+        key = self.key(handler)
+        entry = self.validators.get(key)
+        if entry is None:
+            return None
+        etag, last_modified, not_modified_headers, expires = entry
+        if expires < time.time():
+            self.validators.remove(key)
+            return None
+        if not self.matches(handler, etag, last_modified):
+            return None
+        return list(not_modified_headers)
+    """
+    called when the status and the headers of the response of handler
+    are known (set with start_response), before they are sent. body is
+    the whole body, or None if it is streamed. Adds the ETag computed by
+    the server (if any), remembers the validators, and if the request
+    matches them, changes the response to '304 Not Modified' and returns
+    True: then its body must not be sent.
+    """
+    def check(self, handler, body=None):
+        if handler.request_method not in ('GET', 'HEAD'):
+            return False
+        status, response_headers = handler.headers_set
+        if status[:3] != '200':
+            return False
+        etag = last_modified = None
+        for name, value in response_headers:
+            name = name.lower()
+            if name == 'etag':
+                etag = value
+            elif name == 'last-modified':
+                last_modified = value
+        if (etag is None and body is not None
+                and len(body) <= self.max_body_size):
+            etag = self.etag(body)
+            response_headers.append(('ETag', etag))
+        if etag is None and last_modified is None:
+            return False
+        not_modified_headers = [
+            header for header in response_headers
+            if header[0].lower() in self.NOT_MODIFIED_HEADERS
+        ]
+        if self.validators is not None:
+            ttl = shared_freshness(handler, self.ttl, {'accept-encoding'})
+            if ttl is not None:
+                self.validators.put(
+                    self.key(handler),
+                    (etag, last_modified, not_modified_headers,
+                     time.time() + ttl),
+                    1
+                )
+        if not self.matches(handler, etag, last_modified):
+            return False
+        handler.headers_set[:] = ['304 Not Modified', not_modified_headers]
+        return True
+    # (see validators_match)
+    def matches(self, handler, etag, last_modified):
+        return validators_match(handler, etag, last_modified)
+
+"""
+tells if the validators of the request served by handler match etag
+and last_modified (the validators of the current response, or None).
+If-None-Match wins over If-Modified-Since, when both are sent. The ETags
+are compared ignoring the 'W/' prefix of the weak ones (the weak
+comparison of RFC 7232): e.g. a compressed response has the weak ETag of
+its uncompressed body (see Compression.set_headers).
+"""
+def validators_match(handler, etag, last_modified):
+    headers = handler.request_headers
+    if_none_match = headers.get('HTTP_IF_NONE_MATCH')
+    if if_none_match is not None:
+        if etag is None:
+            return False
+        if if_none_match.strip() == '*':
+            return True
+        etag = etag.strip()
+        if etag.startswith('W/'):
+            etag = etag[2:]
+        for tag in if_none_match.split(','):
+            tag = tag.strip()
+            if tag.startswith('W/'):
+                tag = tag[2:]
+            if tag == etag:
+                return True
+        return False
+    if_modified_since = headers.get('HTTP_IF_MODIFIED_SINCE')
+    if if_modified_since is None or last_modified is None:
+        return False
+    """
+    a date which can't be parsed (or is out of range, e.g. the year
+    99999) is ignored, as if the header was not sent (RFC 9110)
+    """
+    try:
+        return (mktime_tz(parsedate_tz(last_modified))
+                <= mktime_tz(parsedate_tz(if_modified_since)))
+    except (ValueError, OverflowError, TypeError):
+        return False
+
+
+"""
+static files (--static option): the files under a directory are served
+at a url prefix (a 'mount'), e.g. --static /static=./assets serves
+./assets/css/site.css at /static/css/site.css. The server answers these
+requests itself: the app is never called, since the only thing a
+framework would do is read the file.
+[cache]
+For each file, the status line and the headers are formatted once, and
+kept in an LRUCache, ready to be sent (like in ResponseCache):
+Content-Type (guessed from the extension), Content-Length, Last-Modified
+and ETag (from the modification time and the size of the file). The
+files of at most self.max_file_size bytes (the many small css, js,
+icons, ...) are kept in the cache too, with their content: the most
+requested ones are always in memory, and are sent with a single send(),
+without touching the disk. The bigger files are sent with os.sendfile
+(see WSGIRequestHandler.sendfile), straight from the page cache of the
+kernel, without being copied into python.
+[invalidation]
+Each request calls os.stat() on the file (a single system call), and the
+cached entry is used only if the inode, the size and the modification
+time (in nanoseconds) of the file are the same as when it was read: a
+file changed or replaced on disk is read again at the next request.
+[conditional requests]
+Every file has an ETag and a Last-Modified date: the requests whose
+If-None-Match or If-Modified-Since match them get '304 Not Modified'
+(see validators_match).
+An entry is a tuple (key, head, headers, body, etag, last_modified),
+where key is (inode, size, mtime) and body is None for the big files.
+"""
+class StaticFiles(object):
+    def __init__(self, mounts, cache_size=64 * 1024 * 1024,
+                 max_file_size=256 * 1024):
+        # (url prefix, directory), the longest prefixes first
+        self.mounts = sorted(
+            ((prefix.rstrip('/'), os.path.abspath(directory))
+             for prefix, directory in mounts),
+            key=lambda mount: len(mount[0]), reverse=True
         )
+        self.max_file_size = max_file_size
+        self.files = LRUCache(cache_size)
+        # reads the system's table of types now (e.g. /etc/mime.types),
+        # and not during the first request
+        mimetypes.init()
+    """
+    returns the path of the file for the url path, '' if it is under a
+    mount but can't be a file in its directory (e.g. with '..'), or None
+    if it is not under a mount (the app serves it).
+    """
+    def find(self, path):
+        for prefix, directory in self.mounts:
+            if path.startswith(prefix + '/'):
+                break
+        else:
+            return None
+        parts = unquote(path[len(prefix) + 1:]).split('/')
+        if '..' in parts or '\0' in parts[-1]:
+            return ''
+        return os.path.join(directory, *parts)
+    """
+    returns the entry of the file file_path, from the cache if the file
+    has not changed since, or None if it is not a regular file. The hit
+    or miss is counted in handler.counters (see RequestStats).
+    """
+    def get(self, handler, file_path):
+        try:
+            file_stat = os.stat(file_path)
+        except (OSError, ValueError):
+            return None
+        if not stat.S_ISREG(file_stat.st_mode):
+            return None
+        entry = self.files.get(file_path)
+        if entry is not None and entry[0] == self.key(file_stat):
+            handler.counters['static_hits'] = 1
+            return entry
+        handler.counters['static_misses'] = 1
+        entry = self.load(file_path)
+        if entry is not None:
+            head, body = entry[1], entry[3]
+            self.files.put(file_path, entry, len(head) + len(body or b''))
+        return entry
+    # what tells that a file has changed (see [invalidation] above)
+    def key(self, file_stat):
+        return file_stat.st_ino, file_stat.st_size, file_stat.st_mtime_ns
+    """
+    reads a file and returns its entry, or None if it can't be read.
+    The file is opened first: os.fstat() describes the file actually
+    read, even if it was replaced in the meantime.
+    """
+    def load(self, file_path):
+        try:
+            with open(file_path, 'rb') as f:
+                file_stat = os.fstat(f.fileno())
+                if not stat.S_ISREG(file_stat.st_mode):
+                    return None
+                size = file_stat.st_size
+                body = None
+                if size <= self.max_file_size:
+                    body = f.read()
+                    size = len(body)
+        except OSError:
+            return None
+        content_type, encoding = mimetypes.guess_type(file_path)
+        if content_type is None or encoding is not None:
+            # e.g. 'x.tar.gz' is sent as it is, not as a compressed tar
+            content_type = 'application/octet-stream'
+        last_modified = formatdate(file_stat.st_mtime, usegmt=True)
+        etag = '"%x-%x"' % (file_stat.st_mtime_ns, size)
+        headers = [
+            ('Content-Type', content_type),
+            ('Content-Length', str(size)),
+            ('Last-Modified', last_modified),
+            ('ETag', etag),
+        ]
+        head = ''.join(
+            ['HTTP/1.1 200 OK\r\n']
+            + [name + ': ' + value + '\r\n' for name, value in headers]
+        ).encode('latin-1') + SERVER_HEADER
+        return self.key(file_stat), head, headers, body, etag, last_modified
+
+
+"""
+the characters of a header name (the 'tchar' of RFC 7230), except '_'.
+In the environ dictionary '-' becomes '_' (see header_key): a header
+'Content_Length' or 'Transfer_Encoding' would have the same key as the
+real one, and a proxy in front of the server, which doesn't know them,
+would pass them on (request smuggling). So they are rejected, as any
+name with other characters (spaces, control characters, ...).
+"""
+HEADER_NAME_CHARS = frozenset(
+    "!#$%&'*+-.^`|~0123456789"
+    'ABCDEFGHIJKLMNOPQRSTUVWXYZabcdefghijklmnopqrstuvwxyz'
+)
+
+"""
+returns the environ key of a request header name, e.g.
+'User-Agent' -> 'HTTP_USER_AGENT', 'Content-Type' -> 'CONTENT_TYPE'
+The same few headers arrive with almost every request, so the keys are
+computed once and kept in the dictionary HEADER_KEYS (which starts with
+the most common ones). sys.intern() makes all the requests share the
+same string object for a key, instead of allocating a new one each time.
+The cache is bounded, so that a client sending random header names can't
+make it grow forever.
+"""
+HEADER_KEYS = {}
+MAX_HEADER_KEYS = 1000
+
+def header_key(name):
+    key = HEADER_KEYS.get(name)
+    if key is None:
+        key = name.upper().replace('-', '_')
+        if key not in ('CONTENT_TYPE', 'CONTENT_LENGTH'):
+            key = 'HTTP_' + key
+        key = sys.intern(key)
+        if len(HEADER_KEYS) < MAX_HEADER_KEYS:
+            HEADER_KEYS[name] = key
+    return key
+
+# common header names, as sent by browsers and tools like curl
+for name in (
+    'Host', 'User-Agent', 'Accept', 'Accept-Encoding', 'Accept-Language',
+    'Connection', 'Content-Type', 'Content-Length', 'Cookie', 'Referer',
+    'Cache-Control', 'Pragma', 'If-None-Match', 'If-Modified-Since',
+    'Authorization', 'Origin', 'Upgrade-Insecure-Requests', 'Range',
+    'X-Forwarded-For', 'X-Forwarded-Proto', 'X-Requested-With',
+    'Sec-Fetch-Site', 'Sec-Fetch-Mode', 'Sec-Fetch-Dest', 'DNT',
+):
+    header_key(name)
+    header_key(name.lower())
+
+"""
+exception raised while reading or parsing a request which is not valid.
+status is the status string of the error response, e.g. '400 Bad Request'
+"""
+class HTTPError(Exception):
+    def __init__(self, status):
+        Exception.__init__(self, status)
+        self.status = status
+
+"""
+exception raised when the connection to the client fails while the
+server reads from it or writes to it (e.g. the client reset it, or
+closed it in the middle of a request). It is a ConnectionError, but
+a ConnectionError raised by the app (e.g. its database refused the
+connection) is not one: that is an error of the app, answered with a
+'500 Internal Server Error' (see WSGIRequestHandler.handle_one_request).
+"""
+class ClientDisconnected(ConnectionError):
+    pass
+
+"""
+wsgi.file_wrapper (see PEP 3333, 'Optional Platform-Specific File
+Handling'). An application that wants to send a file calls
+environ['wsgi.file_wrapper'](filelike, block_size) and returns the result.
+It is a normal iterable, reading the file block by block, so it works
+with any server. But WSGIServer recognises it in finish_response, and if
+the file has a file descriptor (fileno()), it lets the kernel copy the
+file straight to the client socket with os.sendfile, without passing
+the data through python at all.
+"""
+class FileWrapper(object):
+    def __init__(self, filelike, blksize=8192):
+        self.filelike = filelike
+        self.blksize = blksize
+        if hasattr(filelike, 'close'):
+            self.close = filelike.close
+    # iteration: read the file one block at a time
+    def __iter__(self):
+        while True:
+            data = self.filelike.read(self.blksize)
+            if not data:
+                return
+            yield data
+    """
+    returns (fd, offset, size) if the file can be sent with os.sendfile:
+    * fd     : file descriptor of the file
+    * offset : current position in the file. It is where the app left it,
+               e.g. with seek() to answer a Range request
+    * size   : bytes from offset to the end of the file
+    Returns None if the file is not a regular file with a descriptor
+    (e.g. a BytesIO, or a pipe): then it must be iterated.
+    """
+    def sendfile_params(self):
+        try:
+            fd = self.filelike.fileno()
+            offset = self.filelike.tell()
+            file_stat = os.fstat(fd)
+        except (AttributeError, OSError, io.UnsupportedOperation):
+            return None
+        # S_ISREG: regular file (not a pipe, socket, terminal, ...)
+        if not stat.S_ISREG(file_stat.st_mode):
+            return None
+        return fd, offset, max(file_stat.st_size - offset, 0)
+
+"""
+wsgi.input: the body of the request, read from the client socket only
+when (and as much as) the app reads it. The body is never kept as a whole
+in memory: an app can read a big upload piece by piece, and write it to
+a file, with the memory of a single piece. It is a file-like object with
+read(size), readline(size), readlines(hint) and iteration (line by line),
+as PEP 3333 requires.
+The bytes already received (after the head of the request) are in
+handler.read_buffer: they are used first, and the socket is read only
+when it's empty (see self.fill).
+[framing]
+The body ends where the request says:
+* Content-Length: after that number of bytes. self.remaining counts the
+  bytes not read yet, and read() returns b'' (end of file) at 0. The
+  bytes after the body belong to the next request (keep-alive,
+  pipelining), and are left in handler.read_buffer
+* 'Transfer-Encoding: chunked' (length is None): the body is sent in
+  chunks, each one preceded by its size in hex on its own line, and ended
+  by a chunk of size 0, e.g. '5\r\nhello\r\n0\r\n\r\n'. The chunks are
+  decoded as they are read (see self.next_chunk): then self.remaining
+  counts the bytes left in the current chunk
+[100-continue]
+A client sending 'Expect: 100-continue' waits for '100 Continue' before
+sending the body (e.g. curl, for big uploads): it is sent the first time
+the app reads the body, so an app which doesn't read it saves the upload.
+[draining]
+The part of the body that the app did not read must still be read from
+the socket before the next request on the connection: see self.drain.
+"""
+class RequestBody(object):
+    # longest line of the chunked framing (size line or trailer)
+    MAX_LINE = 8192
+    # the only characters of a chunk size (see self.next_chunk)
+    HEX_DIGITS = frozenset(b'0123456789abcdefABCDEF')
+
+    def __init__(self, handler, length=None, expect_continue=False):
+        self.handler = handler
+        self.chunked = length is None
+        # bytes left in the body (or in the current chunk, if chunked)
+        self.remaining = 0 if self.chunked else length
+        # chunked: the size of the first chunk is still to be read, and
+        # the body ends when the last chunk is read
+        self.first_chunk = True
+        self.done = not self.chunked and length == 0
+        self.expect_continue = expect_continue
+    """
+    returns the number of bytes of the body available in the read buffer
+    (at least 1, reading the socket if needed), or 0 at the end of the
+    body.
+    """
+    def fill(self):
+        if self.remaining == 0:
+            if not self.chunked or self.done:
+                self.done = True
+                return 0
+            self.next_chunk()
+            if self.done:
+                return 0
+        buffer = self.handler.read_buffer
+        if not buffer:
+            self.recv()
+        return min(self.remaining, len(buffer))
+    # adds more bytes from the socket to the read buffer
+    def recv(self):
+        if self.expect_continue:
+            self.expect_continue = False
+            self.handler.send(CONTINUE_RESPONSE)
+        data = self.handler.recv()
+        if not data:
+            raise ClientDisconnected('the client closed the connection '
+                                  'in the middle of the request body')
+        self.handler.read_buffer += data
+    # removes n bytes of the body from the read buffer, and returns them
+    def consume(self, n):
+        buffer = self.handler.read_buffer
+        data = bytes(buffer[:n])
+        del buffer[:n]
+        self.remaining -= n
+        return data
+    """
+    reads the line ending at the next CRLF in the read buffer (without
+    the CRLF), for the chunked framing
+    """
+    def read_line(self):
+        buffer = self.handler.read_buffer
+        while True:
+            end = buffer.find(b'\r\n')
+            if end >= 0:
+                line = bytes(buffer[:end])
+                del buffer[:end + 2]
+                return line
+            if len(buffer) > self.MAX_LINE:
+                raise HTTPError('400 Bad Request')
+            self.recv()
+    """
+    reads the size line of the next chunk (after the CRLF ending the data
+    of the previous one). The last chunk (size 0) is followed by optional
+    trailer headers, which are skipped, and an empty line.
+    """
+    def next_chunk(self):
+        if not self.first_chunk and self.read_line():
+            raise HTTPError('400 Bad Request')
+        self.first_chunk = False
+        # the size may be followed by extensions (';name=value'), ignored
+        size = self.read_line().split(b';')[0].rstrip(b' \t')
         """
-        setsockopt(level,optname,value:int/buffer) sets the value for
-        some socket option (the symbolic constants are the ones like
-        socket.SO_*). The value can be an integer, None, or a bytes-like
-        object representing a buffer.
-        [SOL]
-        SOL_ means "socket option level". These symbols are used to set
-        socket options through setsockopt.
-        [SO_REUSEADDR]
-        indicates that the address can be reused. For an AF_INET socket, it
-        means that a socket may bind, except when there is an active listening
-        socket bound to the address.
-        [bind]
-        'socket binding' means assigning an address so it can accept connections
-        on that address.
+        only hex digits: int(size, 16) alone would also accept '0x5',
+        '+5' or '5_0', which a proxy in front of the server may read
+        differently. Then the two would not agree on where the body
+        ends, and the rest could be taken for another request (request
+        smuggling).
         """
-        listen_socket.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
-        # Binds the socket to the address: server_address (argument of
-        # the WSGIServer constructor)
-        listen_socket.bind(server_address)
-        # listen([backlog]) enables the server to accept connections.
-        # the backlog argument specifies the number of unaccepted connections
-        # that the system will allow before refusing new connections.
-        listen_socket.listen(self.request_queue_size)
-        """
-        getsockname() returns the socket's own address. This can be useful
-        to find out the port number of an IP socket. The format of the
-        address returned depends on the address family. In this case,
-        the address family AF_INET is used, which is expressed as a tuple
-        host, port.
-        The slicing at the end is probably to ensure that only two arguments
-        are extracted from getsockname()
-        """
-        host, port = self.listen_socket.getsockname()[:2]
-        """
-        getfqdn() returns a Fully Qualified Domain Name for the argument name
-        in this case, a fully qualified domain is returned for the host
-        string retrieved by getsockname
-        """
-        # saves server name as instance attribute
-        self.server_name = socket.getfqdn(host)
-        # saves port as instance attribute
-        self.server_port = port
-        # Return headers set by Web framework/Web application
-        self.headers_set = []
+        if not size or not self.HEX_DIGITS.issuperset(size):
+            raise HTTPError('400 Bad Request')
+        self.remaining = int(size, 16)
+        if self.remaining == 0:
+            while self.read_line():
+                pass
+            self.done = True
     """
-    WSGI object has an instance object which represents the web application.
-    This is a setter that takes an application, and stores it internally.
+    reads size bytes of the body (less only at its end), or all the rest
+    of the body if size is negative or None
     """
-    def set_app(self, application):
-        self.application = application
+    def read(self, size=-1):
+        if size is None:
+            size = -1
+        parts = []
+        total = 0
+        while size < 0 or total < size:
+            available = self.fill()
+            if not available:
+                break
+            if size >= 0:
+                available = min(available, size - total)
+            parts.append(self.consume(available))
+            total += available
+        return b''.join(parts)
     """
-    starts serving, with an endless loop, doing continuously:
-        self.listen_socket.accept() # accepting connection
-        self.handle_one_request()   # handling a single request
+    reads a line of the body, with its b'\n' (not more than size bytes,
+    if size is given). Returns b'' at the end of the body.
     """
-    def serve_forever(self):
-        # just local name for self.listen_socket (internal socket object member)
-        listen_socket = self.listen_socket
-        # serves until stopped with CTRL+C or similar
+    def readline(self, size=-1):
+        if size is None:
+            size = -1
+        parts = []
+        total = 0
+        while size < 0 or total < size:
+            available = self.fill()
+            if not available:
+                break
+            if size >= 0:
+                available = min(available, size - total)
+            end = self.handler.read_buffer.find(b'\n', 0, available)
+            if end >= 0:
+                parts.append(self.consume(end + 1))
+                break
+            parts.append(self.consume(available))
+            total += available
+        return b''.join(parts)
+    # the lines of the body, until their total size reaches hint
+    def readlines(self, hint=-1):
+        lines = []
+        total = 0
+        for line in self:
+            lines.append(line)
+            total += len(line)
+            if 0 < hint <= total:
+                break
+        return lines
+
+    def __iter__(self):
         while True:
+            line = self.readline()
+            if not line:
+                return
+            yield line
+    """
+    called after the response: reads (and throws away) the rest of the
+    body, so that the next request on the connection starts at the right
+    place. Returns False if the connection must be closed instead:
+    * the client is still waiting for '100 Continue': it may not send the
+      body at all
+    * more than max_size bytes of body are left (with Content-Length):
+      reading a big upload nobody wants costs more than a new connection
+    """
+    def drain(self, max_size):
+        if self.done:
+            return True
+        if self.expect_continue:
+            return False
+        if not self.chunked and self.remaining > max_size:
+            return False
+        buffer = self.handler.read_buffer
+        drained = 0
+        while True:
+            available = self.fill()
+            if not available:
+                return True
+            drained += available
+            if drained > max_size:
+                return False
+            # the bytes are dropped without being copied (see consume)
+            del buffer[:available]
+            self.remaining -= available
+
+"""
+per-connection part of the server. WSGIServer accepts the connections,
+and then creates a WSGIRequestHandler object for each one of them, which
+reads the requests and sends the responses (see WSGIServer.serve_forever).
+All the state of a request (the client socket, the request line, the
+headers set by the app, ...) lives in the handler object, and not in the
+server: so several requests can be served at the same time, each by its
+own handler, in different threads.
+"""
+class WSGIRequestHandler(object):
+    """
+    constructor, takes:
+    * server            : the WSGIServer object, for the configuration
+                          and the application
+    * client_connection : the socket returned by accept()
+    * client_address    : the address of the client
+    """
+    def __init__(self, server, client_connection, client_address):
+        self.server = server
+        self.client_connection = client_connection
+        self.client_address = client_address
+        # bytes received from the client and not used yet. They are kept
+        # from one request to the next one (see self.read_request_head)
+        self.read_buffer = bytearray()
+        # environ variables of the listening socket of the connection (see
+        # WSGIServer.setup_listeners). None: the ones of the server
+        self.base_environ = None
+        # wsgi.input of the current request (see RequestBody)
+        self.input = None
+        # bytes of the responses not sent yet (see self.send)
+        self.send_buffer = bytearray()
+        # True while the whole body of the response is already in memory
+        # (see self.finish_response)
+        self.buffering = False
+        # Return headers set by Web framework/Web application
+        self.headers_set = []
+        self.headers_sent = False
+        # requests served on the connection (see self.handle)
+        self.request_num = 0
+        # for the access log (see self.log_request)
+        self.request_line = '-'
+        self.bytes_sent = 0
+        self.start_time = time.perf_counter()
+        # when the connection was accepted (see WSGIServer.handle_connection)
+        self.accept_time = self.start_time
+        # the body of the response, while it is being sent, if it can be
+        # cached (see self.start_capture)
+        self.capture = None
+        # counts added to the statistics for the request (see
+        # self.record_request), e.g. {'cache_hits': 1}
+        self.counters = {}
+        # whether the response may still be compressed, and the zlib
+        # compressor of a streamed body (see self.start_compression)
+        self.compress = False
+        self.compressor = None
+        # whether the validators of the response are still to be checked,
+        # and whether it became '304 Not Modified' (see self.validate)
+        self.conditional = False
+        self.not_modified = False
+    """
+    method that handles the client connection, called by
+    WSGIServer.serve_forever for each accepted connection.
+    [keep-alive]
+    In HTTP/1.0 the connection was closed after each response, so every
+    request paid for a new TCP handshake. HTTP/1.1 connections are
+    persistent by default: after the response, the client may send
+    another request on the same socket. So we loop over
+    self.handle_one_request until:
+    * the client asks to close (header 'Connection: close', or an
+      HTTP/1.0 request without 'Connection: keep-alive')
+    * the client closes the connection itself
+    * the client stays idle for more than self.server.keepalive_timeout seconds
+    * self.server.max_keepalive_requests requests have been served
+    [pipelining]
+    An HTTP/1.1 client may send several requests without waiting for the
+    responses. They may all arrive with a single recv(): what follows the
+    first request stays in self.read_buffer, and the next request is
+    served from there, without reading the socket again. The responses
+    must be sent in the same order as the requests.
+    The responses are not sent right away, but collected in
+    self.send_buffer (see self.send), and sent all together when the
+    server has nothing else to do than to wait for the client (see
+    self.recv), or when the connection is closed: a batch of pipelined
+    requests is answered with a single sendall().
+    [threads]
+    With threads, an idle connection doesn't keep its thread while it
+    waits for the next request: it is parked (see WSGIServer.park), and
+    handle() is called again, by another thread maybe, when the next
+    request arrives. self.request_num counts the requests across calls.
+    """
+    def handle(self):
+        stats = self.server.stats
+        if stats is not None and self.request_num == 0:
+            stats.record(
+                {'accept': time.perf_counter() - self.accept_time},
+                {'connections': 1},
+            )
+        parked = False
+        try:
+            while self.request_num < self.server.max_keepalive_requests:
+                self.request_num += 1
+                request_num = self.request_num
+                # the last allowed request is answered with
+                # 'Connection: close'
+                # (and so is the last one before a graceful stop, see
+                # WSGIServer.handle_worker_exit)
+                self.close_connection = (
+                    request_num == self.server.max_keepalive_requests
+                    or self.server.stopping
+                )
+                self.handle_one_request()
+                # the next request starts after the body of this one
+                if not self.close_connection and self.input is not None:
+                    try:
+                        if not self.input.drain(self.server.max_drain_size):
+                            self.close_connection = True
+                    except HTTPError:
+                        # malformed body (see RequestBody): the response
+                        # is already on its way, but nothing after it can
+                        # be trusted
+                        self.close_connection = True
+                if self.close_connection or self.server.stopping:
+                    break
+                if self.server.threads > 0 and not self.read_buffer:
+                    # idle: the thread is free until the next request
+                    self.flush()
+                    parked = True
+                    self.server.park(self)
+                    return
+            self.flush()
+        except socket.timeout:
+            # idle for too long: drop the connection
+            pass
+        except ConnectionError:
+            # e.g. the client reset the connection
+            pass
+        except Exception:
             """
-            accept() accepts a connection. The socket must be:
-            * bound to an address (done in __init__ with bind())
-            * listening for connections (done with listen())
-            The returned value is a pair (conn, addr) where conn is a
-            new socket object, usable to send and receive data on the
-            connection, and addr is the address bound to the socket on
-            the other end of the connection
+            a bug of the server itself: only this connection is lost, not
+            the process (or the thread) serving it, with all the others
             """
-            # New client connection
-            self.client_connection, client_address = listen_socket.accept()
-            # Handle one request and close the client connection. Then
-            # loop over to wait for another client connection.
-            # This method makes use of self.client_connection above
-            self.handle_one_request()
+            traceback.print_exc()
+        finally:
+            if not parked:
+                self.close()
+    # closes the connection (see self.handle and WSGIServer.next_job)
+    def close(self):
+        """
+        mark the socket closed. The underlying system resource (e.g.
+        a file descriptor) is also closed when all file objects from
+        makefile() are closed.
+        One this happens, all future operations on the socket will fail.
+        The remote end will receive no more data.
+        """
+        # Closes socket, regardless of the success of the responses
+        close_start = time.perf_counter()
+        self.client_connection.close()
+        if self.server.stats is not None:
+            self.server.stats.record(
+                {'close': time.perf_counter() - close_start}, {}
+            )
+        self.server.busy = False
     """
     custom method that handles one request. This method is called in
-    self.serve_forever endlessly.
+    self.handle, once for each request sent on a connection.
     """
     def handle_one_request(self):
         """
-        socket.recv(bufsize[,flags]) receives data from the socket.
-        It returns a bytes object representing the data received.
-        bufsize specifies the maximum amount of data to be received
-        at once (in this case, 1024 bytes). flags defaults to 0. See
-        Unix man page recv(2) for an explanation.
-        [bytes object]
-        native python object which is an immutable sequence of integers
-        in the range [0,256[
-        """
-        # Receives data by the client_connection socket object returned
-        # by accept() (in self.serve_forever).
-        self.request_data = request_data = self.client_connection.recv(1024)
-        """
-        Print formatted request data a la 'curl -v'.
-        The bytearray object request_data is first converted to str
-        using .decode('utf-8'), then it is split in lines, and they
+        Read the request line and the headers (the 'head' of the request)
+        from the client connection. See self.read_request_head.
+        settimeout() makes recv() raise socket.timeout if nothing
+        arrives for keepalive_timeout seconds (an idle connection).
+        The timeout is removed afterwards, so that sending a big
+        response to a slow client is not interrupted.
+        """
+        self.client_connection.settimeout(self.server.keepalive_timeout)
+        self.input = None
+        self.capture = None
+        self.counters = {}
+        self.compress = self.server.compression is not None
+        self.compressor = None
+        self.conditional = self.server.conditional is not None
+        self.not_modified = False
+        # the fields of the access log line (see self.log_request): a
+        # request rejected before parse_request (e.g. 431) must not be
+        # logged with the request line and size of the previous one
+        self.request_line = '-'
+        self.bytes_sent = 0
+        self.headers_set = []
+        self.headers_sent = False
+        try:
+            self.request_data = request_data = self.read_request_head()
+            # None means that the client closed the connection
+            if request_data is None:
+                self.close_connection = True
+                return
+            self.client_connection.settimeout(None)
+            # a request is in progress: a graceful stop must wait for it
+            self.server.busy = True
+            # call self.parse_request on the data received by the request
+            request_lines = self.parse_request(request_data)
+            # the body (if any) sent along with the request, read by the
+            # app (see RequestBody)
+            self.input = self.read_request_body()
+        except HTTPError as e:
+            # malformed or too big request: answer with an error status
+            # and give up on this connection
+            self.client_connection.settimeout(None)
+            self.close_connection = True
+            self.send_error(e.status)
+            self.log_request(e.status)
+            self.record_request(e.status, {})
+            return
+        # end of each phase of the request, for the statistics (see
+        # RequestStats). time.perf_counter() costs much less than a
+        # request, so the times are taken even if they are not used
+        read_end = time.perf_counter()
+        """
+        In debug mode, print formatted request data a la 'curl -v'.
+        The lines were already split by self.parse_request, and they
         are printed in format (note the '<' for denoting a request):
         < line1
         < line2
         ...
         """
-        print(''.join(
-            '< {line}\n'.format(line=line)
-            for line in request_data.decode('utf-8').splitlines()
-        ))
-        # call self.parse_request on the data received by the request
-        self.parse_request(request_data)
+        if self.server.debug:
+            print(''.join(
+                '< {line}\n'.format(line=line)
+                for line in request_lines
+            ))
+        # the client may ask to close the connection after this request
+        if not self.should_keep_alive():
+            self.close_connection = True
+
+        # nothing has been sent to the client yet
+        self.headers_set = []
+        self.headers_sent = False
+        durations = {}
+        try:
+            """
+            the server may answer by itself (static file, cache, ...):
+            then the request is done. It's inside the try too, so that
+            an error there is answered like an error of the app, and
+            doesn't stop the server
+            """
+            if self.answer_without_app(read_end):
+                return
+            self.call_app(read_end, durations)
+        except ClientDisconnected:
+            # the client went away: nothing more to do
+            raise
+        except HTTPError as e:
+            # the request was malformed (e.g. its body, see RequestBody)
+            self.close_connection = True
+            if not self.headers_sent:
+                self.headers_set = [e.status, []]
+                self.send_error(e.status)
+        except Exception:
+            # an error in the application: print the traceback on the
+            # server side, and tell the client (if it's not too late)
+            traceback.print_exc()
+            self.close_connection = True
+            if not self.headers_sent:
+                self.headers_set = ['500 Internal Server Error', []]
+                self.send_error('500 Internal Server Error')
+        status = self.headers_set[0] if self.headers_set else '-'
+        self.log_request(status)
+        self.record_request(status, durations)
+    """
+    answers the request without calling the app, if the server can: a
+    file of a static mount, a 304 from the cached validators, or a
+    response from the cache. Returns True if the request was answered
+    (and logged). read_end is when the request had been read.
+    """
+    def answer_without_app(self, read_end):
+        # the files of the static mounts are served without the app
+        if self.server.static is not None:
+            status = self.serve_static()
+            if status is not None:
+                self.end_without_app(status, read_end)
+                return True
+
+        # the client's copy may still be valid (see ConditionalRequests)
+        if self.conditional and self.request_method in ('GET', 'HEAD'):
+            not_modified_headers = self.server.conditional.lookup(self)
+            if not_modified_headers is not None:
+                self.counters['validator_hits'] = 1
+                self.headers_set = ['304 Not Modified', not_modified_headers]
+                self.send_headers()
+                self.end_without_app(self.headers_set[0], read_end)
+                return True
 
+        # the response may be in the cache (see ResponseCache)
+        cache = self.server.cache
+        if cache is not None and self.request_method in ('GET', 'HEAD'):
+            entry = cache.get(self)
+            if entry is not None:
+                self.counters['cache_hits'] = 1
+                self.send_cached(entry)
+                self.end_without_app(entry[0], read_end)
+                return True
+            self.counters['cache_misses'] = 1
+        return False
+    """
+    calls the application and sends its response. The durations of the
+    phases are added to durations (see RequestStats).
+    """
+    def call_app(self, read_end, durations):
         # Construct environment dictionary using request data
         # this dictionary contains the data required by the application
         # according to the WSGI specification
         env = self.get_environ()
+        environ_end = time.perf_counter()
 
         """
         It's time to call our application callable and get
@@ -233,8 +1868,24 @@ class WSGIServer(object):
         When called by the server, the application object must return
         an iterable yielding zero or more strings ('result' here).
         """
-        result = self.application(env, self.start_response)
-
+        application = self.server.application
+        if self.server.stats is not None:
+            if self.path == STATS_PATH:
+                application = self.server.stats.app
+            elif self.path == PROFILE_PATH:
+                application = self.server.profiler.app
+        # the profiler samples only the threads in the app (see Profiler)
+        in_app = self.server.profiler.in_app
+        ident = threading.get_ident()
+        in_app.add(ident)
+        try:
+            self.run_app(application, env, read_end, environ_end, durations)
+        finally:
+            in_app.discard(ident)
+    # calls the app and sends its response (see self.call_app)
+    def run_app(self, application, env, read_end, environ_end, durations):
+        result = application(env, self.start_response)
+        app_end = time.perf_counter()
         """
         The server or gateway transmits the yielded strings (by application)
         to the client, in an unbuffered fashion, completing the
@@ -244,51 +1895,289 @@ class WSGIServer(object):
         Calls self.finish_response() by giving as argument the
         result outputted by the web application after giving it
         the environment dictionary and the start_response function.
-        finish_response actually builds the response and prints it in
-        a curl-like format.
+        finish_response actually sends the response, piece by piece,
+        and prints it in a curl-like format.
         """
         self.finish_response(result)
+        write_end = time.perf_counter()
+        if self.request_method not in SAFE_METHODS:
+            self.invalidate_caches()
+        durations.update({
+            'read': read_end - self.start_time,
+            'environ': environ_end - read_end,
+            'app': app_end - environ_end,
+            'write': write_end - app_end,
+            'total': write_end - self.start_time,
+        })
+    """
+    adds the request to the statistics (see RequestStats), if they are
+    enabled: the durations of its phases (a dictionary phase: seconds),
+    its status and the bytes sent
+    """
+    def record_request(self, status, durations):
+        stats = self.server.stats
+        if stats is None:
+            return
+        counters = {'requests': 1, 'bytes_sent': self.bytes_sent}
+        if status[:1] in ('1', '2', '3', '4', '5'):
+            counters[status[0] + 'xx'] = 1
+        counters.update(self.counters)
+        stats.record(durations, counters)
+    """
+    adds the line of the current request to the access log (see
+    AccessLog), if the server has one
+    """
+    def log_request(self, status):
+        access_log = self.server.access_log
+        if access_log is None or not access_log.sampled():
+            return
+        if isinstance(self.client_address, tuple):
+            client = self.client_address[0]
+        else:
+            client = '-'
+        access_log.log('{client} "{request}" {status} {size} {ms:.3f}ms'.format(
+            client=client,
+            request=self.request_line,
+            status=status[:3],
+            size=self.bytes_sent,
+            ms=(time.perf_counter() - self.start_time) * 1000,
+        ))
+    """
+    reads from the client connection until the end of the request head,
+    i.e. the request line and the headers, which end with an empty line
+    (two consecutive '\r\n'). Returns the head as a bytes object (without
+    the final empty line), or None if the client closed the connection.
+    [incremental reading]
+    A single recv(1024) is not enough: the head can be longer than that,
+    or arrive split in several TCP segments. So we keep reading into
+    self.read_buffer (a bytearray, which can grow in place), and we look
+    for the end of the head only in the newly received data (plus the
+    last 3 bytes, in case '\r\n\r\n' was split between two reads).
+    The bytes received after the head (e.g. the request body) are left
+    in self.read_buffer, so they are not lost.
+    If the head grows beyond self.server.max_header_size, the request is rejected
+    with '431 Request Header Fields Too Large' without reading the rest.
+    """
+    def read_request_head(self):
+        buffer = self.read_buffer
+        scan_start = 0
+        # the request starts with its first byte (maybe already received,
+        # e.g. with pipelining): from then on, measure how long it takes
+        # to serve it (see self.log_request and RequestStats)
+        self.start_time = time.perf_counter()
+        while True:
+            # empty lines before the request line must be ignored
+            while buffer[:2] == b'\r\n':
+                del buffer[:2]
+            end = buffer.find(b'\r\n\r\n', scan_start)
+            if end >= 0:
+                break
+            if len(buffer) > self.server.max_header_size:
+                raise HTTPError('431 Request Header Fields Too Large')
+            scan_start = max(len(buffer) - 3, 0)
+            if not buffer:
+                # waiting for a new request, with all the responses sent:
+                # nothing is in progress (see WSGIServer.handle_worker_exit)
+                self.flush()
+                self.server.busy = False
+                if (self.request_num > 1 and self.server.threads == 0
+                        and not self.wait_for_next_request()):
+                    return None
+            """
+            socket.recv(bufsize[,flags]) receives data from the socket.
+            It returns a bytes object representing the data received.
+            bufsize specifies the maximum amount of data to be received
+            at once. flags defaults to 0. See Unix man page recv(2) for
+            an explanation.
+            [bytes object]
+            native python object which is an immutable sequence of integers
+            in the range [0,256[
+            """
+            data = self.recv()
+            # an empty bytes object means that the client closed the connection
+            if not data:
+                if buffer:
+                    raise HTTPError('400 Bad Request')
+                return None
+            if not buffer:
+                self.start_time = time.perf_counter()
+                # a new request has begun: a graceful stop must now wait
+                # for it, even if the rest of its head is still to come
+                # (see WSGIServer.handle_worker_exit)
+                self.server.busy = True
+            buffer += data
+        if end > self.server.max_header_size:
+            raise HTTPError('431 Request Header Fields Too Large')
+        head = bytes(buffer[:end])
+        # remove the head and the empty line from the buffer
+        del buffer[:end + 4]
+        return head
+    """
+    waits for the next request on a keep-alive connection, when the
+    process serves one connection at a time (no --threads): an idle client
+    would keep all the others waiting in the listen queue for up to
+    keepalive_timeout seconds. So the wait also ends as soon as another
+    client is waiting to connect. Returns True if the client sent
+    something, False if another client is waiting or the keep-alive
+    timeout expired (then the connection is closed, see
+    self.read_request_head).
+    """
+    def wait_for_next_request(self):
+        with selectors.DefaultSelector() as selector:
+            selector.register(self.client_connection, selectors.EVENT_READ, True)
+            for listen_socket in self.server.listen_sockets:
+                selector.register(listen_socket, selectors.EVENT_READ, False)
+            events = selector.select(self.server.keepalive_timeout)
+        return any(key.data for key, mask in events)
     """
     method called when handling one request (with self.handle_one_request)
-    which takes un-parsed text (bytes object) coming from a recv() call
-    (when receiving data from a client request). This method parses the
-    first line of the request text, and saves various parts into:
+    which takes un-parsed text (bytes object) of the request head, read by
+    self.read_request_head. This method parses the first line of the
+    request text, and saves various parts into:
     * self.request_method : first part. e.g. GET
-    * self.path           : second part, the url. e.g. /hello
+    * self.path           : second part, the url path. e.g. /hello
+    * self.query_string   : the part of the url after '?', e.g. a=1&b=2
     * self.request_version: third part, HTTP version. e.g. HTTP/1.0
+    The following lines are the headers, saved in self.request_headers.
+    Returns the list of lines of the head.
+    Raises HTTPError('400 Bad Request') if the request is malformed.
     """
     def parse_request(self, text):
         """
-        split the line when encountering a newline (e.g. \n, \r
-        \r\n, \v, \f, ...). Then, select only the first line
+        HTTP headers are encoded as ISO-8859-1 (latin-1): every byte is
+        a character, so decoding never fails. The head is decoded only
+        once, and then split on the HTTP newline '\r\n'
         (the resulting splitted lines are strings which do NOT
-        contain newline characters)
-        """
-        request_line = text.decode('utf-8').splitlines()[0]
-        """
-        rstrip([chars]) trims the given string by removing all
-        instances of the given chars at the end (right) of the
-        given string. In this case, we strip the newline '\r\n'.
-        This is useful only if there are many '\r\n' left after
-        the first one, stripped by splitlines().
+        contain newline characters).
         \r is the carriage return character. \n is the newline.
         The pair carriagereturn-newline is needed as a newline
         symbol in a network terminal session (for example when
         using telnet).
         """
-        request_line = request_line.rstrip('\r\n')
+        lines = text.decode('latin-1').split('\r\n')
+        self.request_line = lines[0]
         """
         Break down the request line into components.
         split() splits when it encounters whitespaces
         therefore a line like:
-        GET /hello HTPP/1.1
+        GET /hello?name=joe HTPP/1.1
         is split into:
-        'GET', '/hello', 'HTTP/1.1'
+        'GET', '/hello?name=joe', 'HTTP/1.1'
+        """
+        try:
+            (self.request_method,   # GET
+            target,                 # /hello?name=joe
+            self.request_version    # HTTP/1.1
+            ) = lines[0].split()
+        except ValueError:
+            raise HTTPError('400 Bad Request')
+        if not self.request_version.startswith('HTTP/'):
+            raise HTTPError('400 Bad Request')
+        # the query string is whatever follows the first '?'
+        self.path, _, self.query_string = target.partition('?')
+        """
+        The following lines are the headers, in the form 'Name: value'.
+        They are stored in the dictionary self.request_headers, already
+        with the names used by the environ dictionary (see CGI spec):
+        the name is uppercased, '-' becomes '_' and 'HTTP_' is prepended.
+        E.g. 'Connection: close' -> {'HTTP_CONNECTION': 'close'}
+        The only exceptions are Content-Type and Content-Length, which
+        become CONTENT_TYPE and CONTENT_LENGTH.
+        A header sent more than once has its values joined by commas.
         """
-        (self.request_method,   # GET
-        self.path,              # /hello
-        self.request_version    # HTTP/1.1
-        ) = request_line.split()
+        self.request_headers = headers = {}
+        key = None
+        for line in lines[1:]:
+            # a line starting with a whitespace continues the previous one
+            # (obsolete 'line folding')
+            if line[:1] in (' ', '\t') and key is not None:
+                headers[key] += ' ' + line.strip()
+                continue
+            name, colon, value = line.partition(':')
+            # (see HEADER_NAME_CHARS)
+            if (not colon or not name
+                    or not HEADER_NAME_CHARS.issuperset(name)):
+                raise HTTPError('400 Bad Request')
+            key = header_key(name)
+            value = value.strip()
+            if key in headers:
+                headers[key] += ',' + value
+            else:
+                headers[key] = value
+        return lines
+    """
+    tells if the connection can be kept open after the current request
+    (see self.handle).
+    * HTTP/1.1: yes, unless the client sent 'Connection: close'
+    * HTTP/1.0: no, unless the client sent 'Connection: keep-alive'
+    The header is a list of options, in any case, e.g.
+    'Keep-Alive, Upgrade' (and a repeated header is joined with commas).
+    """
+    def should_keep_alive(self):
+        options = set(
+            option.strip().lower() for option in
+            self.request_headers.get('HTTP_CONNECTION', '').split(',')
+        )
+        if self.request_version == 'HTTP/1.1':
+            return 'close' not in options
+        return 'keep-alive' in options
+    """
+    reads the request body, whose size is given by the Content-Length
+    header (no header: no body). Part of it may have already been
+    received together with the head, and is waiting in self.read_buffer.
+    Anything after the body belongs to the next request, and stays in
+    self.read_buffer.
+    """
+    def read_request_body(self):
+        headers = self.request_headers
+        expect_continue = (
+            self.request_version == 'HTTP/1.1'
+            and headers.get('HTTP_EXPECT', '').lower() == '100-continue'
+        )
+        transfer_encoding = headers.get('HTTP_TRANSFER_ENCODING')
+        if transfer_encoding is not None:
+            # chunked is the only transfer coding of a request we know
+            if transfer_encoding.strip().lower() != 'chunked':
+                raise HTTPError('501 Not Implemented')
+            if 'CONTENT_LENGTH' in headers:
+                # both framings: the chunked one wins, but the request
+                # may be meant to confuse a proxy in front of us (request
+                # smuggling), so the connection is not reused
+                del headers['CONTENT_LENGTH']
+                self.close_connection = True
+            return RequestBody(self, None, expect_continue)
+        try:
+            length = int(headers.get('CONTENT_LENGTH', 0))
+        except ValueError:
+            raise HTTPError('400 Bad Request')
+        if length < 0:
+            raise HTTPError('400 Bad Request')
+        return RequestBody(self, length, expect_continue and length > 0)
+    """
+    sends a minimal error response with the given status string, e.g.
+    '400 Bad Request', without involving the application.
+    """
+    def send_error(self, status):
+        self.send(self.error_response(status))
+    """
+    returns the bytes of the error response sent by self.send_error
+    """
+    def error_response(self, status):
+        body = status.encode() + b'\n'
+        if self.server.debug:
+            print('> HTTP/1.1 {status}\n'.format(status=status))
+        return b''.join([
+            (
+                'HTTP/1.1 {status}\r\n'
+                'Content-Type: text/plain\r\n'
+                'Content-Length: {length}\r\n'
+            ).format(status=status, length=len(body)).encode('latin-1'),
+            date_header(),
+            SERVER_HEADER,
+            CLOSE_HEADER,
+            b'\r\n',
+            body,
+        ])
     """
     method that creates the environment dictionary (required according
     to WSGI specifications) and returns it. This is used in
@@ -300,8 +2189,15 @@ class WSGIServer(object):
         environ dictionary, required to contain the environment
         variables as defined by the Common Gateway Interface
         specification.
+        Most of the variables are the same for all the requests: they
+        are prepared once, in WSGIServer.setup_environ, and here we start
+        from a copy of them. Copying a dict is much faster than building
+        it again, key by key.
         """
-        env = {}
+        base_environ = self.base_environ
+        if base_environ is None:
+            base_environ = self.server.base_environ
+        env = base_environ.copy()
         """
         The following code snippet does not follow PEP8 conventions
         but it's formatted the way it is for demonstration purposes
@@ -309,24 +2205,19 @@ class WSGIServer(object):
         See https://www.python.org/dev/peps/pep-0333/#environ-variables
         for official WSGI documentation.
         """
-        # Required WSGI variables
-        env['wsgi.version']     = (1,0)
-        env['wsgi.url_scheme']  = 'http'
-        # as input, we use a BytesIO object (buffer-like class)
-        # initialized with the data (bytes object) of the request
-        env['wsgi.input']       = io.BytesIO(self.request_data)
-        # sys.stderr is the file object corresponding to the standard error
-        env['wsgi.errors']      = sys.stderr
-        env['wsgi.multithread'] = False
-        env['wsgi.multiprocess']= False
-        env['wsgi.run_once']    = False
+        # the body of the request, read from the socket by the app
+        # (see RequestBody)
+        env['wsgi.input']       = self.input
         # Required CGI variables
         # (these were extracted by self.parse_request in self.handle_one_request)
         env['REQUEST_METHOD'] = self.request_method     # GET
-        env['PATH_INFO'] = self.path                    # /hello
-        env['SERVER_NAME'] = self.server_name           # localhost
-        # since the request parameters must be strings, we stringify this
-        env['SERVER_PORT'] = str(self.server_port)      # 8888
+        # the path is url-decoded (e.g. %20 -> ' '). As any other environ
+        # string, it must be a latin-1 str (see PEP 3333)
+        env['PATH_INFO'] = unquote(self.path, 'latin-1')  # /hello
+        env['QUERY_STRING'] = self.query_string         # name=joe
+        env['SERVER_PROTOCOL'] = self.request_version   # HTTP/1.1
+        # request headers: HTTP_HOST, HTTP_USER_AGENT, CONTENT_TYPE, ...
+        env.update(self.request_headers)
         return env
     """
     start_response function. This is given as second argument to the
@@ -345,59 +2236,347 @@ class WSGIServer(object):
     parameter: a string to be written as part of the HTTP response body.
     The write callable is provided only to support existing frameworks, and should
     not be used in new applications or frameworks.
-    Here it is used in a simplified manner, just to set server headers,
-    without returning any write callable.
+    Note that start_response does not send anything: the headers are sent
+    together with the first non-empty piece of body (see self.write), so
+    that the app can still change its mind, e.g. in case of an error.
     Official WSGI documentation: https://www.python.org/dev/peps/pep-0333/#the-start-response-callable
     Purpose of start_response: https://stackoverflow.com/questions/16774952/wsgi-whats-the-purpose-of-start-response-function
     """
     def start_response(self, status, response_headers, exc_info=None):
-        # Add necessary server headers
-        server_headers = [
-            ('Date', 'Tue, 31 Mar 2015 12:54:48 GMT'),
-            ('Server', 'WSGIServer 0.2')
-        ]
-        # Stores headers by taking the status (passed to start_response),
-        # the response_headers (passed to start_response by the app) and
-        # the server_headers (built here by hand).
-        self.headers_set = [status, response_headers + server_headers]
+        if exc_info:
+            try:
+                # too late to change the status: the headers are gone
+                # already. Re-raise the app's error, the server will
+                # close the connection.
+                if self.headers_sent:
+                    raise exc_info[1].with_traceback(exc_info[2])
+            finally:
+                # avoid a reference cycle with the traceback
+                exc_info = None
+        # Stores headers by taking the status (passed to start_response)
+        # and a copy of the response_headers (passed to start_response by
+        # the app), since the server may add some headers to it.
+        # The server headers (Date, Server) are added by build_headers.
+        self.headers_set = [status, list(response_headers)]
         # To adhere to WSGI specification the start_response must return
-        # a 'write' callable. For simplicity's sake we'll ignore that detail
-        # for now.
-        # return self.finish_response
+        # a 'write' callable.
+        return self.write
+    """
+    sends the status line and the headers saved by start_response, as
+    bytes, all together (see self.send).
+    [framing of the body]
+    On a persistent connection the client must know where the body ends,
+    since the end of the connection does not mark it. If the app did not
+    set a Content-Length header, the body is sent with
+    'Transfer-Encoding: chunked' (HTTP/1.1 only): each piece of body is
+    preceded by its size (in hex), and an empty piece marks the end. An
+    HTTP/1.0 client doesn't know chunked encoding, so in that case the
+    connection is closed after the body instead.
+    """
+    def send_headers(self):
+        self.send(self.build_headers())
+        self.headers_sent = True
+    """
+    returns the status line and the headers of the response (see
+    self.send_headers) as a bytes object, ready to be sent.
+    """
+    def build_headers(self):
+        # takes status string and all headers saved by start_response
+        # (start_response is called when it is passed to the application)
+        status, response_headers = self.headers_set
+        """
+        status line and headers of the app, one in each line. Note that
+        as newline we use \r\n.
+        They are joined in a single string, and converted to bytes with
+        a single encode(), since sockets work with bytes objects.
+        HTTP headers are latin-1 strings (see PEP 3333).
+        """
+        app_headers = ''.join(
+            ['HTTP/1.1 ', status, '\r\n']
+            + [name + ': ' + value + '\r\n' for name, value in response_headers]
+        ).encode('latin-1')
+        # then the server headers, which are already bytes (see
+        # SERVER_HEADER and date_header at the top of the module)
+        header_names = [name.lower() for name, value in response_headers]
+        parts = [app_headers]
+        if 'date' not in header_names:
+            parts.append(date_header())
+        if 'server' not in header_names:
+            parts.append(SERVER_HEADER)
+        self.chunked = False
+        if self.response_has_body() and 'content-length' not in header_names:
+            if self.request_version == 'HTTP/1.1':
+                parts.append(CHUNKED_HEADER)
+                self.chunked = True
+            else:
+                self.close_connection = True
+        # tell the client whether the connection stays open
+        parts.append(self.connection_header())
+        # empty line: end of the headers
+        parts.append(b'\r\n')
+        response = b''.join(parts)
+        # In debug mode, print formatted response data a la 'curl -v'
+        if self.server.debug:
+            print(''.join(
+                '> {line}\n'.format(line=line)
+                for line in response.decode('latin-1').splitlines()
+            ))
+        return response
+    """
+    tells if the response may have a body: the responses to HEAD requests,
+    and the responses with status 1xx, 204 No Content and 304 Not Modified
+    never have one.
+    """
+    def response_has_body(self):
+        status = self.headers_set[0]
+        return not (
+            self.request_method == 'HEAD'
+            or status[:1] == '1'
+            or status[:3] in ('204', '304')
+        )
+    """
+    the write(body_data) callable returned by start_response. It is also
+    used by self.finish_response to send each piece of body yielded by
+    the app, as soon as it is yielded: the response is streamed to the
+    client, and never kept as a whole in memory.
+    The headers are sent just before the first non-empty piece of body
+    (or at the end, by finish_response, if there is none): until then,
+    the app may still call start_response again with exc_info, to send
+    an error instead (PEP 3333).
+    """
+    def write(self, data):
+        if not self.headers_set:
+            raise AssertionError('write() before start_response()')
+        if not data:
+            return
+        if not self.headers_sent:
+            """
+            the headers and the first piece of body are sent with a single
+            sendall(). With two separate small sends, the second one could
+            wait for the client to acknowledge the first (Nagle's algorithm)
+            while the client delays its acknowledgement (delayed ACK):
+            that would add ~40ms to every response on a keep-alive
+            connection.
+            """
+            if self.conditional:
+                self.validate()
+            if self.compress:
+                self.start_compression()
+            headers = self.build_headers()
+            self.start_capture()
+            if self.response_has_body():
+                headers += self.frame_body(self.encode(data))
+            self.send(headers)
+            self.headers_sent = True
+        elif self.response_has_body():
+            self.send(self.frame_body(self.encode(data)))
+        """
+        a streamed body (e.g. a generator) is sent piece by piece, as the
+        app produces it: the client may be waiting for each piece
+        """
+        if not self.buffering:
+            self.flush()
+    """
+    [conditional requests]
+    checks the validators of the response (see ConditionalRequests.check)
+    before its headers are sent. body is the whole body, if it is known.
+    If the client's copy is still valid, the response becomes '304 Not
+    Modified', without body.
+    """
+    def validate(self, body=None):
+        self.conditional = False
+        self.not_modified = self.server.conditional.check(self, body)
+    """
+    [compression]
+    called before the headers of a streamed body are sent: its length is
+    not known, so if it is compressed (see Compression.choose), each piece
+    is compressed as it is written (see self.encode), and it is sent with
+    chunked encoding.
+    """
+    def start_compression(self):
+        self.compress = False
+        compression = self.server.compression
+        encoding = compression.choose(self)
+        if encoding is not None:
+            compression.set_headers(self, encoding)
+            self.compressor = compression.compressobj(encoding)
+            self.counters['compressed'] = 1
+    """
+    compresses a piece of a streamed body, if it is compressed. zlib keeps
+    the data until it has enough to compress it well: Z_SYNC_FLUSH makes
+    it output everything it has received so far, so that the client gets
+    each piece when the app yields it (a bit less compressed).
+    """
+    def encode(self, data):
+        if self.compressor is None:
+            return data
+        return self.compressor.compress(data) + self.compressor.flush(zlib.Z_SYNC_FLUSH)
+    """
+    returns the bytes to send for a piece of body: the data itself, or
+    a chunk (size in hex, \r\n, data, \r\n) with chunked encoding
+    """
+    def frame_body(self, data):
+        self.bytes_sent += len(data)
+        if self.capture is not None:
+            if self.bytes_sent > self.server.cache.max_entry_size:
+                # too big to be cached
+                self.capture = None
+            else:
+                self.capture.append(data)
+        # In debug mode, print the body data a la 'curl -v'
+        if self.server.debug:
+            print(''.join(
+                '> {line}\n'.format(line=line)
+                for line in data.decode('utf-8', 'replace').splitlines()
+            ))
+        if self.chunked:
+            return b''.join((b'%x\r\n' % len(data), data, b'\r\n'))
+        return data
     """
     function that takes the response ouputted by the application, and
-    processes the answer and prints that, together with all the headers.
+    sends it to the client, one piece at a time, as the app yields them
+    (see self.write).
     This method is invoked at the end of handle_one_request, and the
-    argument 'result' is of bytes type.
+    argument 'result' is an iterable of bytes objects.
     """
     def finish_response(self, result):
-        # if there are problems when sending the response to the
-        # client, this block is skipped
         try:
-            # takes status string and all headers saved by start_response
-            # (start_response is called when it is passed to the application)
-            status, response_headers = self.headers_set
-            # formatted response. Note that as newline we use \r\n
-            response = 'HTTP/1.1 {status}\r\n'.format(status=status)
-            # format all the headers, one in each line.
-            # response_headers is a list of tuples (2 elements each).
-            # to pass the two elements as {0} and {1} arguments in the
-            # formatted string, we unzip the tuple with *
-            for header in response_headers:
-                response += '{0}: {1}\r\n'.format(*header)
-            # newline
-            response += '\r\n'
-            # format response given by the app, by glueing each
-            # string in the list of strings yielded as response
-            # (data is originally bytes, and we convert it to
-            # string with .decode('utf-8'))
-            for data in result:
-                response += data.decode('utf-8')
-            # Print formatted response data a la 'curl -v'
-            print(''.join(
-                '> {line}\n'.format(line=line)
-                for line in response.splitlines()
-            ))
+            if isinstance(result, FileWrapper):
+                params = result.sendfile_params()
+                if params is not None:
+                    if self.conditional:
+                        self.validate()
+                    if self.not_modified:
+                        self.send_headers()
+                    else:
+                        self.sendfile(*params)
+                    return
+            # a list (or tuple) holds the whole body: it can be sent
+            # together with the next responses (see self.send)
+            self.buffering = isinstance(result, (list, tuple))
+            pieces = result
+            if (self.buffering and not self.headers_sent
+                    and (self.conditional or self.compress)):
+                """
+                the whole body is here: its ETag can be computed from it
+                (see self.validate), and it can be compressed at once (or
+                taken from the cache of compressed bodies), and sent with
+                its Content-Length
+                """
+                body = b''.join(result)
+                pieces = [body]
+                if self.conditional:
+                    self.validate(body)
+                if self.not_modified:
+                    pieces = []
+                elif self.compress:
+                    self.compress = False
+                    compressed = self.server.compression.compress_body(
+                        self, body
+                    )
+                    if compressed is not None:
+                        pieces = [compressed]
+            # the most common response is a list with the whole body in a
+            # single bytes object (e.g. wsgiapp.py): then we know the
+            # Content-Length, and we don't need chunked encoding
+            if (self.buffering and len(pieces) == 1
+                    and not self.headers_sent):
+                self.set_default_header('Content-Length', str(len(pieces[0])))
+            for data in pieces:
+                self.write(data)
+                if self.not_modified:
+                    # no body: the rest of a stream is not needed
+                    break
+            if self.compressor is not None:
+                # the end of the compressed stream (and the gzip trailer)
+                self.send(self.frame_body(self.compressor.flush()))
+                self.compressor = None
+            if not self.headers_sent:
+                # empty body: the headers are still to be sent
+                if self.response_has_body():
+                    self.set_default_header('Content-Length', '0')
+                self.send_headers()
+                self.start_capture()
+            elif self.chunked:
+                # last, empty chunk
+                self.send(b'0\r\n\r\n')
+            if self.capture is not None:
+                evicted = self.server.cache.store(
+                    self, b''.join(self.capture), self.cache_ttl
+                )
+                if evicted is not None:
+                    self.counters['cache_stores'] = 1
+                    self.counters['cache_evictions'] = evicted
+                self.capture = None
+        finally:
+            self.buffering = False
+            """
+            according to PEP 3333, if the iterable returned by the
+            application has a close() method, the server must call it
+            when the request is done, whether or not it completed
+            normally (e.g. to release resources held by a generator).
+            """
+            if hasattr(result, 'close'):
+                result.close()
+    """
+    sends the response to a FileWrapper (see finish_response) with
+    os.sendfile(out_fd, in_fd, offset, count): the kernel copies count
+    bytes of the file in_fd, starting at offset, to the socket out_fd.
+    The data is never copied into python bytes objects. The body is
+    size bytes long, unless the app set a smaller Content-Length (e.g.
+    for a Range request, where it also seeked to the start of the range).
+    """
+    def sendfile(self, fd, offset, size):
+        size = self.sendfile_size(size)
+        self.send_headers()
+        if not self.response_has_body():
+            return
+        # the headers must reach the socket before the file
+        self.flush()
+        if self.server.debug:
+            print('> [{size} bytes sent with sendfile]\n'.format(size=size))
+        out_fd = self.client_connection.fileno()
+        while size > 0:
+            # sendfile may send less than requested: loop over
+            try:
+                sent = os.sendfile(out_fd, fd, offset, size)
+            except ConnectionError as e:
+                raise ClientDisconnected(*e.args) from e
+            if sent == 0:
+                # the file is shorter than expected: the client would
+                # wait forever for the missing bytes
+                self.close_connection = True
+                break
+            offset += sent
+            size -= sent
+            self.bytes_sent += sent
+    """
+    returns the number of bytes to send from a file with size bytes left,
+    taking into account the Content-Length set by the app (if any), or
+    setting it if the app did not
+    """
+    def sendfile_size(self, size):
+        for name, value in self.headers_set[1]:
+            if name.lower() == 'content-length':
+                return min(size, int(value))
+        self.headers_set[1].append(('Content-Length', str(size)))
+        return size
+    """
+    adds data to the bytes to send to the client, in self.send_buffer.
+    They are sent by self.flush: when the server is about to wait for the
+    client (see self.recv), at the end of the connection (see self.handle),
+    after each piece of a streamed body (see self.write), or when more
+    than self.server.send_buffer_size bytes are waiting.
+    """
+    def send(self, data):
+        self.send_buffer += data
+        if len(self.send_buffer) >= self.server.send_buffer_size:
+            self.flush()
+    """
+    sends all the bytes waiting in self.send_buffer
+    """
+    def flush(self):
+        if self.send_buffer:
             """
             socket.sendall(bytes[,flags]) sends data to the socket.
             The socket must be connected to a remote socket.
@@ -405,22 +2584,902 @@ class WSGIServer(object):
             Unlike send(), this method continues to send data from 'bytes'
             untile either all data has been sent, or an error occurs.
             On error, an exception is raised.
-            Note that the argument (response) must be converted from str
-            back to bytes again, since these mechanisms work with bytes
-            objects. That's why we use encode() on it.
             """
-            self.client_connection.sendall(response.encode())
-        finally:
+            try:
+                self.client_connection.sendall(self.send_buffer)
+            except ConnectionError as e:
+                # (see ClientDisconnected)
+                raise ClientDisconnected(*e.args) from e
+            self.send_buffer.clear()
+    """
+    receives data from the client connection. The responses not sent yet
+    are sent first: the client may be waiting for them before sending
+    anything else.
+    """
+    def recv(self):
+        self.flush()
+        try:
+            return self.client_connection.recv(self.server.recv_size)
+        except ConnectionError as e:
+            raise ClientDisconnected(*e.args) from e
+    """
+    called after the response to an unsafe method (e.g. POST): if it
+    succeeded (2xx or 3xx), the resource may have changed, and the copies
+    of its responses and their validators are removed (see
+    ResponseCache.invalidate, ConditionalRequests.invalidate)
+    """
+    def invalidate_caches(self):
+        if not self.headers_set or self.headers_set[0][:1] not in '23':
+            return
+        if self.server.cache is not None:
+            self.server.cache.invalidate(self)
+        if self.server.conditional is not None:
+            self.server.conditional.invalidate(self)
+    """
+    if the response can be cached (see ResponseCache.freshness), starts
+    keeping a copy of its body (see self.frame_body), which is stored in
+    the cache at the end (see self.finish_response)
+    """
+    def start_capture(self):
+        cache = self.server.cache
+        if cache is not None and self.request_method == 'GET':
+            self.cache_ttl = cache.freshness(self)
+            if self.cache_ttl is not None:
+                self.capture = []
+    """
+    logs and records (see RequestStats) a request answered by the server
+    itself, without calling the app: from a cache, or a static file.
+    read_end is when the request had been read.
+    """
+    def end_without_app(self, status, read_end):
+        write_end = time.perf_counter()
+        self.log_request(status)
+        self.record_request(status, {
+            'read': read_end - self.start_time,
+            'write': write_end - read_end,
+            'total': write_end - self.start_time,
+        })
+    """
+    sends a response from the cache (see ResponseCache): the stored
+    status line, headers and body, with the headers which change at every
+    response
+    """
+    def send_cached(self, entry):
+        status, head, body, expires, created = entry
+        self.headers_set = [status, []]
+        if self.server.debug:
+            print('> [cached response, {size} bytes]\n'.format(size=len(body)))
+        self.send_stored(
+            head + b'Age: %d\r\n' % (time.time() - created), body
+        )
+    """
+    returns the Connection header of the response (or b'' if none is
+    needed), which tells the client whether the connection stays open.
+    A worker told to stop while serving the request (see
+    WSGIServer.handle_worker_exit) closes the connection after it: the
+    client must know it before sending the next request.
+    """
+    def connection_header(self):
+        if self.server.stopping:
+            self.close_connection = True
+        if self.close_connection:
+            return CLOSE_HEADER
+        if self.request_version == 'HTTP/1.0':
+            return KEEP_ALIVE_HEADER
+        return b''
+    """
+    sends a response whose status line and headers are already bytes
+    (head), adding the headers which change at every response, and body
+    (unless the request is HEAD). See send_cached and serve_static.
+    """
+    def send_stored(self, head, body):
+        self.headers_sent = True
+        parts = [head, date_header(), self.connection_header(), b'\r\n']
+        if self.request_method != 'HEAD':
+            parts.append(body)
+            self.bytes_sent = len(body)
+        self.send(b''.join(parts))
+    """
+    [static files]
+    serves the request from a static mount (see StaticFiles), without
+    calling the app. Returns the status of the response, or None if the
+    path is not under a static mount.
+    """
+    def serve_static(self):
+        static = self.server.static
+        file_path = static.find(self.path)
+        if file_path is None:
+            return None
+        if self.request_method not in ('GET', 'HEAD'):
+            return self.send_status(
+                '405 Method Not Allowed', [('Allow', 'GET, HEAD')]
+            )
+        entry = static.get(self, file_path) if file_path else None
+        if entry is None:
+            return self.send_status('404 Not Found')
+        key, head, headers, body, etag, last_modified = entry
+        if validators_match(self, etag, last_modified):
+            self.headers_set = ['304 Not Modified', [
+                ('ETag', etag), ('Last-Modified', last_modified),
+            ]]
+            self.send_headers()
+        elif body is not None:
+            # small file: from memory
+            self.headers_set = ['200 OK', headers]
+            self.send_stored(head, body)
+        else:
+            # big file: sendfile, from the file opened again
+            try:
+                f = open(file_path, 'rb')
+            except OSError:
+                return self.send_status('404 Not Found')
+            with f:
+                self.headers_set = ['200 OK', list(headers)]
+                self.sendfile(f.fileno(), 0, key[1])
+        return self.headers_set[0]
+    """
+    sends a response with a short text body: the status itself. Unlike
+    self.send_error, the connection stays open.
+    """
+    def send_status(self, status, headers=()):
+        body = status.encode() + b'\n'
+        self.headers_set = [status, [
+            ('Content-Type', 'text/plain'),
+            ('Content-Length', str(len(body))),
+        ] + list(headers)]
+        self.send_headers()
+        if self.response_has_body():
+            self.send(body)
+            self.bytes_sent = len(body)
+        return status
+    """
+    adds the header (name, value) to the response headers set by
+    start_response, unless the app already set a header with that name
+    """
+    def set_default_header(self, name, value):
+        response_headers = self.headers_set[1]
+        for header_name, header_value in response_headers:
+            if header_name.lower() == name.lower():
+                return
+        response_headers.append((name, value))
+
+
+# WSGI program class definition
+class WSGIServer(object):
+    """
+    class variables, shared by all instances of WSGIServer class
+    they can still be accessed as self.address_family, self.socket_type,...
+    """
+    # constant representing IPv4, passed as first argument to socket()
+    address_family = socket.AF_INET
+    # constant representing socket type of type TCP
+    socket_type = socket.SOCK_STREAM
+    # parameter for socket.listen([backlog]) which specifies the number of
+    # unaccepted connections that the system will allow before reusing new connections
+    # (with threads or workers, many clients can be waiting at the same time:
+    # see also webserver3g.py)
+    request_queue_size = 1024
+    # HTTP/1.1 persistent connections (keep-alive): number of seconds a
+    # client connection may stay idle, waiting for the next request,
+    # before the server closes it
+    keepalive_timeout = 5
+    # maximum number of requests served on the same client connection
+    # before the server closes it
+    max_keepalive_requests = 100
+    # maximum size in bytes of the request line plus the headers. Bigger
+    # requests are rejected with status 431
+    max_header_size = 65536
+    # maximum number of bytes read from a client connection with one recv()
+    recv_size = 65536
+    # maximum number of bytes of responses kept in the send buffer of a
+    # connection, waiting to be sent together (see WSGIRequestHandler.send)
+    send_buffer_size = 65536
+    # maximum number of bytes of a request body not read by the app which
+    # are read and thrown away to reuse the connection: with more, it is
+    # closed instead (see RequestBody.drain)
+    max_drain_size = 1024 * 1024
+    # class of the objects that handle the client connections
+    handler_class = WSGIRequestHandler
+    # pre-fork mode: a worker which dies before being ready, or less than
+    # min_worker_life seconds after its start, failed to start. It is
+    # respawned after respawn_delay seconds, doubled at each failure in a
+    # row (up to max_respawn_delay), and after max_start_failures of them
+    # the master gives up (see reap_workers)
+    min_worker_life = 1.0
+    respawn_delay = 0.1
+    max_respawn_delay = 10.0
+    max_start_failures = 10
+
+    """
+    constructor, takes the server address as argument
+    [server_address]
+    the given argument is the address to which the internal socket()
+    object will be bound to.
+    """
+    def __init__(self, server_address, listen_sockets=None):
+        """
+        listen_sockets are sockets already bound and listening: e.g.
+        inherited from the previous master process when the server is
+        restarted (see inherited_sockets), or bound to the --bind
+        addresses (see open_listener). If there are none, a socket is
+        bound to server_address, with the protocol of the class
+        (address_family: IPv4, and socket_type: TCP), see bind_socket.
+        """
+        if not listen_sockets:
+            listen_sockets = [bind_socket(
+                self.address_family, server_address, self.request_queue_size,
+                self.socket_type
+            )]
+        # all the connections of all the listening sockets are served by
+        # the same accept loop (see self.accept)
+        self.listen_sockets = listen_sockets
+        self.listen_socket = listen_sockets[0]
+        # the name and port of the first one are the default SERVER_NAME
+        # and SERVER_PORT (see socket_name and self.setup_environ)
+        self.server_name, self.server_port = socket_name(self.listen_socket)
+        # waits on the listening sockets, when there are several (see
+        # self.accept)
+        self.selector = None
+        # True when this server runs inside one of many worker processes
+        # (see self.serve_prefork). Exposed to the app as wsgi.multiprocess
+        self.multiprocess = False
+        # number of threads serving the connections (0: no threads, the
+        # connections are served one at a time by serve_forever itself)
+        self.threads = 0
+        # True when self.threads > 0. Exposed to the app as wsgi.multithread
+        self.multithread = False
+        # where the requests are logged (see AccessLog). None: no log
+        self.access_log = AccessLog(sys.stdout)
+        # debug mode: print every request and response a la 'curl -v'
+        self.debug = False
+        # the application (see self.set_app). In pre-fork mode it may be
+        # None: then each worker imports self.app_path ('module:callable')
+        # by itself, after the fork (see self.spawn_worker)
+        self.application = None
+        self.app_path = None
+        # pids of the live worker processes, only used by the master
+        # process in pre-fork mode. Maps pid -> worker number
+        self.workers = {}
+        # workers of the previous generation, finishing their requests
+        # after a reload (see self.reload_workers)
+        self.old_workers = {}
+        # start time of each worker (time.monotonic), and the ready pipe of
+        # the respawned ones: maps pid -> (start time, fd or None)
+        self.worker_starts = {}
+        # workers which failed to start in a row (see self.reap_workers)
+        self.start_failures = 0
+        # graceful stop of a worker (see self.handle_worker_exit): stopping
+        # is True once it has been asked to stop, busy while it is in the
+        # middle of a request
+        self.stopping = False
+        self.busy = False
+        # the pool of threads, if any (see self.serve_forever)
+        self.executor = None
+        # with threads: the idle keep-alive connections, waiting for their
+        # next request without a thread (see self.park). Maps socket ->
+        # (handler, deadline)
+        self.parked = {}
+        # handlers waiting to be parked by the accept loop
+        self.park_queue = deque()
+        # statistics of the requests (see RequestStats). None: disabled
+        self.stats = None
+        # incremented at each reload (see self.reload_workers)
+        self.generation = 0
+        # sampling profiler, off until started (see Profiler)
+        self.profiler = Profiler()
+        # cache of the responses (see ResponseCache). None: no cache
+        self.cache = None
+        # compression of the responses (see Compression). None: disabled
+        self.compression = None
+        # conditional requests (see ConditionalRequests). None: disabled
+        self.conditional = None
+        # static mounts (see StaticFiles). None: no static files
+        self.static = None
+    """
+    WSGI object has an instance object which represents the web application.
+    This is a setter that takes an application, and stores it internally.
+    """
+    def set_app(self, application):
+        self.application = application
+    """
+    starts serving, with an endless loop, doing continuously:
+        self.listen_socket.accept() # accepting connection
+        self.handle_connection()    # handling the requests of the connection
+    [threads]
+    If self.threads > 0, the connections are not handled here: they are
+    handed over to a pool of self.threads threads, and the loop goes back
+    to accept() right away. An app that spends its time waiting (e.g. for
+    a database) can then serve several requests at the same time, in a
+    single process. Threads are much cheaper than processes, but they all
+    share the same python interpreter: only one of them at a time can run
+    python code (because of the GIL, the Global Interpreter Lock).
+    The pool is bounded: when all the threads are busy, the loop waits
+    for one of them to be free before accepting another connection, and
+    new clients wait in the listen queue of the kernel.
+    A keep-alive connection waiting for its next request does not keep a
+    thread: it is handed back to the loop (see self.park), which waits for
+    new connections and for the next requests of the idle ones with the
+    same selector (see self.next_job). So a few idle clients can't take
+    all the threads, while the new ones wait.
+    """
+    def serve_forever(self):
+        if self.threads > 0:
+            self.multithread = True
             """
-            mark the socket closed. The underlying system resource (e.g.
-            a file descriptor) is also closed when all file objects from
-            makefile() are closed.
-            One this happens, all future operations on the socket will fail.
-            The remote end will receive no more data.
+            ThreadPoolExecutor(max_workers) starts up to max_workers
+            threads, which run the functions given to its submit() method.
+            A semaphore counts the free threads: acquire() takes one (and
+            blocks if there are none left), release() gives it back.
+            The pool is created here, and not in __init__, because the
+            threads would not survive a fork() (see self.serve_prefork).
             """
-            # Closes socket, regardless of the success of the response
-            self.client_connection.close()
-
+            self.executor = ThreadPoolExecutor(max_workers=self.threads)
+            self.free_threads = threading.BoundedSemaphore(self.threads)
+        # same for the thread writing the access log
+        if self.access_log is not None:
+            self.access_log.start()
+        self.setup_environ()
+        self.setup_listeners()
+        # SIGUSR1: take a profile (see self.handle_profile)
+        signal.signal(signal.SIGUSR1, self.handle_profile)
+        # serves until stopped with CTRL+C or similar (or gracefully, see
+        # self.handle_worker_exit)
+        while not self.stopping:
+            if self.threads > 0:
+                self.free_threads.acquire()
+                # a new connection, or the next request of an idle one
+                try:
+                    job = self.next_job()
+                except BaseException:
+                    self.free_threads.release()
+                    self.close_parked()
+                    raise
+                self.executor.submit(*job).add_done_callback(self.release_thread)
+                continue
+            """
+            accept() accepts a connection. The socket must be:
+            * bound to an address (done in __init__ with bind())
+            * listening for connections (done with listen())
+            The returned value is a pair (conn, addr) where conn is a
+            new socket object, usable to send and receive data on the
+            connection, and addr is the address bound to the socket on
+            the other end of the connection
+            """
+            # New client connection, on any of the listening sockets
+            client_connection, client_address, base_environ = self.accept()
+            # Handle all the requests sent on this connection and close
+            # the client connection. Then loop over to wait for another
+            # client connection.
+            self.handle_connection(
+                client_connection, client_address, None, base_environ
+            )
+    """
+    [several listeners]
+    prepares the accept loop (see self.accept). Each listening socket has
+    its own environ variables (SERVER_NAME, SERVER_PORT: see socket_name),
+    since a connection may arrive on any of them.
+    With a single listening socket, accept() just blocks on it, as usual.
+    With several, a selector (epoll) waits until any of them has a
+    connection: they are made non-blocking, since in pre-fork mode all
+    the workers are woken up, and only one of them gets the connection.
+    The selector is created here, in the process which serves (and not in
+    __init__): an epoll object would be shared by the workers after fork.
+    """
+    def setup_listeners(self):
+        self.listeners = {}
+        for listen_socket in self.listen_sockets:
+            if listen_socket is self.listen_socket:
+                environ = self.base_environ
+            else:
+                environ = self.base_environ.copy()
+                server_name, server_port = socket_name(listen_socket)
+                environ['SERVER_NAME'] = server_name
+                environ['SERVER_PORT'] = str(server_port)
+            self.listeners[listen_socket] = environ
+        if len(self.listen_sockets) == 1 and self.threads == 0:
+            self.listen_socket.setblocking(True)
+            return
+        self.selector = selectors.DefaultSelector()
+        for listen_socket, environ in self.listeners.items():
+            listen_socket.setblocking(False)
+            self.selector.register(listen_socket, selectors.EVENT_READ, environ)
+        if self.threads > 0:
+            # wakes up the selector when a connection is parked (see
+            # self.park): the data of its key is None
+            self.wakeup_socket, self.wakeup_writer = socket.socketpair()
+            self.wakeup_socket.setblocking(False)
+            self.wakeup_writer.setblocking(False)
+            self.selector.register(self.wakeup_socket, selectors.EVENT_READ, None)
+    """
+    waits for a new connection on any of the listening sockets (see
+    self.setup_listeners), and returns (connection, client address,
+    environ variables of its listening socket)
+    """
+    def accept(self):
+        if self.selector is None:
+            client_connection, client_address = self.listen_socket.accept()
+            return client_connection, client_address, self.base_environ
+        while True:
+            for key, events in self.selector.select():
+                try:
+                    client_connection, client_address = key.fileobj.accept()
+                except BlockingIOError:
+                    # another worker was faster
+                    continue
+                # the connection must not inherit the non-blocking mode
+                client_connection.setblocking(True)
+                return client_connection, client_address, key.data
+    """
+    with threads: waits until there is something for a thread to do, and
+    returns it as the arguments of executor.submit:
+    * a new connection on one of the listening sockets
+    * the next request on a parked keep-alive connection (see self.park)
+    The parked connections idle for more than keepalive_timeout seconds
+    are closed, as a thread would do (see WSGIRequestHandler.handle).
+    """
+    def next_job(self):
+        while True:
+            while self.park_queue:
+                handler = self.park_queue.popleft()
+                self.parked[handler.client_connection] = (
+                    handler, time.monotonic() + self.keepalive_timeout
+                )
+                self.selector.register(
+                    handler.client_connection, selectors.EVENT_READ, handler
+                )
+            # wake up once a second to close the expired connections
+            timeout = 1.0 if self.parked else None
+            for key, events in self.selector.select(timeout):
+                if key.data is None:
+                    # see self.park: the new handlers are registered above
+                    try:
+                        self.wakeup_socket.recv(4096)
+                    except BlockingIOError:
+                        pass
+                elif key.fileobj in self.listeners:
+                    try:
+                        client_connection, client_address = key.fileobj.accept()
+                    except BlockingIOError:
+                        # another worker was faster
+                        continue
+                    client_connection.setblocking(True)
+                    return (self.handle_connection, client_connection,
+                            client_address, time.perf_counter(), key.data)
+                else:
+                    # the client sent something: its handler goes on
+                    self.selector.unregister(key.fileobj)
+                    del self.parked[key.fileobj]
+                    return (key.data.handle,)
+            now = time.monotonic()
+            for connection, (handler, deadline) in list(self.parked.items()):
+                if deadline < now:
+                    self.selector.unregister(connection)
+                    del self.parked[connection]
+                    handler.close()
+    """
+    called by a thread when its keep-alive connection is idle, waiting
+    for the next request: the accept loop waits for it instead (see
+    self.next_job), and the thread is free for another connection.
+    The selector belongs to the accept loop, so the handler is queued,
+    and the loop woken up to register it.
+    """
+    def park(self, handler):
+        self.park_queue.append(handler)
+        try:
+            self.wakeup_writer.send(b'\0')
+        except BlockingIOError:
+            # the loop has plenty of wake ups pending already
+            pass
+    # closes the parked connections, when the server stops
+    def close_parked(self):
+        for handler, deadline in list(self.parked.values()):
+            handler.close()
+        self.parked = {}
+        while self.park_queue:
+            self.park_queue.popleft().close()
+    """
+    prepares the environ variables that are the same for all the requests
+    (see WSGIRequestHandler.get_environ). It is called when the server
+    starts serving, when its mode (threads, workers) is known.
+    """
+    def setup_environ(self):
+        env = self.base_environ = {}
+        # Required WSGI variables
+        env['wsgi.version']     = (1,0)
+        env['wsgi.url_scheme']  = 'http'
+        # sys.stderr is the file object corresponding to the standard error
+        env['wsgi.errors']      = sys.stderr
+        # True when requests are served by a pool of threads
+        # (see self.serve_forever)
+        env['wsgi.multithread'] = self.multithread
+        # True only in pre-fork mode (see self.serve_prefork)
+        env['wsgi.multiprocess']= self.multiprocess
+        env['wsgi.run_once']    = False
+        # optional: fast file transmission (see FileWrapper)
+        env['wsgi.file_wrapper']= FileWrapper
+        # wsgi.input returns b'' at the end of the body, so the app may
+        # read it even without a Content-Length (a chunked request)
+        env['wsgi.input_terminated'] = True
+        # Required CGI variables
+        env['SCRIPT_NAME'] = ''                         # app mounted at /
+        env['SERVER_NAME'] = self.server_name           # localhost
+        # since the request parameters must be strings, we stringify this
+        env['SERVER_PORT'] = str(self.server_port)      # 8888
+    """
+    handles a client connection, with a new handler object (see
+    WSGIRequestHandler), which holds all the state of its requests.
+    """
+    def handle_connection(self, client_connection, client_address,
+                          accept_time=None, base_environ=None):
+        handler = self.handler_class(self, client_connection, client_address)
+        if accept_time is not None:
+            handler.accept_time = accept_time
+        if base_environ is not None:
+            handler.base_environ = base_environ
+        handler.handle()
+    """
+    called by the thread pool when a connection has been handled, with the
+    concurrent.futures.Future object of the call to self.handle_connection
+    """
+    def release_thread(self, future):
+        self.free_threads.release()
+        # the exceptions raised in the threads are kept in the future
+        # object: print them, as serve_forever would do
+        error = future.exception()
+        if error is not None:
+            traceback.print_exception(type(error), error, error.__traceback__)
+    """
+    pre-fork mode: serve with num_workers long-lived worker processes.
+    The listening socket is bound once, here in the master process (in
+    __init__). Then the master forks num_workers children. Each child
+    inherits a copy of the listening socket and runs the usual
+    self.serve_forever loop, so the kernel hands each new connection to
+    one of the workers blocked in accept().
+    Compared to webserver3c-webserver3g, which fork a new child for every
+    accepted connection, the cost of fork() is paid only once per worker,
+    and not once per request.
+    The master does not serve requests itself: it just waits for workers
+    to die (e.g. crashed, or killed by someone) and forks a new one
+    in their place, so that there are always num_workers of them.
+    [signals]
+    The master waits for signals with sigwaitinfo(), instead of installing
+    handlers for them: the signals in MASTER_SIGNALS are blocked, and
+    sigwaitinfo() returns the next one that arrives, so they are handled
+    one at a time, here in the loop, and never in the middle of something
+    else. (Unlike sigwait(), it returns when a signal with a handler, such
+    as SIGTERM, arrives, so the handler can run.)
+    * SIGCHLD: a child terminated (see self.reap_workers)
+    * SIGHUP : reload the app (see self.reload_workers)
+    * SIGUSR2: restart the server itself (see self.reexec)
+    * SIGUSR1: print the memory used by the workers (see
+               self.print_memory)
+    * SIGTERM: stop (see self.handle_master_exit)
+    """
+    def serve_prefork(self, num_workers):
+        self.multiprocess = True
+        self.num_workers = num_workers
+        # TERM: terminate the workers too and exit
+        signal.signal(signal.SIGTERM, self.handle_master_exit)
+        signal.pthread_sigmask(signal.SIG_BLOCK, MASTER_SIGNALS)
+        try:
+            if not self.start_workers():
+                self.stop_workers()
+                sys.exit('The workers failed to start')
+            # restarted by a previous master (see self.reexec): now that
+            # the workers are ready, the previous master can stop
+            previous = os.environ.pop('WSGISERVER_PREVIOUS_MASTER', None)
+            if previous is not None:
+                os.kill(int(previous), signal.SIGTERM)
+            self.print_memory()
+            while True:
+                signum = signal.sigwaitinfo(MASTER_SIGNALS).si_signo
+                if signum == signal.SIGHUP:
+                    self.reload_workers()
+                elif signum == signal.SIGUSR2:
+                    self.reexec()
+                elif signum == signal.SIGUSR1:
+                    self.print_memory()
+                self.reap_workers()
+        except KeyboardInterrupt:
+            # CTRL+C: the workers get the SIGINT too, but make sure
+            # nobody is left behind
+            self.stop_workers()
+    """
+    forks self.num_workers new workers, and waits until they are ready to
+    serve (they have imported the app). Returns False if any of them
+    failed to start.
+    """
+    def start_workers(self):
+        ready = [self.spawn_worker(worker_num)
+                 for worker_num in range(self.num_workers)]
+        started = True
+        for pid, ready_fd in ready:
+            # b'' (end of file): the worker died before being ready
+            if os.read(ready_fd, 1) != b'1':
+                started = False
+            os.close(ready_fd)
+        return started
+    """
+    collects the children which terminated (without blocking, as in
+    webserver3g), and forks a new worker in place of each dead one.
+    [crash loop]
+    A worker which can't start (e.g. the app raises at import, or a
+    port it needs is taken) would die again right away: respawning it
+    at once would fork hundreds of processes per second. Such a worker
+    died before writing to its ready pipe, or just after its start
+    (see min_worker_life). Then the next one is forked after a delay,
+    doubled at each failure in a row, and after max_start_failures the
+    master stops: nothing can be served. A worker which served for a
+    while resets the count.
+    """
+    def reap_workers(self):
+        while True:
+            try:
+                pid, status = os.waitpid(-1, os.WNOHANG)
+            except ChildProcessError:  # no children at all
+                return
+            if pid == 0:  # no more zombies
+                return
+            if pid in self.old_workers:
+                print('Old worker {num} (pid {pid}) exited'.format(
+                    num=self.old_workers.pop(pid), pid=pid))
+                start, ready_fd = self.worker_starts.pop(pid, (0, None))
+                if ready_fd is not None:
+                    os.close(ready_fd)
+            elif pid in self.workers:
+                worker_num = self.workers.pop(pid)
+                print('Worker {num} (pid {pid}) died with status {status}'
+                      .format(num=worker_num, pid=pid, status=status))
+                start, ready_fd = self.worker_starts.pop(pid, (0, None))
+                ready = time.monotonic() - start >= self.min_worker_life
+                if ready_fd is not None:
+                    # the worker is dead: this never blocks
+                    ready = ready and os.read(ready_fd, 1) == b'1'
+                    os.close(ready_fd)
+                self.start_failures = 0 if ready else self.start_failures + 1
+                if self.start_failures >= self.max_start_failures:
+                    print('The workers failed to start {n} times in a row, '
+                          'stopping'.format(n=self.start_failures))
+                    self.stop_workers()
+                    sys.exit('The workers failed to start')
+                if self.start_failures > 0:
+                    delay = min(
+                        self.respawn_delay * 2 ** (self.start_failures - 1),
+                        self.max_respawn_delay
+                    )
+                    print('Respawning worker {num} in {delay:.1f}s'.format(
+                        num=worker_num, delay=delay))
+                    time.sleep(delay)
+                # don't wait for it to be ready (the others are serving),
+                # but keep the pipe, to know if it started
+                new_pid, ready_fd = self.spawn_worker(worker_num)
+                self.worker_starts[new_pid] = (time.monotonic(), ready_fd)
+    """
+    reload (SIGHUP): deploys a new version of the app without refusing any
+    connection. The listening socket stays open in the master all the
+    time, so new clients wait in its listen queue, and never find it
+    closed. The master:
+    * forks a new generation of workers, which import the app again
+      (the master never imported it, so they read the new code)
+    * when they are all ready, stops the old workers gracefully: they
+      finish the requests in progress, and exit (see handle_worker_exit)
+    If the new workers fail to start (e.g. the new code has a syntax
+    error), they are stopped instead, and the old ones keep serving.
+    """
+    def reload_workers(self):
+        if self.application is not None:
+            # the app was imported before forking (e.g. passed to
+            # make_server): the new workers would get the same old one
+            print('The app was not imported by the workers: restart with '
+                  'SIGUSR2 to reload it')
+            return
+        old_workers, self.workers = self.workers, {}
+        self.generation += 1
+        if self.start_workers():
+            print('Reloaded {0}'.format(self.app_path))
+            stale_workers = old_workers
+        else:
+            print('Reload failed: the new workers did not start')
+            stale_workers, self.workers = self.workers, old_workers
+        self.old_workers.update(stale_workers)
+        self.signal_workers(stale_workers, signal.SIGTERM)
+    """
+    restart (SIGUSR2): replaces the whole server, master included, with a
+    new one running the code on disk now (e.g. a new webserver2.py). The
+    master forks, and the child execs a new python process with the same
+    command line. exec() keeps the open file descriptors that are marked
+    inheritable: the listening sockets are passed to the new server as fd 3
+    (4, ...), with the environment variables LISTEN_FDS and LISTEN_PID (the
+    same protocol used by systemd, see inherited_sockets). When the workers of
+    the new server are ready, it stops this one with SIGTERM.
+    """
+    def reexec(self):
+        pid = os.fork()
+        if pid == 0:  # child: becomes the new master
+            """
+            the sockets go to the fds 3, 4, ... They are first copied
+            above those numbers: otherwise, moving a socket to 3 could
+            close another one which is at 3 already (e.g. inherited)
+            """
+            num_fds = len(self.listen_sockets)
+            copies = [
+                fcntl.fcntl(listen_socket.fileno(), fcntl.F_DUPFD,
+                            LISTEN_FDS_START + num_fds)
+                for listen_socket in self.listen_sockets
+            ]
+            for i, fd in enumerate(copies):
+                os.dup2(fd, LISTEN_FDS_START + i)
+                os.set_inheritable(LISTEN_FDS_START + i, True)
+                os.close(fd)
+            os.environ['LISTEN_FDS'] = str(num_fds)
+            os.environ['LISTEN_PID'] = str(os.getpid())
+            os.environ['WSGISERVER_PREVIOUS_MASTER'] = str(os.getppid())
+            # blocked signals survive exec(): unblock them
+            signal.pthread_sigmask(signal.SIG_UNBLOCK, MASTER_SIGNALS)
+            # orig_argv also has the options of python itself (e.g. -u)
+            argv = getattr(sys, 'orig_argv', None) or [sys.executable] + sys.argv
+            try:
+                os.execv(sys.executable, [sys.executable] + argv[1:])
+            finally:
+                # exec failed: this child must not go on as a master
+                traceback.print_exc()
+                os._exit(1)
+        print('Started a new master (pid {pid})'.format(pid=pid))
+    """
+    forks a worker process. The child runs self.serve_forever and never
+    returns from this method (it exits with os._exit). The parent stores
+    the child pid and returns it, with a file descriptor from which it can
+    read a byte when the worker is ready to serve (or end of file, if the
+    worker died before).
+    [preload and copy-on-write]
+    If the app was imported by the master (--preload), the workers don't
+    import it again: after fork() they share the memory pages of the
+    master, and a page is copied (copy-on-write) only when a process
+    writes to it. Python writes to objects even when it only reads them
+    (reference counts), and the garbage collector writes to all the
+    objects it examines: a collection in a worker would copy most of the
+    pages of the app. gc.freeze() moves all the objects that exist now
+    to a 'permanent generation', which the collector never examines, so
+    their pages stay shared. (The master also disables the collector
+    until then, see __main__, so that it doesn't leave holes in the
+    pages that new objects of the workers would fill.)
+    """
+    def spawn_worker(self, worker_num):
+        ready_fd, ready_write_fd = os.pipe()
+        if self.application is not None:
+            gc.freeze()
+        pid = os.fork()
+        if pid == 0:  # child
+            gc.enable()
+            # the slot of this worker in the statistics (see RequestStats)
+            if self.stats is not None:
+                self.stats.slot = (
+                    worker_num + self.num_workers * (self.generation % 2)
+                )
+            os.close(ready_fd)
+            # the master handlers make no sense in a worker: here TERM
+            # stops the worker gracefully (see handle_worker_exit), and
+            # a reload or restart is the master's business
+            signal.signal(signal.SIGTERM, self.handle_worker_exit)
+            signal.signal(signal.SIGUSR1, self.handle_profile)
+            signal.signal(signal.SIGHUP, signal.SIG_IGN)
+            signal.signal(signal.SIGUSR2, signal.SIG_IGN)
+            signal.pthread_sigmask(signal.SIG_UNBLOCK, MASTER_SIGNALS)
+            status = 0
+            try:
+                if self.application is None:
+                    self.set_app(load_app(self.app_path))
+                try:
+                    os.write(ready_write_fd, b'1')
+                except BrokenPipeError:
+                    # nobody waits for us any more (e.g. the master died)
+                    pass
+                os.close(ready_write_fd)
+                self.serve_forever()
+            except (KeyboardInterrupt, SystemExit):
+                pass
+            except Exception:
+                # print the traceback and die: the master will respawn us
+                traceback.print_exc()
+                status = 1
+            finally:
+                # let the threads finish the requests in progress
+                if self.executor is not None:
+                    self.executor.shutdown(wait=True)
+                # os._exit doesn't run any cleanup: write the last lines
+                if self.access_log is not None:
+                    self.access_log.flush()
+                os._exit(status)
+        else:  # parent
+            os.close(ready_write_fd)
+            self.workers[pid] = worker_num
+            self.worker_starts[pid] = (time.monotonic(), None)
+            print('Started worker {num} (pid {pid})'.format(
+                num=worker_num, pid=pid))
+            return pid, ready_fd
+    """
+    prints the memory used by each worker, read from /proc (Linux only):
+    * RSS: resident set size, all the pages in RAM, including the ones
+      shared with other processes (e.g. the master)
+    * PSS: proportional set size, each shared page counts 1/N if it is
+      shared by N processes. The sum of the PSS of all the processes is
+      the memory they really use together
+    * USS: unique set size, the pages used by this process alone: the
+      memory that another worker would really cost
+    """
+    def print_memory(self):
+        for pid, worker_num in sorted(self.workers.items(), key=lambda item: item[1]):
+            usage = memory_usage(pid)
+            if usage is None:
+                # e.g. the worker just died: the others are still there
+                continue
+            print('Worker {num} (pid {pid}): USS {uss:.1f} MB, PSS {pss:.1f} MB, '
+                  'RSS {rss:.1f} MB'.format(num=worker_num, pid=pid, **usage))
+    """
+    sends the signal signum to the workers (pids) given
+    """
+    def signal_workers(self, workers, signum):
+        for pid in workers:
+            try:
+                os.kill(pid, signum)
+            except OSError:  # already dead
+                pass
+    """
+    sends SIGTERM to all the workers (old ones included), and waits for
+    them to terminate (so that they don't become zombies, see
+    webserver3d.py)
+    """
+    def stop_workers(self):
+        workers = dict(self.old_workers)
+        workers.update(self.workers)
+        self.signal_workers(workers, signal.SIGTERM)
+        for pid in workers:
+            try:
+                os.waitpid(pid, 0)
+            except OSError:
+                pass
+        self.workers = {}
+        self.old_workers = {}
+        for start, ready_fd in self.worker_starts.values():
+            if ready_fd is not None:
+                os.close(ready_fd)
+        self.worker_starts = {}
+    """
+    SIGTERM handler of the worker processes: graceful stop. The worker
+    stops accepting new connections, but finishes the request it is
+    serving (if any), closing the connection after it.
+    While the worker is waiting (in accept(), or for the next request on
+    a keep-alive connection), it exits right away, raising SystemExit
+    from the handler. While it is busy serving a request, the handler
+    just sets self.stopping: the request goes on, its response gets
+    'Connection: close' if its headers are not sent yet (see
+    WSGIRequestHandler.connection_header), and then the loops in
+    WSGIRequestHandler.handle and self.serve_forever end.
+    With threads, the main thread is always just accepting: it stops,
+    and the threads finish their requests (see spawn_worker). A thread
+    waiting for the next request on a keep-alive connection waits at most
+    keepalive_timeout seconds.
+    """
+    def handle_worker_exit(self, signum, frame):
+        self.stopping = True
+        if self.threads > 0 or not self.busy:
+            raise SystemExit(0)
+    """
+    SIGUSR1 handler of the processes serving requests (the workers in
+    pre-fork mode): starts the profiler (see Profiler)
+    """
+    def handle_profile(self, signum, frame):
+        path = self.profiler.start()
+        if path is not None:
+            print('Profiling pid {pid} for {seconds}s: {path}'.format(
+                pid=os.getpid(), seconds=self.profiler.seconds, path=path),
+                flush=True)
+    """
+    SIGTERM handler of the master process
+    """
+    def handle_master_exit(self, signum, frame):
+        self.stop_workers()
+        sys.exit(0)
 """
 host and port used in this program. host is localhost.
 In this way, you can visit the service (when it is running)
@@ -430,6 +3489,196 @@ telnet localhost 8888
 """
 SERVER_ADDRESS = (HOST, PORT) = '', 8888
 
+"""
+signals handled by the master process in pre-fork mode (see
+WSGIServer.serve_prefork)
+"""
+MASTER_SIGNALS = {signal.SIGCHLD, signal.SIGHUP, signal.SIGUSR1, signal.SIGUSR2}
+
+"""
+returns the memory used by the process pid, in MB, as a dictionary with
+the keys 'rss', 'pss' and 'uss' (see WSGIServer.print_memory), or None
+if it can't be read. /proc/<pid>/smaps_rollup has the sums over all
+the memory mappings of the process, in kB.
+"""
+def memory_usage(pid):
+    fields = {}
+    try:
+        with open('/proc/{0}/smaps_rollup'.format(pid)) as smaps:
+            for line in smaps:
+                parts = line.split()
+                if len(parts) == 3 and parts[2] == 'kB':
+                    fields[parts[0].rstrip(':')] = int(parts[1])
+    except OSError:
+        return None
+    return {
+        'rss': fields.get('Rss', 0) / 1024.0,
+        'pss': fields.get('Pss', 0) / 1024.0,
+        'uss': (fields.get('Private_Clean', 0)
+                + fields.get('Private_Dirty', 0)) / 1024.0,
+    }
+
+"""
+imports the application, given as 'module:callable', e.g. wsgiapp:app
+* module   is the name of the module (e.g. if you have an app called
+           pyramidapp.py, module = pyramidapp)
+* callable is the name of the object inside the module which represents
+           the app, usually just the word 'app'
+"""
+def load_app(app_path):
+    # splits nameofthemodule and 'app'
+    module, application = app_path.split(':')
+    # import the module and returns it
+    module = __import__(module)
+    # gets the object 'app' from the imported module
+    return getattr(module, application)
+
+"""
+returns the listening sockets passed by the process which started this
+one (an empty list if there are none). The protocol is the one of
+systemd socket activation: the sockets are the file descriptors from
+LISTEN_FDS_START (3) on, their number is in the environment variable
+LISTEN_FDS, and LISTEN_PID is the pid of the process they are meant for
+(so that they are not taken by another process which just inherited the
+environment).
+WSGIServer.reexec uses it to pass the sockets to a new server, and a
+supervisor (e.g. systemd, with a .socket unit) can bind them itself and
+start the server with them.
+"""
+LISTEN_FDS_START = 3
+
+def inherited_sockets():
+    if os.environ.get('LISTEN_PID') != str(os.getpid()):
+        return []
+    num_fds = int(os.environ.pop('LISTEN_FDS', 0))
+    del os.environ['LISTEN_PID']
+    listen_sockets = []
+    for fd in range(LISTEN_FDS_START, LISTEN_FDS_START + num_fds):
+        # the type and the family of the socket are read from the fd itself
+        listen_socket = socket.socket(fileno=fd)
+        # don't pass it on to any other program (see WSGIServer.reexec)
+        listen_socket.set_inheritable(False)
+        listen_sockets.append(listen_socket)
+    return listen_sockets
+
+"""
+parses an address of the --bind option, and returns (family, address):
+* unix:PATH          -> AF_UNIX, PATH     e.g. unix:/run/app.sock
+* fd://N             -> None, N           a socket already bound and
+                                          listening, with file descriptor N
+* [HOST]:PORT        -> AF_INET6, (HOST, PORT)  e.g. [::]:8888, [::1]:8888
+* HOST:PORT or :PORT -> AF_INET, (HOST, PORT)   e.g. 127.0.0.1:8888
+Raises ValueError if it is not valid. An IPv6 address needs the brackets:
+in '::1:8000' the port can't be told apart from the address.
+"""
+def parse_bind(bind):
+    if bind.startswith('unix:'):
+        return socket.AF_UNIX, bind[len('unix:'):]
+    if bind.startswith('fd://'):
+        return None, int(bind[len('fd://'):])
+    host, colon, port = bind.rpartition(':')
+    if not colon:
+        raise ValueError('missing port in address {0!r}'.format(bind))
+    family = socket.AF_INET
+    if host.startswith('[') and host.endswith(']'):
+        family, host = socket.AF_INET6, host[1:-1]
+    elif ':' in host or '[' in bind:
+        raise ValueError('an IPv6 address must be written as [ADDRESS]:PORT, '
+                         'e.g. [::1]:8888, not {0!r}'.format(bind))
+    if not port.isdigit():
+        raise ValueError('invalid port in address {0!r}'.format(bind))
+    return family, (host, int(port))
+
+"""
+returns a new socket of the given family, bound to address and listening
+(see WSGIServer.__init__)
+"""
+def bind_socket(family, address, backlog, socket_type=socket.SOCK_STREAM):
+    listen_socket = socket.socket(family, socket_type)
+    if family == socket.AF_UNIX:
+        """
+        a unix domain socket is a file: the clients on the same machine
+        (e.g. nginx, as a reverse proxy) connect to its path, without
+        going through the TCP/IP stack. bind() creates the file, and
+        fails if it exists: a socket left by a previous run is removed.
+        Who can connect depends on the permissions of the file (and so
+        on the umask of the server).
+        """
+        try:
+            if stat.S_ISSOCK(os.stat(address).st_mode):
+                os.unlink(address)
+        except FileNotFoundError:
+            pass
+    else:
+        """
+        setsockopt(level,optname,value:int/buffer) sets the value for
+        some socket option (the symbolic constants are the ones like
+        socket.SO_*). The value can be an integer, None, or a bytes-like
+        object representing a buffer.
+        [SOL]
+        SOL_ means "socket option level". These symbols are used to set
+        socket options through setsockopt.
+        [SO_REUSEADDR]
+        indicates that the address can be reused. For an AF_INET socket, it
+        means that a socket may bind, except when there is an active listening
+        socket bound to the address.
+        [bind]
+        'socket binding' means assigning an address so it can accept connections
+        on that address.
+        """
+        listen_socket.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+        if family == socket.AF_INET6:
+            # IPv6 only: an IPv4 socket can be bound to the same port
+            # (e.g. --bind 0.0.0.0:8888 --bind [::]:8888)
+            listen_socket.setsockopt(socket.IPPROTO_IPV6, socket.IPV6_V6ONLY, 1)
+    # Binds the socket to the address
+    listen_socket.bind(address)
+    # listen([backlog]) enables the server to accept connections.
+    # the backlog argument specifies the number of unaccepted connections
+    # that the system will allow before refusing new connections.
+    listen_socket.listen(backlog)
+    return listen_socket
+
+"""
+returns the listening socket for an address of the --bind option (see
+parse_bind): a new one, or the one with the given file descriptor
+"""
+def open_listener(bind, backlog):
+    family, address = parse_bind(bind)
+    if family is None:
+        return socket.socket(fileno=address)
+    return bind_socket(family, address, backlog)
+
+"""
+returns (SERVER_NAME, SERVER_PORT) for the connections of a listening
+socket (see WSGIServer.setup_environ).
+getsockname() returns the socket's own address. The format of the
+address returned depends on the address family: (host, port) for
+AF_INET, (host, port, flowinfo, scope_id) for AF_INET6, hence the [:2].
+getfqdn() returns a Fully Qualified Domain Name for the host.
+A unix domain socket has a path instead: its clients (a reverse proxy)
+send the real host name in the Host header anyway, and the apps use it
+(HTTP_HOST) before SERVER_NAME. For them, the server is localhost, on
+the default port of http.
+"""
+def socket_name(listen_socket):
+    if listen_socket.family == getattr(socket, 'AF_UNIX', None):
+        return 'localhost', 80
+    host, port = listen_socket.getsockname()[:2]
+    return socket.getfqdn(host), port
+
+"""
+the address of a listening socket, as printed when the server starts,
+e.g. 0.0.0.0:8888, [::1]:8888, unix:/run/app.sock
+"""
+def listener_label(listen_socket):
+    address = listen_socket.getsockname()
+    if listen_socket.family == getattr(socket, 'AF_UNIX', None):
+        return 'unix:' + address
+    if listen_socket.family == socket.AF_INET6:
+        return '[{0}]:{1}'.format(*address[:2])
+    return '{0}:{1}'.format(*address[:2])
+
 """
 Function that builds a WSGIServer object (the gateway),
 using the given server_address and the given application.
@@ -437,9 +3686,9 @@ The WSGI is something in between, which lets server and
 application/framework communicate. This is where the
 initialization is done.
 """
-def make_server(server_address, application):
+def make_server(server_address, application, listen_sockets=None):
     # Builds WSGIServer object
-    server = WSGIServer(server_address)
+    server = WSGIServer(server_address, listen_sockets)
     # Sets the application
     server.set_app(application)
     # Return 'server': the WSGIServer object
@@ -458,29 +3707,316 @@ If this file is being imported from another module, __name__ will be
 set to the module's name.
 """
 if __name__ == '__main__':
-    # check that there is at least a command line argument
-    if len(sys.argv) < 2:
-        sys.exit('Provide a WSGI application object as module:callable')
+    """
+    command line arguments:
+    * app       : the app path (see below), mandatory
+    * --bind    : address to listen on (may be repeated): HOST:PORT,
+                  [IPV6]:PORT, unix:PATH or fd://N (see parse_bind).
+                  Default: port 8888 on all the IPv4 interfaces
+    * --workers : number of worker processes (pre-fork mode). With the
+                  default of 0, this process serves the requests by itself
+    * --preload : import the app in the master, before forking the workers
+                  (see WSGIServer.spawn_worker)
+    * --threads : number of threads serving the connections, in each
+                  process. With the default of 0, there are no threads
+    * --keepalive-timeout, --max-requests : limits of the persistent
+                  connections (see WSGIRequestHandler.handle)
+    * --access-log, --access-log-sample : where to write the access log,
+                  and which fraction of the requests to log (see AccessLog)
+    * --debug   : print every request and response a la 'curl -v'
+    * --stats   : collect statistics, served at /__stats (see RequestStats)
+    * --profile-rate, --profile-seconds, --profile-dir : samples per second,
+                  duration and directory of the profiles (see Profiler)
+    * --cache-size, --cache-ttl, --cache-vary : size (MB) of the response
+                  cache (0: no cache), default freshness and request headers
+                  in the key (see ResponseCache)
+    * --gzip    : compress the responses of the types in COMPRESSIBLE_TYPES
+                  for the clients which accept it (see Compression)
+    * --gzip-min-size, --gzip-level : smallest body compressed, and zlib
+                  level (1: fastest .. 9: smallest)
+    * --gzip-cache-size, --gzip-cache-paths : size (MB) of the cache of
+                  compressed bodies, and path prefixes whose bodies are
+                  cached even without an ETag
+    * --etag    : answer '304 Not Modified' to the conditional requests
+                  (If-None-Match, If-Modified-Since), computing an ETag
+                  for the bodies up to --etag-max-size bytes
+    * --etag-cache-size, --etag-cache-ttl : paths whose validators are
+                  kept, to answer 304 without calling the app, and for how
+                  long without a max-age (0: not kept, see
+                  ConditionalRequests)
+    * --static  : serve the files of a directory at a url prefix, without
+                  the app, e.g. --static /static=./assets (may be repeated)
+    * --static-cache-size, --static-max-file-size : size (MB) of the cache
+                  of static files, and biggest file kept in it (bytes)
+    """
+    parser = argparse.ArgumentParser(
+        description='WSGI server for LSBAWS.',
+        formatter_class=argparse.ArgumentDefaultsHelpFormatter,
+    )
+    parser.add_argument(
+        'app',
+        help='WSGI application object as module:callable'
+    )
+    parser.add_argument(
+        '--bind',
+        action='append',
+        default=[],
+        metavar='ADDRESS',
+        help='Address to listen on, may be repeated: HOST:PORT, [IPV6]:PORT, '
+             'unix:PATH or fd://N (default: :8888).'
+    )
+    parser.add_argument(
+        '--workers',
+        type=int,
+        default=0,
+        help='Number of pre-forked worker processes (0: no workers).'
+    )
+    parser.add_argument(
+        '--preload',
+        action='store_true',
+        help='Import the app once in the master process, before forking '
+             'the workers (SIGHUP can not reload it then: use SIGUSR2).'
+    )
+    parser.add_argument(
+        '--threads',
+        type=int,
+        default=0,
+        help='Number of threads per process (0: no threads).'
+    )
+    parser.add_argument(
+        '--keepalive-timeout',
+        type=float,
+        default=WSGIServer.keepalive_timeout,
+        help='Seconds an idle keep-alive connection is kept open.'
+    )
+    parser.add_argument(
+        '--max-requests',
+        type=int,
+        default=WSGIServer.max_keepalive_requests,
+        help='Maximum number of requests served per connection.'
+    )
+    parser.add_argument(
+        '--access-log',
+        default='-',
+        help='Access log file ("-": standard output, "": no access log).'
+    )
+    parser.add_argument(
+        '--access-log-sample',
+        type=float,
+        default=1.0,
+        help='Fraction of the requests written in the access log.'
+    )
+    parser.add_argument(
+        '--debug',
+        action='store_true',
+        help='Print every request and response.'
+    )
+    parser.add_argument(
+        '--stats',
+        action='store_true',
+        help='Collect timing statistics, served at {0}.'.format(STATS_PATH)
+    )
+    parser.add_argument(
+        '--profile-rate',
+        type=float,
+        default=100,
+        help='Stack samples per second taken by the profiler (SIGUSR1).'
+    )
+    parser.add_argument(
+        '--profile-seconds',
+        type=float,
+        default=10,
+        help='Default duration of a profile.'
+    )
+    parser.add_argument(
+        '--profile-dir',
+        default='.',
+        help='Directory where the profiles are written.'
+    )
+    parser.add_argument(
+        '--cache-size',
+        type=float,
+        default=0,
+        help='Megabytes of responses kept in the response cache (0: no cache).'
+    )
+    parser.add_argument(
+        '--cache-ttl',
+        type=float,
+        default=60,
+        help='Seconds a response without max-age is cached.'
+    )
+    parser.add_argument(
+        '--cache-vary',
+        default='',
+        help='Comma separated request headers which are part of the cache '
+             'key (e.g. Accept-Encoding).'
+    )
+    parser.add_argument(
+        '--gzip',
+        action='store_true',
+        help='Compress the responses with gzip (or deflate).'
+    )
+    parser.add_argument(
+        '--gzip-min-size',
+        type=int,
+        default=1024,
+        help='Smallest body (bytes) which is compressed.'
+    )
+    parser.add_argument(
+        '--gzip-level',
+        type=int,
+        default=6,
+        choices=range(1, 10),
+        metavar='1..9',
+        help='Compression level.'
+    )
+    parser.add_argument(
+        '--gzip-cache-size',
+        type=float,
+        default=8,
+        help='Size (MB) of the cache of compressed bodies (0: no cache).'
+    )
+    parser.add_argument(
+        '--gzip-cache-paths',
+        default='',
+        help='Comma separated path prefixes whose compressed bodies are '
+             'cached even without an ETag (e.g. /static/).'
+    )
+    parser.add_argument(
+        '--etag',
+        action='store_true',
+        help='Answer conditional requests with 304 Not Modified.'
+    )
+    parser.add_argument(
+        '--etag-max-size',
+        type=int,
+        default=1024 * 1024,
+        help='Biggest body (bytes) whose ETag is computed by the server.'
+    )
+    parser.add_argument(
+        '--etag-cache-size',
+        type=int,
+        default=10000,
+        help='Number of paths whose validators are cached (0: no cache).'
+    )
+    parser.add_argument(
+        '--etag-cache-ttl',
+        type=int,
+        default=0,
+        help='Seconds the validators are cached, if the app gives no max-age '
+             '(0: they are not cached).'
+    )
+    parser.add_argument(
+        '--static',
+        action='append',
+        default=[],
+        metavar='PREFIX=DIRECTORY',
+        help='Serve the files of DIRECTORY at the url PREFIX, without the app.'
+    )
+    parser.add_argument(
+        '--static-cache-size',
+        type=float,
+        default=64,
+        help='Size (MB) of the in-memory cache of static files.'
+    )
+    parser.add_argument(
+        '--static-max-file-size',
+        type=int,
+        default=256 * 1024,
+        help='Biggest static file (bytes) kept in memory; bigger ones are '
+             'sent with sendfile.'
+    )
+    args = parser.parse_args()
     """
     the first argument (after the executable's name) is the app path
-    in the format NAMEOFAPP:app
-    * NAMEOFAPP is the name of the app (e.g. if you have an app called
-                pyramidapp.py, NAMEOFAPP = pyramidapp)
-    * app is just the word 'app'. Inside the application module, there
-                must be an object called app which represents the app
+    in the format NAMEOFAPP:app (see load_app).
+    In pre-fork mode the app is not imported here, but by each worker
+    (see WSGIServer.spawn_worker): so that the workers can import it
+    again, with the new code, when the server gets SIGHUP. Unless it is
+    preloaded: then it's imported here, once, with the garbage collector
+    disabled (see WSGIServer.spawn_worker).
     """
-    app_path = sys.argv[1]
-    # splits nameofthemodule and 'app'
-    module, application = app_path.split(':')
-    # import the module and returns it
-    module = __import__(module)
-    # gets the object 'app' from the imported module, and
-    # saves a referenece to the app object in 'application'
-    application = getattr(module, application)
-    # builds the WSGI server at localhost
-    httpd = make_server(SERVER_ADDRESS, application)
+    if args.workers > 0 and not args.preload:
+        application = None
+    else:
+        if args.workers > 0:
+            gc.disable()
+        application = load_app(args.app)
+    """
+    builds the WSGI server, listening on:
+    * the sockets passed by the previous server (see WSGIServer.reexec),
+      or by a supervisor (e.g. systemd), if there are any
+    * otherwise the --bind addresses
+    * otherwise SERVER_ADDRESS (port 8888 on all the IPv4 interfaces)
+    """
+    listen_sockets = inherited_sockets()
+    if not listen_sockets:
+        try:
+            listen_sockets = [
+                open_listener(bind, WSGIServer.request_queue_size)
+                for bind in args.bind
+            ]
+        except ValueError as e:
+            parser.error('--bind: {0}'.format(e))
+    httpd = make_server(SERVER_ADDRESS, application, listen_sockets)
+    httpd.app_path = args.app
+    httpd.keepalive_timeout = args.keepalive_timeout
+    httpd.max_keepalive_requests = args.max_requests
+    httpd.threads = args.threads
+    httpd.debug = args.debug
+    httpd.profiler = Profiler(
+        args.profile_rate, args.profile_seconds, args.profile_dir
+    )
+    if args.cache_size > 0:
+        httpd.cache = ResponseCache(
+            int(args.cache_size * 1024 * 1024), args.cache_ttl,
+            [name.strip() for name in args.cache_vary.split(',') if name.strip()],
+        )
+    if args.gzip:
+        httpd.compression = Compression(
+            args.gzip_min_size, level=args.gzip_level,
+            cache_size=int(args.gzip_cache_size * 1024 * 1024),
+            cache_paths=[path.strip() for path in args.gzip_cache_paths.split(',')
+                         if path.strip()],
+        )
+    if args.static:
+        mounts = []
+        for mount in args.static:
+            prefix, equal, directory = mount.partition('=')
+            if not equal or not prefix.startswith('/'):
+                parser.error('--static expects PREFIX=DIRECTORY, e.g. /static=./assets')
+            mounts.append((prefix, directory))
+        httpd.static = StaticFiles(
+            mounts, int(args.static_cache_size * 1024 * 1024),
+            args.static_max_file_size,
+        )
+    if args.etag:
+        httpd.conditional = ConditionalRequests(
+            args.etag_max_size, args.etag_cache_size, args.etag_cache_ttl
+        )
+    if args.stats:
+        # two slots for each worker (see RequestStats)
+        httpd.stats = RequestStats(max(2 * args.workers, 1))
+    if not args.access_log:
+        httpd.access_log = None
+    else:
+        if args.access_log == '-':
+            stream = sys.stdout
+        else:
+            stream = open(args.access_log, 'a')
+        httpd.access_log = AccessLog(stream, args.access_log_sample)
     # print information about the running server
-    print('WSGIServer: Serving HTTP on port {port} ...\n'.format(port=PORT))
+    print('WSGIServer: Serving HTTP on {addresses} ...\n'.format(
+        addresses=', '.join(map(listener_label, httpd.listen_sockets))))
     # start serving, until manually interrupted, waiting for requests
-    # and serving responses by printing them in the terminal
-    httpd.serve_forever()
+    # and serving responses
+    try:
+        if args.workers > 0:
+            httpd.serve_prefork(args.workers)
+        else:
+            httpd.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        if httpd.access_log is not None:
+            httpd.access_log.flush()
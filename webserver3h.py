@@ -0,0 +1,180 @@
+###########################################################################
+# Event-loop server - webserver3h.py                                      #
+#                                                                         #
+# - Single process, no fork, no signals, no zombies                       #
+# - Non-blocking sockets multiplexed with selectors (epoll on Linux)      #
+#                                                                         #
+###########################################################################
+"""
+This server serves the same requests as webserver3g.py, but without
+forking a child for each connection. A single process keeps all the
+connections open at the same time, using non-blocking sockets: recv(),
+send() and accept() never wait, they do whatever can be done right now
+(or raise BlockingIOError if nothing can be done).
+To know which sockets are ready, the server asks the kernel with a
+selector (selectors.DefaultSelector is the most efficient one available:
+epoll on Linux, kqueue on Mac OS X). select() blocks until at least one
+of the registered sockets is ready to be read from (EVENT_READ) or
+written to (EVENT_WRITE), and returns the list of the ready ones.
+Since the work on a connection can stop at any moment (the request may
+arrive in several pieces, the response may not fit in the socket buffer)
+each connection keeps its own state:
+* a read buffer, with the bytes of the request received so far
+* a write buffer, with the bytes of the response not sent yet
+* a state: READING the request, then WRITING the response
+A single process serves everybody: an error with one client (a bug, a
+weird request) must only close that connection, never stop the server.
+And a client can't make its read buffer grow forever: requests whose
+headers don't fit in MAX_HEADER_SIZE bytes get a 431 response.
+Compare its speed with webserver3g.py, using client3.py, to see the cost
+of forking a process per connection.
+"""
+import selectors
+import socket
+import traceback
+
+SERVER_ADDRESS = (HOST, PORT) = '', 8888
+REQUEST_QUEUE_SIZE = 1024
+# maximum size of the request line plus the headers
+MAX_HEADER_SIZE = 65536
+
+# states of a connection
+READING = 'reading'
+WRITING = 'writing'
+
+# the response sent to every request (same as webserver3g.py)
+HTTP_RESPONSE = b"""\
+HTTP/1.1 200 OK
+
+Hello, World!
+"""
+
+# the response to requests with too big headers
+HTTP_TOO_LARGE = b"""\
+HTTP/1.1 431 Request Header Fields Too Large
+Connection: close
+
+"""
+
+
+class Connection(object):
+    """
+    state of a client connection
+    """
+    def __init__(self, client_connection):
+        self.client_connection = client_connection
+        self.state = READING
+        self.read_buffer = bytearray()
+        self.write_buffer = b''
+
+
+def accept(selector, listen_socket):
+    # accept all the connections waiting in the listen queue
+    while True:
+        try:
+            client_connection, client_address = listen_socket.accept()
+        except BlockingIOError:
+            return
+        client_connection.setblocking(False)
+        # wait for the request
+        selector.register(
+            client_connection,
+            selectors.EVENT_READ,
+            Connection(client_connection),
+        )
+
+
+def handle_read(selector, connection):
+    try:
+        data = connection.client_connection.recv(1024)
+    except BlockingIOError:
+        return
+    except ConnectionError:
+        close(selector, connection)
+        return
+    if not data:
+        # the client closed the connection
+        close(selector, connection)
+        return
+    connection.read_buffer += data
+    # the request is complete when the empty line after the headers
+    # has arrived (webserver3g.py just uses the first recv()). Only the
+    # new bytes are searched (plus the last 3 of before, in case the
+    # empty line was split between two recv()): searching the whole
+    # buffer again at each recv() would take quadratic time
+    start = max(len(connection.read_buffer) - len(data) - 3, 0)
+    if connection.read_buffer.find(b'\r\n\r\n', start) < 0:
+        if len(connection.read_buffer) > MAX_HEADER_SIZE:
+            respond(selector, connection, HTTP_TOO_LARGE)
+        return
+    # the request is bytes sent by anybody: not necessarily valid UTF-8
+    print(connection.read_buffer.decode(errors='replace'))
+    respond(selector, connection, HTTP_RESPONSE)
+
+
+def respond(selector, connection, response):
+    # switch state: from now on, wait for the socket to be writable
+    connection.state = WRITING
+    connection.write_buffer = response
+    selector.modify(
+        connection.client_connection, selectors.EVENT_WRITE, connection
+    )
+
+
+def handle_write(selector, connection):
+    try:
+        # send() sends as much as fits in the socket buffer, and returns
+        # the number of bytes sent: the rest is kept for the next time
+        sent = connection.client_connection.send(connection.write_buffer)
+    except BlockingIOError:
+        return
+    except ConnectionError:
+        close(selector, connection)
+        return
+    connection.write_buffer = connection.write_buffer[sent:]
+    if not connection.write_buffer:
+        # response sent: done with this client
+        close(selector, connection)
+
+
+def close(selector, connection):
+    try:
+        selector.unregister(connection.client_connection)
+    except (KeyError, ValueError):
+        # already closed (e.g. by serve_forever after an error)
+        pass
+    connection.client_connection.close()
+
+
+def serve_forever():
+    listen_socket = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+    listen_socket.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+    listen_socket.bind(SERVER_ADDRESS)
+    listen_socket.listen(REQUEST_QUEUE_SIZE)
+    # accept() must not block either
+    listen_socket.setblocking(False)
+    print('Serving HTTP on port {port} ...'.format(port=PORT))
+
+    selector = selectors.DefaultSelector()
+    # the listening socket is 'readable' when there are connections to
+    # accept. Its data is None, to tell it apart from the clients
+    selector.register(listen_socket, selectors.EVENT_READ, None)
+
+    while True:
+        # wait until some sockets are ready
+        for key, events in selector.select():
+            if key.data is None:
+                accept(selector, listen_socket)
+                continue
+            try:
+                if key.data.state == READING:
+                    handle_read(selector, key.data)
+                else:
+                    handle_write(selector, key.data)
+            except Exception:
+                # only this client is dropped: the others go on
+                traceback.print_exc()
+                close(selector, key.data)
+
+if __name__ == '__main__':
+    serve_forever()
@@ -0,0 +1,224 @@
+###########################################################################
+# Bounded concurrent server - webserver3i.py                              #
+#                                                                         #
+# - Forks a child per connection, like webserver3g.py                     #
+# - But never more than --max-children children at the same time         #
+#                                                                         #
+###########################################################################
+"""
+webserver3g.py forks a child for each connection it accepts, with no
+limit: a burst of clients makes it fork as many processes as there are
+clients, and the machine ends up thrashing (or running out of processes
+or file descriptors, see webserver3d.py), so every client is served
+slowly, or not at all.
+This server counts its children: the reaper (the SIGCHLD handler) removes
+them from the count when they exit. When --max-children children are
+running, the server is overloaded, and it does one of two things
+(--overload option):
+* wait  : it stops calling accept() until a child exits. The new clients
+          wait in the listen queue of the kernel (REQUEST_QUEUE_SIZE long),
+          and when that is full too, the kernel drops their connections
+* reject: it accepts the connection, and answers right away (without
+          forking) with '503 Service Unavailable' and a 'Retry-After'
+          header, telling the client to come back later. It costs much
+          less than serving the request
+In both cases the latency grows gracefully under overload, while the
+machine keeps a bounded number of processes.
+Send SIGUSR1 to the server to print its counters:
+kill -USR1 <pid>
+* active   : children running now (and peak: the most at the same time)
+* accepted : connections served by a child
+* rejected : connections answered with 503
+* queue    : connections waiting in the listen queue to be accepted
+             (Linux only)
+"""
+import argparse
+import errno
+import os
+import signal
+import socket
+import struct
+
+SERVER_ADDRESS = (HOST, PORT) = '', 8888
+REQUEST_QUEUE_SIZE = 1024
+
+# pids of the running children
+children = set()
+# counters (see print_stats)
+stats = {'accepted': 0, 'rejected': 0, 'peak': 0}
+
+# the response sent when the server is overloaded, in 'reject' mode
+HTTP_503_RESPONSE = b"""\
+HTTP/1.1 503 Service Unavailable\r
+Retry-After: 1\r
+Content-Type: text/plain\r
+Content-Length: 20\r
+Connection: close\r
+\r
+Service Unavailable
+"""
+
+
+def reap():
+    # collect all the children which have exited (no zombies left)
+    while True:
+        try:
+            pid, status = os.waitpid(
+                -1,          # Wait for any child process
+                 os.WNOHANG  # Do not block and return EWOULDBLOCK error
+            )
+        except OSError:
+            return
+
+        if pid == 0:  # no more zombies
+            return
+        children.discard(pid)
+
+
+def grim_reaper(signum, frame):
+    reap()
+
+
+def queue_depth(listen_socket):
+    """
+    number of connections in the listen queue, waiting to be accepted.
+    On Linux, getsockopt(TCP_INFO) on a listening socket returns it in
+    the field tcpi_unacked of struct tcp_info (an unsigned int after 8
+    bytes and 4 unsigned ints). None where it's not available.
+    """
+    try:
+        info = listen_socket.getsockopt(socket.IPPROTO_TCP, socket.TCP_INFO, 104)
+    except (AttributeError, OSError):
+        return None
+    return struct.unpack_from('I', info, 24)[0]
+
+
+def print_stats(listen_socket):
+    print(
+        'active={active} peak={peak} accepted={accepted} '
+        'rejected={rejected} queue={queue}'.format(
+            active=len(children),
+            queue=queue_depth(listen_socket),
+            **stats
+        ),
+        flush=True,
+    )
+
+
+def wait_for_child(max_children):
+    """
+    blocks until less than max_children children are running.
+    SIGCHLD is blocked while checking the count: otherwise a child could
+    exit (and be reaped by grim_reaper) between the check and the wait,
+    and the server would wait for a signal that already arrived.
+    sigtimedwait() waits for a blocked signal to become pending, and
+    consumes it, so it is not delivered to grim_reaper: reap() is called
+    here instead.
+    """
+    signal.pthread_sigmask(signal.SIG_BLOCK, {signal.SIGCHLD})
+    try:
+        reap()
+        while len(children) >= max_children:
+            signal.sigtimedwait({signal.SIGCHLD}, 1.0)
+            reap()
+    finally:
+        signal.pthread_sigmask(signal.SIG_UNBLOCK, {signal.SIGCHLD})
+
+
+def reject(client_connection):
+    """
+    answers with 503 from the parent, without forking. The bytes of the
+    request already received are read first: closing a socket with unread
+    data makes the kernel reset the connection, and the client could lose
+    the response.
+    """
+    client_connection.setblocking(False)
+    try:
+        client_connection.recv(1024)
+    except (BlockingIOError, ConnectionError):
+        pass
+    try:
+        client_connection.send(HTTP_503_RESPONSE)
+    except OSError:
+        pass
+    stats['rejected'] += 1
+
+
+def handle_request(client_connection):
+    request = client_connection.recv(1024)
+    print(request.decode())
+    http_response = b"""\
+HTTP/1.1 200 OK
+
+Hello, World!
+"""
+    client_connection.sendall(http_response)
+
+
+def serve_forever(max_children, overload):
+    listen_socket = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+    listen_socket.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+    listen_socket.bind(SERVER_ADDRESS)
+    listen_socket.listen(REQUEST_QUEUE_SIZE)
+    print('Serving HTTP on port {port} ...'.format(port=PORT))
+
+    signal.signal(signal.SIGCHLD, grim_reaper)
+    signal.signal(
+        signal.SIGUSR1, lambda signum, frame: print_stats(listen_socket)
+    )
+
+    while True:
+        if overload == 'wait' and len(children) >= max_children:
+            # don't accept: the clients wait in the listen queue
+            wait_for_child(max_children)
+        try:
+            client_connection, client_address = listen_socket.accept()
+        except IOError as e:
+            code, msg = e.args
+            # restart 'accept' if it was interrupted
+            if code == errno.EINTR:
+                continue
+            else:
+                raise
+
+        if len(children) >= max_children:
+            reject(client_connection)
+            client_connection.close()
+            continue
+
+        # a child exiting before its pid is in children would never be
+        # removed from the count: SIGCHLD waits until it has been added
+        signal.pthread_sigmask(signal.SIG_BLOCK, {signal.SIGCHLD})
+        pid = os.fork()
+        if pid == 0:  # child
+            listen_socket.close()  # close child copy
+            handle_request(client_connection)
+            client_connection.close()
+            os._exit(0)
+        else:  # parent
+            children.add(pid)
+            signal.pthread_sigmask(signal.SIG_UNBLOCK, {signal.SIGCHLD})
+            stats['accepted'] += 1
+            stats['peak'] = max(stats['peak'], len(children))
+            client_connection.close()  # close parent copy and loop over
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(
+        description='Fork-per-connection server with a bounded number of children.',
+        formatter_class=argparse.ArgumentDefaultsHelpFormatter,
+    )
+    parser.add_argument(
+        '--max-children',
+        type=int,
+        default=64,
+        help='Maximum number of children serving connections at the same time.'
+    )
+    parser.add_argument(
+        '--overload',
+        choices=['wait', 'reject'],
+        default='wait',
+        help='When the children are all busy: stop accepting connections '
+             '(wait), or answer them with 503 (reject).'
+    )
+    args = parser.parse_args()
+    serve_forever(args.max_children, args.overload)
@@ -0,0 +1,537 @@
+###########################################################################
+# Asynchronous WSGI server - webserver4.py                                #
+#                                                                         #
+# - One process, one thread running an event loop (asyncio)               #
+# - The WSGI application runs in a pool of threads                        #
+#                                                                         #
+###########################################################################
+"""
+All the servers seen so far block: a process (or a thread) waits in
+accept() or in recv() until something arrives. While a slow client
+takes its time to send its request, the process serving it can do
+nothing else (see webserver3b.py). To serve many clients at the same
+time, webserver3c-3g and webserver2 --workers/--threads use one
+process or one thread per connection.
+This server uses a different model: an event loop. A single thread
+asks the operating system to be notified when *any* of the sockets
+is ready (a new connection to accept, some data to read, room to
+write), and then does just the work that can be done without waiting.
+The asyncio module of python implements the event loop, and lets us
+write the code of each connection as a coroutine ('async def'): when a
+coroutine would have to wait, it 'await's, and the loop runs the other
+coroutines in the meantime.
+So an idle or slow connection costs only the memory of its coroutine,
+and not a whole process or thread.
+The catch: a WSGI application is a normal (blocking) function, which
+could block the whole event loop. So the application, and the
+iteration of the response it returns, run in a pool of threads, while
+the event loop only reads the requests and writes the responses.
+Parsing the requests and building the responses is done by the same
+code used by webserver2.py (see WSGIRequestHandler).
+Run it with:
+python webserver4.py wsgiapp:app
+"""
+import argparse
+import asyncio
+import io
+import socket
+import sys
+import time
+import traceback
+from concurrent.futures import ThreadPoolExecutor
+
+from webserver2 import (
+    AccessLog,
+    CONTINUE_RESPONSE,
+    ClientDisconnected,
+    FileWrapper,
+    HTTPError,
+    RequestBody,
+    SERVER_ADDRESS,
+    WSGIRequestHandler,
+    WSGIServer,
+)
+
+
+"""
+handles a client connection on the event loop. It reuses the methods of
+WSGIRequestHandler (webserver2.py) that don't touch the socket, e.g.
+parse_request, get_environ, start_response, build_headers, and replaces
+the ones doing I/O with coroutines using the asyncio streams:
+* reader : asyncio.StreamReader, to read from the client
+* writer : asyncio.StreamWriter, to write to the client. write() only
+           puts the data in a buffer; 'await writer.drain()' waits until
+           the buffer is small enough (so a slow client can't make us
+           buffer a whole big response in memory)
+"""
+class AsyncRequestHandler(WSGIRequestHandler):
+    def __init__(self, server, reader, writer):
+        WSGIRequestHandler.__init__(
+            self, server, None, writer.get_extra_info('peername')
+        )
+        self.reader = reader
+        self.writer = writer
+        self.loop = asyncio.get_running_loop()
+    """
+    runs func(*args) in the thread pool of the server, and waits (without
+    blocking the event loop) for its result
+    """
+    def run_in_thread(self, func, *args):
+        return self.loop.run_in_executor(self.server.executor, func, *args)
+    """
+    same as WSGIRequestHandler.handle: serves the requests of the
+    connection (keep-alive) and closes it
+    """
+    async def handle(self):
+        try:
+            for request_num in range(1, self.server.max_keepalive_requests + 1):
+                self.close_connection = (
+                    request_num == self.server.max_keepalive_requests
+                )
+                await self.handle_one_request()
+                if self.close_connection:
+                    break
+        except asyncio.TimeoutError:
+            # idle for too long: drop the connection
+            pass
+        except ConnectionError:
+            # e.g. the client reset the connection
+            pass
+        finally:
+            self.writer.close()
+            try:
+                await self.writer.wait_closed()
+            except ConnectionError:
+                pass
+
+    async def handle_one_request(self):
+        # the fields of the access log line, in case the request is
+        # rejected before parse_request (see WSGIRequestHandler)
+        self.request_line = '-'
+        self.bytes_sent = 0
+        self.headers_set = []
+        self.headers_sent = False
+        self.start_time = time.perf_counter()
+        try:
+            # wait_for raises asyncio.TimeoutError if the client sends
+            # nothing for keepalive_timeout seconds
+            request_data = await asyncio.wait_for(
+                self.read_request_head(), self.server.keepalive_timeout
+            )
+            # None means that the client closed the connection
+            if request_data is None:
+                self.close_connection = True
+                return
+            self.start_time = time.perf_counter()
+            request_lines = self.parse_request(request_data)
+            # the whole body is read before calling the app: its reads
+            # can't wait for the socket (see RequestBody in webserver2.py)
+            self.input = io.BytesIO(await self.read_request_body())
+        except HTTPError as e:
+            self.close_connection = True
+            self.writer.write(self.error_response(e.status))
+            await self.drain()
+            self.log_request(e.status)
+            return
+        # In debug mode, print formatted request data a la 'curl -v'
+        if self.server.debug:
+            print(''.join(
+                '< {line}\n'.format(line=line)
+                for line in request_lines
+            ))
+        # the client may ask to close the connection after this request
+        if not self.should_keep_alive():
+            self.close_connection = True
+        env = self.get_environ()
+        # nothing has been sent to the client yet
+        self.headers_set = []
+        self.headers_sent = False
+        try:
+            # the application runs in a thread of the pool
+            result = await self.run_in_thread(
+                self.server.application, env, self.start_response
+            )
+            await self.finish_response(result)
+        except ClientDisconnected:
+            # the client went away: nothing more to do
+            raise
+        except Exception:
+            # an error in the application: print the traceback on the
+            # server side, and tell the client (if it's not too late)
+            traceback.print_exc()
+            self.close_connection = True
+            if not self.headers_sent:
+                self.headers_set = ['500 Internal Server Error', []]
+                self.writer.write(
+                    self.error_response('500 Internal Server Error')
+                )
+                await self.drain()
+        self.log_request(self.headers_set[0] if self.headers_set else '-')
+    """
+    reads the request line and the headers, up to the empty line.
+    readuntil() keeps the bytes after the separator in the buffer of the
+    reader, for the body or the next request. It raises LimitOverrunError
+    if the separator is not found in the first 'limit' bytes (see
+    AsyncWSGIServer.serve), and IncompleteReadError if the client closes
+    the connection before sending it.
+    """
+    async def read_request_head(self):
+        while True:
+            try:
+                data = await self.reader.readuntil(b'\r\n\r\n')
+            except asyncio.LimitOverrunError:
+                raise HTTPError('431 Request Header Fields Too Large')
+            except asyncio.IncompleteReadError as e:
+                if e.partial.strip():
+                    raise HTTPError('400 Bad Request')
+                return None
+            # empty lines before the request line must be ignored
+            head = data[:-4].lstrip(b'\r\n')
+            if head:
+                return head
+
+    """
+    reads the whole request body: Content-Length bytes, or the chunks of
+    a chunked body (same rules as WSGIRequestHandler.read_request_body).
+    A client sending 'Expect: 100-continue' waits for the interim
+    response before sending the body.
+    The body is kept in memory until the app is done with it: a body
+    bigger than server.max_body_size is refused with '413 Content Too
+    Large' (before reading it, if its Content-Length says so), otherwise
+    a single client could use all the memory of the server.
+    """
+    async def read_request_body(self):
+        headers = self.request_headers
+        transfer_encoding = headers.get('HTTP_TRANSFER_ENCODING')
+        if transfer_encoding is not None:
+            if transfer_encoding.strip().lower() != 'chunked':
+                raise HTTPError('501 Not Implemented')
+            if 'CONTENT_LENGTH' in headers:
+                # both framings (see WSGIRequestHandler.read_request_body)
+                self.close_connection = True
+            await self.send_continue()
+            body = await self.read_chunked_body()
+            # the app gets the decoded body, whose length is now known
+            del headers['HTTP_TRANSFER_ENCODING']
+            headers['CONTENT_LENGTH'] = str(len(body))
+            return body
+        try:
+            length = int(headers.get('CONTENT_LENGTH', 0))
+        except ValueError:
+            raise HTTPError('400 Bad Request')
+        if length < 0:
+            raise HTTPError('400 Bad Request')
+        if length > self.server.max_body_size:
+            raise HTTPError('413 Content Too Large')
+        if length > 0:
+            await self.send_continue()
+        try:
+            return await self.reader.readexactly(length)
+        except asyncio.IncompleteReadError:
+            raise HTTPError('400 Bad Request')
+    # answers 'Expect: 100-continue' (see RequestBody in webserver2.py)
+    async def send_continue(self):
+        if (self.request_version == 'HTTP/1.1'
+                and self.request_headers.get('HTTP_EXPECT', '').lower()
+                == '100-continue'):
+            self.writer.write(CONTINUE_RESPONSE)
+            await self.drain()
+    """
+    decodes a chunked body from the reader: each chunk is its size in hex
+    (maybe followed by ';extensions'), CRLF, the data, CRLF. The last
+    chunk has size 0, and is followed by optional trailers and an empty
+    line. The sizes are checked as in RequestBody.next_chunk.
+    """
+    async def read_chunked_body(self):
+        parts = []
+        total = 0
+        while True:
+            size = (await self.read_chunk_line()).split(b';')[0].rstrip(b' \t')
+            if not size or not RequestBody.HEX_DIGITS.issuperset(size):
+                raise HTTPError('400 Bad Request')
+            size = int(size, 16)
+            if size == 0:
+                break
+            total += size
+            if total > self.server.max_body_size:
+                raise HTTPError('413 Content Too Large')
+            try:
+                parts.append(await self.reader.readexactly(size))
+            except asyncio.IncompleteReadError:
+                raise HTTPError('400 Bad Request')
+            if await self.read_chunk_line():
+                # the data must be followed by CRLF
+                raise HTTPError('400 Bad Request')
+        # trailers, up to the empty line
+        while await self.read_chunk_line():
+            pass
+        return b''.join(parts)
+    # reads a line of the chunked framing, without its CRLF
+    async def read_chunk_line(self):
+        try:
+            line = await self.reader.readuntil(b'\r\n')
+        except (asyncio.LimitOverrunError, asyncio.IncompleteReadError):
+            raise HTTPError('400 Bad Request')
+        return line[:-2]
+    """
+    the write(body_data) callable returned by start_response. The app
+    calls it from its thread: the data is passed to the event loop, and
+    the thread waits until it has been written
+    """
+    def write(self, data):
+        asyncio.run_coroutine_threadsafe(
+            self.async_write(data), self.loop
+        ).result()
+    """
+    same as WSGIRequestHandler.write, on the event loop
+    """
+    async def async_write(self, data):
+        if not self.headers_set:
+            raise AssertionError('write() before start_response()')
+        if not data:
+            # the headers wait for the first non-empty piece
+            return
+        # the headers and the first piece of body are written together
+        # (see WSGIRequestHandler.write)
+        parts = []
+        if not self.headers_sent:
+            parts.append(self.build_headers())
+            self.headers_sent = True
+        if self.response_has_body():
+            parts.append(self.frame_body(data))
+        self.writer.write(b''.join(parts))
+        await self.drain()
+    """
+    same as WSGIRequestHandler.send_headers, on the event loop
+    """
+    async def async_send_headers(self):
+        self.writer.write(self.build_headers())
+        self.headers_sent = True
+        await self.drain()
+    """
+    same as WSGIRequestHandler.finish_response. If the result is a list,
+    its pieces are already there; otherwise each next() on the result
+    may run code of the app (e.g. a generator), and it is done in a
+    thread of the pool.
+    """
+    async def finish_response(self, result):
+        try:
+            if isinstance(result, FileWrapper):
+                params = result.sendfile_params()
+                if params is not None:
+                    await self.sendfile(result.filelike, *params)
+                    return
+            if isinstance(result, (list, tuple)):
+                if len(result) == 1:
+                    self.set_default_header(
+                        'Content-Length', str(len(result[0]))
+                    )
+                for data in result:
+                    await self.async_write(data)
+            else:
+                iterator = await self.run_in_thread(iter, result)
+                while True:
+                    data = await self.run_in_thread(next, iterator, None)
+                    if data is None:
+                        break
+                    await self.async_write(data)
+            if not self.headers_sent:
+                # empty body: the headers are still to be sent
+                if self.response_has_body():
+                    self.set_default_header('Content-Length', '0')
+                await self.async_send_headers()
+            elif self.chunked:
+                # last, empty chunk
+                self.writer.write(b'0\r\n\r\n')
+                await self.drain()
+        finally:
+            # see WSGIRequestHandler.finish_response
+            if hasattr(result, 'close'):
+                await self.run_in_thread(result.close)
+    """
+    waits until the data written can be buffered (see writer above). A
+    failure of the connection is a ClientDisconnected (see webserver2.py),
+    not an error of the app
+    """
+    async def drain(self):
+        try:
+            await self.writer.drain()
+        except ConnectionError as e:
+            raise ClientDisconnected(*e.args) from e
+    """
+    same as WSGIRequestHandler.sendfile, with loop.sendfile(), which
+    uses os.sendfile when possible
+    """
+    async def sendfile(self, filelike, fd, offset, size):
+        size = self.sendfile_size(size)
+        await self.async_send_headers()
+        if not self.response_has_body():
+            return
+        if self.server.debug:
+            print('> [{size} bytes sent with sendfile]\n'.format(size=size))
+        try:
+            sent = await self.loop.sendfile(
+                self.writer.transport, filelike, offset, size
+            )
+        except ConnectionError as e:
+            raise ClientDisconnected(*e.args) from e
+        self.bytes_sent += sent
+        if sent < size:
+            # the file is shorter than expected
+            self.close_connection = True
+
+
+"""
+the server: it has the same configuration and the same application
+interface as WSGIServer in webserver2.py (see make_server below), but
+serves the connections on an event loop.
+"""
+class AsyncWSGIServer(object):
+    # same limits as WSGIServer
+    request_queue_size = WSGIServer.request_queue_size
+    keepalive_timeout = WSGIServer.keepalive_timeout
+    max_keepalive_requests = WSGIServer.max_keepalive_requests
+    max_header_size = WSGIServer.max_header_size
+    # biggest request body, in bytes (see read_request_body)
+    max_body_size = 10 * 1024 * 1024
+    # number of threads running the application
+    threads = 8
+    # class of the objects that handle the client connections
+    handler_class = AsyncRequestHandler
+
+    def __init__(self, server_address):
+        self.server_address = server_address
+        # the application runs in many threads, in one process
+        self.multithread = True
+        self.multiprocess = False
+        # see WSGIServer
+        self.access_log = AccessLog(sys.stdout)
+        self.debug = False
+        # no graceful stop here (see WSGIServer.handle_worker_exit)
+        self.stopping = False
+
+    def set_app(self, application):
+        self.application = application
+    # same as WSGIServer.setup_environ
+    setup_environ = WSGIServer.setup_environ
+    """
+    asyncio.start_server(client_connected_cb, host, port) creates the
+    listening socket, and for each new connection calls (on the event
+    loop) the coroutine client_connected_cb(reader, writer).
+    """
+    async def serve(self):
+        self.executor = ThreadPoolExecutor(max_workers=self.threads)
+        # the access log is written by its own thread, so the event loop
+        # never waits for the terminal or the disk
+        if self.access_log is not None:
+            self.access_log.start()
+        host, port = self.server_address
+        server = await asyncio.start_server(
+            self.handle_connection,
+            host or None,
+            port,
+            backlog=self.request_queue_size,
+            # maximum size of the request head (see read_request_head)
+            limit=self.max_header_size,
+        )
+        # same as WSGIServer.__init__
+        host, port = server.sockets[0].getsockname()[:2]
+        self.server_name = socket.getfqdn(host)
+        self.server_port = port
+        self.setup_environ()
+        async with server:
+            await server.serve_forever()
+
+    async def handle_connection(self, reader, writer):
+        handler = self.handler_class(self, reader, writer)
+        await handler.handle()
+    """
+    runs the event loop until manually interrupted
+    """
+    def serve_forever(self):
+        asyncio.run(self.serve())
+
+
+def make_server(server_address, application):
+    server = AsyncWSGIServer(server_address)
+    server.set_app(application)
+    return server
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(
+        description='Asynchronous WSGI server for LSBAWS.',
+        formatter_class=argparse.ArgumentDefaultsHelpFormatter,
+    )
+    parser.add_argument(
+        'app',
+        help='WSGI application object as module:callable'
+    )
+    parser.add_argument(
+        '--threads',
+        type=int,
+        default=AsyncWSGIServer.threads,
+        help='Number of threads running the application.'
+    )
+    parser.add_argument(
+        '--keepalive-timeout',
+        type=float,
+        default=AsyncWSGIServer.keepalive_timeout,
+        help='Seconds an idle keep-alive connection is kept open.'
+    )
+    parser.add_argument(
+        '--max-requests',
+        type=int,
+        default=AsyncWSGIServer.max_keepalive_requests,
+        help='Maximum number of requests served per connection.'
+    )
+    parser.add_argument(
+        '--max-body-size',
+        type=float,
+        default=AsyncWSGIServer.max_body_size / (1024 * 1024),
+        help='Biggest request body (MB), bigger ones get 413.'
+    )
+    parser.add_argument(
+        '--access-log',
+        default='-',
+        help='Access log file ("-": standard output, "": no access log).'
+    )
+    parser.add_argument(
+        '--access-log-sample',
+        type=float,
+        default=1.0,
+        help='Fraction of the requests written in the access log.'
+    )
+    parser.add_argument(
+        '--debug',
+        action='store_true',
+        help='Print every request and response.'
+    )
+    args = parser.parse_args()
+    # import the app, as in webserver2.py
+    module, application = args.app.split(':')
+    module = __import__(module)
+    application = getattr(module, application)
+    httpd = make_server(SERVER_ADDRESS, application)
+    httpd.threads = args.threads
+    httpd.keepalive_timeout = args.keepalive_timeout
+    httpd.max_keepalive_requests = args.max_requests
+    httpd.max_body_size = int(args.max_body_size * 1024 * 1024)
+    httpd.debug = args.debug
+    if not args.access_log:
+        httpd.access_log = None
+    else:
+        if args.access_log == '-':
+            stream = sys.stdout
+        else:
+            stream = open(args.access_log, 'a')
+        httpd.access_log = AccessLog(stream, args.access_log_sample)
+    print('AsyncWSGIServer: Serving HTTP on port {port} ...\n'.format(
+        port=SERVER_ADDRESS[1]))
+    try:
+        httpd.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        if httpd.access_log is not None:
+            httpd.access_log.flush()